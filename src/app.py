@@ -1,24 +1,58 @@
+import asyncio
 import gradio as gr
-import pandas as pd
 import os
-from aws_helpers import upload_file_to_s3, get_s3_metadata, resync_bedrock_knowledge_base
+from aws_clients import warm_up
+from metrics import start_metrics_server
+from aws_helpers import upload_file_to_s3
+from ingestion_scheduler import IngestionScheduler
 from metadata_extractor import extract_metadata_new_file
+from publications import PublicationSnapshot, SORT_COLUMNS
 # from tempfile import NamedTemporaryFile
 # from llm import LlmBot
-from rag_bot import RagBot
+from session_manager import SessionManager
+from local_retriever import LocalRagRetriever
+from hybrid_retriever import HybridRagRetriever
+from rag_retriever import RagRetriever
 import time
 from dotenv import load_dotenv
 load_dotenv()
 
 
-# Initialize the LlmBot with the cat persona
-bot = RagBot(
+# Every browser session gets its own bot, sharing the retriever and AWS clients underneath
+# Uploads are coalesced into as few ingestion jobs as possible
+ingestion_scheduler = IngestionScheduler()
+# The Publications tab pages through a snapshot of the catalog that loads after startup
+publications = PublicationSnapshot()
+
+# Set LOCAL_INDEX_DIR to answer from a local vector index instead of the knowledge base
+retriever = None
+if os.environ.get('LOCAL_INDEX_DIR'):
+    retriever = LocalRagRetriever(os.environ['LOCAL_INDEX_DIR'], num_results=4)
+# Set LEXICAL_INDEX_DIR to fuse vector results with a local BM25 index
+if os.environ.get('LEXICAL_INDEX_DIR'):
+    retriever = HybridRagRetriever(
+        retriever or RagRetriever(os.environ.get('KNOWLEDGE_BASE_ID'), num_results=4),
+        os.environ['LEXICAL_INDEX_DIR']
+    )
+sessions = SessionManager(
     knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
-    system_prompt="You're a helpful academic."
+    system_prompt="You're a helpful academic.",
+    retriever=retriever
 )
 
-def on_submit(message, history):
-    return chat(message, history)
+# Chat handlers are async, so many questions can be in flight on one event loop
+CHAT_CONCURRENCY = int(os.environ.get('CHAT_CONCURRENCY', 64))
+
+async def on_submit(message, history, filters, request: gr.Request):
+    async for update in chat(message, history, filters, request):
+        yield update
+
+def clear_chat(request: gr.Request):
+    sessions.get(request.session_hash).llm.clear_chat_history()
+    return None
+
+def end_session(request: gr.Request):
+    sessions.end(request.session_hash)
 
 def clear_specific_warning(value, warning):
     if value:
@@ -74,22 +108,23 @@ def update_metadata_input(file_obj, authors_warning, title_warning, year_warning
             
         return authors, title, year, topic, authors_warning, title_warning, year_warning, topic_warning
     
-def upload_file(file_obj, authors, title, year, topic, current_df):
-    """Upload a file to S3 and resync the Bedrock knowledge base
+def upload_file(file_obj, authors, title, year, topic, progress=gr.Progress()):
+    """Upload a file to S3, add it to the publications and schedule a resync of the Bedrock
+    knowledge base
     Args:
         file_obj (File): File object to upload
         authors (str): Authors of the publication
         title (str): Title of the publication
         year (int): Year of the publication
         topic (str): Topic of the publication
-        current_df (pd.DataFrame): Current DataFrame of publications
+        progress (gr.Progress): Progress bar that follows the bytes sent to S3
     Returns:
-        pd.DataFrame: Updated DataFrame of publications
         str: Authors of the publication
         str: Title of the publication
         int: Year of the publication
         str: Topic of the publication
         File: File object
+        Button: Submit button showing the result
     """
     metadata = {
         'authors': authors,
@@ -99,23 +134,57 @@ def upload_file(file_obj, authors, title, year, topic, current_df):
     }
     
     try:
-        upload_file_to_s3(file_path=file_obj.name, metadata=metadata)
-        resync_bedrock_knowledge_base()
+        status, duplicate = upload_file_to_s3(
+            file_path=file_obj.name, metadata=metadata,
+            progress=lambda sent, total: progress(sent / max(total, 1), desc="Uploading")
+        )
         upload_success = True
     except Exception as e:
         print(f"Error uploading file: {e}")
         upload_success = False
+    if upload_success and status == "skipped":
+        return "", "", "", "", None, gr.Button(
+            value=f"Already in the library as {duplicate}", interactive=False
+        )
     if upload_success:
-        metadata["file"] = os.path.basename(file_obj.name)
-        new_row = pd.DataFrame([metadata])
-        new_row = new_row.drop(columns=["topic"])
-        new_row = format_metadata(new_row)
-        updated_df = pd.concat([new_row, current_df], ignore_index=True).reset_index(drop=True)
-        return updated_df, "", "", "", "", None, gr.Button(
+        ingestion_scheduler.request_sync()
+        if duplicate is not None:
+            publications.remove(duplicate)
+        publications.insert({**metadata, "file": os.path.basename(file_obj.name)})
+        return "", "", "", "", None, gr.Button(
             value="Upload successful!", interactive=False
         )
     else:
-        return current_df, authors, title, year, topic, file_obj, gr.Button("Submit")
+        return authors, title, year, topic, file_obj, gr.Button("Submit")
+
+
+async def show_publications(page, search, sort_by, descending):
+    """Render one page of the publications
+    Args:
+        page (int): 1-based page number
+        search (str): Words that authors, title or year must contain
+        sort_by (str): Column to sort by
+        descending (bool): Whether to sort in descending order
+    Returns:
+        pd.DataFrame: Publications of the page
+        int: Page number, clamped to the available pages
+        Markdown: Page position and number of matches
+    """
+    # Waits for the snapshot on the first render without blocking the event loop
+    df, page, pages, total = await asyncio.to_thread(
+        publications.page, page, search, sort_by, descending
+    )
+    info = gr.Markdown(f'<p style="font-size: 12px;">Page {page} of {pages} ({total} publications)</p>')
+    return format_metadata(df), page, info
+
+async def search_publications(search, sort_by, descending):
+    return await show_publications(1, search, sort_by, descending)
+
+async def previous_publications(page, search, sort_by, descending):
+    return await show_publications(page - 1, search, sort_by, descending)
+
+async def next_publications(page, search, sort_by, descending):
+    return await show_publications(page + 1, search, sort_by, descending)
 
 
 def format_metadata(df, max_length=50):
@@ -137,17 +206,43 @@ def format_metadata(df, max_length=50):
     return df
 
 
+def ingestion_status():
+    """Describe the state of the knowledge base sync for the Publications tab"""
+    status = ingestion_scheduler.status()
+    if status["pending"]:
+        text = f"⏳ {status['pending']} new publication(s) waiting to be indexed"
+    elif status["job_status"] in (None, "COMPLETE"):
+        text = "✅ All publications are searchable" if status["job_status"] else ""
+    elif status["job_status"] in ("FAILED", "STOPPED", "CANCELLED"):
+        text = f"⚠️ Indexing {status['job_status'].lower()}"
+    else:
+        text = "🔄 Indexing new publications..."
+    if status["last_error"]:
+        text += f" (last error: {status['last_error']})"
+    return gr.Markdown(f'<p style="font-size: 12px;">{text}</p>')
+
 def reset_button():
     """Reset the button after 2 seconds"""
     time.sleep(2)  # Wait for 2 seconds
     return gr.Button(value="Submit", interactive=True)
 
-def chat(message, history):
-    bot_response = bot.chat(message)
-    history.append((message, bot_response))
-    return "", history
-
-def update_selected(n, academic, educator, fun_mode, custom, custom_prompt_text):
+async def chat(message, history, filters, request: gr.Request):
+    """Stream the bot's answer into the chat history token by token
+    Args:
+        message (str): User message
+        history (list): Chat history
+        filters (dict): Retrieval filters of the user's session
+        request (gr.Request): Request of the user's session
+    """
+    bot = sessions.get(request.session_hash)
+    history.append((message, ""))
+    bot_response = ""
+    async for token in bot.astream_chat(message, **filters):
+        bot_response += token
+        history[-1] = (message, bot_response)
+        yield "", history
+
+def update_selected(n, academic, educator, fun_mode, custom, custom_prompt_text, request: gr.Request):
     """Update the selected behavior and system prompt
     Args:
         n (int): Selected behavior
@@ -156,6 +251,7 @@ def update_selected(n, academic, educator, fun_mode, custom, custom_prompt_text)
         fun_mode (Button): Fun mode behavior button
         custom (Button): Custom behavior button
         custom_prompt_text (str): Custom system prompt text    
+        request (gr.Request): Request of the user's session
     Returns:
         list[Button]: Updated behavior buttons
         Textbox: Custom system prompt textbox
@@ -175,21 +271,23 @@ def update_selected(n, academic, educator, fun_mode, custom, custom_prompt_text)
         prompt = custom_prompt_text if custom_prompt_text else "Enter your custom prompt above."
         custom_prompt_visible = True
     
-    bot.llm.change_system_prompt(prompt)
+    sessions.get(request.session_hash).llm.change_system_prompt(prompt)
 
     return [gr.update(variant="primary" if i == n else "secondary") for i in buttons] + [gr.update(visible=custom_prompt_visible)]
 
+def change_custom_prompt(prompt, request: gr.Request):
+    sessions.get(request.session_hash).llm.change_system_prompt(prompt)
+
 # Filter functionality functions
 
-def change_filter_years(start, end):
-    # This is a dummy function for now
+def change_filter_years(start, end, filters):
     print(f"Filtering years: start={start}, end={end}")
-    bot.retriever.filter_years(start, end)
+    return {**filters, "start_year": start, "end_year": end}
 
 def toggle_year_filter(checked):
     return gr.update(visible=checked)
 
-def handle_year_filter(checked, from_year, to_year):
+def handle_year_filter(checked, from_year, to_year, filters):
     if checked:
         start = int(from_year) if from_year.strip() else 1800
         end = int(to_year) if to_year.strip() else 2100
@@ -198,24 +296,24 @@ def handle_year_filter(checked, from_year, to_year):
     else:
         start, end = 1800, 2100
     
-    change_filter_years(start, end)
+    return change_filter_years(start, end, filters)
 
 
 # topic stuff
 def toggle_topic_filter(checked):
     return gr.update(visible=checked)
 
-def change_filter_topic(topic):
+def change_filter_topic(topic, filters):
     print(f"Filtering topic: {topic}")
-    bot.retriever.filter_topic(topic)
+    return {**filters, "topic": topic}
 
-def handle_topic_filter(checked, topic):
+def handle_topic_filter(checked, topic, filters):
     if checked:
         if topic is not None:
             topic = str(topic) if topic.strip() else None
-        change_filter_topic(topic)
+        return change_filter_topic(topic, filters)
     else:
-        change_filter_topic(None)
+        return change_filter_topic(None, filters)
 
 
     # Modify the Gradio interface
@@ -247,6 +345,8 @@ with gr.Blocks(
         with gr.Column(scale=4):
             with gr.Tab("Chat"):
                 chatbot = gr.Chatbot()
+                # Retrieval filters of this browser session, passed with every question
+                retrieval_filters = gr.State({})
                 msg = gr.Textbox(lines=1, label="Message")
                 with gr.Group():
                     with gr.Row():
@@ -286,9 +386,11 @@ with gr.Blocks(
                 submit = gr.Button("Submit")
                 clear = gr.Button("Clear")
 
-                submit.click(on_submit, inputs=[msg, chatbot], outputs=[msg, chatbot])
-                msg.submit(on_submit, inputs=[msg, chatbot], outputs=[msg, chatbot])
-                clear.click(lambda: None, None, chatbot, queue=False)
+                submit.click(on_submit, inputs=[msg, chatbot, retrieval_filters], outputs=[msg, chatbot],
+                             concurrency_limit=CHAT_CONCURRENCY, concurrency_id="chat")
+                msg.submit(on_submit, inputs=[msg, chatbot, retrieval_filters], outputs=[msg, chatbot],
+                           concurrency_limit=CHAT_CONCURRENCY, concurrency_id="chat")
+                clear.click(clear_chat, None, chatbot, queue=False)
 
                 # Connect behavior selection buttons
                 academic_btn.click(update_selected, 
@@ -306,21 +408,23 @@ with gr.Blocks(
 
                 # Add event for custom prompt changes
                 custom_prompt.change(
-                    lambda prompt: bot.llm.change_system_prompt(prompt),
+                    change_custom_prompt,
                     inputs=[custom_prompt],
                     outputs=[]
                 )
 
             with gr.Tab("Publications"):
                 with gr.Column():
+                    with gr.Row(variant="compact"):
+                        search_input = gr.Textbox(label="Search", placeholder="Authors, title or year", scale=3)
+                        sort_input = gr.Dropdown(list(SORT_COLUMNS), value="year", label="Sort by", scale=1)
+                        descending_input = gr.Checkbox(label="Descending", value=True, scale=1)
                     with gr.Row(70):
-                        df = get_s3_metadata()
-                        # shorten long titles and authors and add ... at the end when shortened
-                        df = format_metadata(df)
+                        # Filled page by page once the snapshot has loaded
                         # make the theme text size smaller
                         publications_list = gr.Dataframe(
                             headers=["authors", "title", "year"],
-                            value=df,
+                            value=[],
                             datatype=["str", "str", "number"],
                             label="Publications List",
                             interactive=False,
@@ -329,6 +433,11 @@ with gr.Blocks(
                             column_widths=[20, 20, 3],
                             height=300
                         )
+                    with gr.Row():
+                        previous_page = gr.Button("◀", size="sm", scale=0)
+                        page_info = gr.Markdown("")
+                        next_page = gr.Button("▶", size="sm", scale=0)
+                        page_number = gr.State(1)
                     with gr.Row(30, variant="compact"):
                         # Left 80% for text inputs
                         with gr.Column(scale=70):
@@ -346,6 +455,10 @@ with gr.Blocks(
                 title_warning = gr.Markdown("", visible=False)
                 year_warning = gr.Markdown("", visible=False)
                 topic_warning = gr.Markdown("", visible=False)
+                with gr.Row():
+                    sync_status = gr.Markdown("")
+                    refresh_status = gr.Button("Refresh status", size="sm", scale=0)
+                refresh_status.click(fn=ingestion_status, outputs=sync_status, queue=False)
                 
                 # Add event listener for file upload
                 file_input.upload(
@@ -384,18 +497,34 @@ with gr.Blocks(
                     outputs=[topic_warning]
                 )
                 
+                # Search, sorting and paging run on the server, only one page is sent
+                page_inputs = [page_number, search_input, sort_input, descending_input]
+                page_outputs = [publications_list, page_number, page_info]
+                demo.load(fn=show_publications, inputs=page_inputs, outputs=page_outputs)
+                for view_input in (search_input, sort_input, descending_input):
+                    view_input.change(fn=search_publications, inputs=page_inputs[1:], outputs=page_outputs)
+                previous_page.click(fn=previous_publications, inputs=page_inputs, outputs=page_outputs)
+                next_page.click(fn=next_publications, inputs=page_inputs, outputs=page_outputs)
+
                 add_button.click(
                     fn=upload_file, 
                     inputs=[
-                        file_input, authors_input, title_input, year_input, topic_input, publications_list
+                        file_input, authors_input, title_input, year_input, topic_input
                     ],
                     outputs=[
-                        publications_list, authors_input, title_input, year_input, topic_input, file_input,
+                        authors_input, title_input, year_input, topic_input, file_input,
                         add_button
                     ]
+                ).then(
+                    fn=show_publications,
+                    inputs=page_inputs,
+                    outputs=page_outputs
                 ).then(
                     fn=reset_button,
                     outputs=add_button
+                ).then(
+                    fn=ingestion_status,
+                    outputs=sync_status
                 )
 
                 
@@ -414,29 +543,36 @@ with gr.Blocks(
                 # Add new event listener for year filter changes
                 filter_by_year.change(
                     fn=handle_year_filter,
-                    inputs=[filter_by_year, year_from, year_to]
+                    inputs=[filter_by_year, year_from, year_to, retrieval_filters],
+                    outputs=retrieval_filters
                 )
                 year_from.change(
                     fn=handle_year_filter,
-                    inputs=[filter_by_year, year_from, year_to]
+                    inputs=[filter_by_year, year_from, year_to, retrieval_filters],
+                    outputs=retrieval_filters
                 )
                 
                 year_to.change(
                     fn=handle_year_filter,
-                    inputs=[filter_by_year, year_from, year_to]
+                    inputs=[filter_by_year, year_from, year_to, retrieval_filters],
+                    outputs=retrieval_filters
                 )
                 
                 # add event listener for topic filter changes
                 filter_by_topic.change(
                     fn=handle_topic_filter,
-                    inputs=[filter_by_topic, topic_dropdown]
+                    inputs=[filter_by_topic, topic_dropdown, retrieval_filters],
+                    outputs=retrieval_filters
                 )
                 
                 topic_dropdown.change(
                     fn=handle_topic_filter,
-                    inputs=[filter_by_topic, topic_dropdown]
+                    inputs=[filter_by_topic, topic_dropdown, retrieval_filters],
+                    outputs=retrieval_filters
                )
 
+    demo.unload(end_session)
+
     # Add custom footer
     gr.HTML(
         """
@@ -447,6 +583,9 @@ with gr.Blocks(
     )
 
 if __name__ == "__main__":
+    warm_up()
+    start_metrics_server()
+    publications.load_async()
     demo.launch(
         server_name=os.environ.get('SERVER_IP'),
         server_port=int(os.environ.get('SERVER_PORT')),
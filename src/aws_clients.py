@@ -0,0 +1,99 @@
+import boto3
+import logging
+import os
+import threading
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Connection pool and retry settings shared by every client of the process
+CLIENT_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', 50)),
+    tcp_keepalive=True,
+    connect_timeout=float(os.environ.get('AWS_CONNECT_TIMEOUT', 5)),
+    read_timeout=float(os.environ.get('AWS_READ_TIMEOUT', 120)),
+    retries={
+        'max_attempts': int(os.environ.get('AWS_MAX_ATTEMPTS', 5)),
+        'mode': os.environ.get('AWS_RETRY_MODE', 'adaptive'),
+    },
+)
+
+# Large files are uploaded in parts on several threads of the shared connection pool
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.environ.get('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024)),
+    multipart_chunksize=int(os.environ.get('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024)),
+    max_concurrency=int(os.environ.get('S3_MAX_CONCURRENCY', 10)),
+    use_threads=True,
+)
+
+SERVICES = ('s3', 'bedrock-runtime', 'bedrock-agent', 'bedrock-agent-runtime')
+
+_session = boto3.session.Session()
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, region_name=None):
+    """Get the process-wide client for an AWS service
+    Clients are created once per service and region and then shared, so connection pools
+    and TLS sessions are reused across requests. boto3 clients are thread-safe.
+    Args:
+        service_name (str): Name of the AWS service, e.g. 's3' or 'bedrock-runtime'
+        region_name (str, optional): AWS region. Defaults to AWS_DEFAULT_REGION.
+    Returns:
+        boto3.client: Shared client for the service
+    """
+    if region_name is None:
+        region_name = os.environ.get('AWS_DEFAULT_REGION')
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        # Sessions are not thread-safe, so clients are created under the lock
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _session.client(service_name, region_name=region_name, config=CLIENT_CONFIG)
+                _clients[key] = client
+    return client
+
+
+def set_client(service_name, client, region_name=None):
+    """Replace the shared client of a service, e.g. with a local stand-in for benchmarks
+    Args:
+        service_name (str): Name of the AWS service
+        client: Object with the same methods as the boto3 client
+        region_name (str, optional): AWS region. Defaults to AWS_DEFAULT_REGION.
+    """
+    if region_name is None:
+        region_name = os.environ.get('AWS_DEFAULT_REGION')
+    with _lock:
+        _clients[(service_name, region_name)] = client
+
+
+def warm_up(services=SERVICES, bucket_name=os.environ.get('BUCKET_NAME')):
+    """Create the shared clients at startup and open a first connection to S3
+    Args:
+        services (tuple[str]): Services to create clients for
+        bucket_name (str): Bucket used to open a connection to S3
+    """
+    for service_name in services:
+        get_client(service_name)
+    if 's3' in services and bucket_name:
+        try:
+            get_client('s3').head_bucket(Bucket=bucket_name)
+        except Exception as e:
+            logger.info(f"S3 warm-up failed: {e}")
+    logger.info(f"AWS clients ready: {', '.join(services)}")
+
+
+def reset_clients():
+    """Drop all shared clients, e.g. after the credentials changed"""
+    with _lock:
+        _clients.clear()
@@ -1,9 +1,15 @@
-import boto3
 import pandas as pd
+import io
 import logging
 import json
 import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from aws_clients import TRANSFER_CONFIG, get_client
+from dedup import DEDUP_POLICIES, DEDUP_POLICY, content_hashes, find_duplicate, is_newer
+from metrics import span
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -13,11 +19,74 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# The catalog lives in the bucket next to the papers. JSON is not a supported document type
+# of Bedrock knowledge bases, so ingestion jobs skip it.
+CATALOG_KEY = os.environ.get('CATALOG_KEY', 'catalog.json')
+CATALOG_COLUMNS = ["authors", "title", "year", "topic"]
+# Last catalog fetched per bucket: {'etag': str, 'objects': dict}
+_catalog_cache = {}
+_catalog_lock = threading.Lock()
+# Callbacks run whenever a new ingestion job starts, e.g. to invalidate retrieval caches
+_ingestion_listeners = []
+# Files up to this size are read into memory once and hashed and uploaded from there
+IN_MEMORY_UPLOAD_LIMIT = int(os.environ.get('S3_IN_MEMORY_UPLOAD_LIMIT', 64 * 1024 * 1024))
+
+
+class UploadProgress:
+    """
+    Sums the byte counts that boto3 reports from its transfer threads and passes the total on.
+
+    Args:
+        total (int): Size of the upload in bytes
+        callback (callable): Called with the bytes transferred so far and the total size
+    """
+    def __init__(self, total, callback):
+        self.total = total
+        self.callback = callback
+        self.transferred = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, bytes_amount):
+        with self._lock:
+            self.transferred += bytes_amount
+            transferred = self.transferred
+        self.callback(transferred, self.total)
+
+
+def _open_upload(file_path, fileobj=None):
+    """Buffer to upload from: the given file-like object, the file read into memory at once,
+    or the open file if it is too large for memory"""
+    if fileobj is not None:
+        return fileobj
+    if os.path.getsize(file_path) <= IN_MEMORY_UPLOAD_LIMIT:
+        with open(file_path, 'rb') as f:
+            return io.BytesIO(f.read())
+    return open(file_path, 'rb')
+
+
+def register_ingestion_listener(callback):
+    """Register a callback that is called with the job ID when an ingestion job starts and
+    again when it completes, i.e. when the newly ingested papers become retrievable
+    Args:
+        callback (callable): Function taking the ingestion job ID
+    """
+    _ingestion_listeners.append(callback)
+
+
+def notify_ingestion_listeners(job_id):
+    """Call the registered ingestion listeners with the ID of a started or completed job"""
+    for callback in _ingestion_listeners:
+        try:
+            callback(job_id)
+        except Exception as e:
+            logger.info(f"Ingestion listener failed for job {job_id}: {e}")
+
 
 def upload_file_to_s3(
         file_path, metadata, bucket_name=os.environ.get('BUCKET_NAME'), object_name=None,
+        dedup_policy=DEDUP_POLICY, fileobj=None, progress=None
     ):
-    """Upload a file to an S3 bucket with metadata
+    """Upload a file to an S3 bucket with metadata, unless the paper is already there
     Args:
         file_path (str): Local path of the file to upload
         metadata (dict): Metadata to be stored with the file
@@ -29,8 +98,17 @@ def upload_file_to_s3(
             }
         bucket_name (str): Name of the bucket to upload to
         object_name (str): S3 object name. If not specified then file_name is used
+        dedup_policy (str, optional): What to do if another version of the paper is in the
+            bucket: "skip", "replace" the older version or "keep" both. Identical files are
+            always skipped. None uploads without checking.
+        fileobj (file-like, optional): Binary buffer with the file content, e.g. an upload that
+            is already in memory. Read from `file_path` if not given.
+        progress (callable, optional): Called with the bytes transferred so far and the total
+            size while the file is uploaded
+    Returns:
+        tuple[str, str | None]: "uploaded", "replaced" or "skipped", and the object name of
+            the duplicate in the bucket, if any
     """
-    s3 = boto3.client('s3')
     if object_name is None:
         object_name = os.path.basename(file_path)
     
@@ -44,19 +122,42 @@ def upload_file_to_s3(
         if isinstance(value, str):
             metadata[key] = value.translate(special_char_map)
 
+    buffer = _open_upload(file_path, fileobj)
+    try:
+        return _upload(buffer, file_path, metadata, bucket_name, object_name, dedup_policy, progress)
+    finally:
+        if buffer is not fileobj:
+            buffer.close()
+
+
+def _upload(buffer, file_path, metadata, bucket_name, object_name, dedup_policy, progress):
+    s3 = get_client('s3')
+    hashes = content_hashes(buffer)
+    duplicate = None
+    if dedup_policy is not None:
+        if dedup_policy not in DEDUP_POLICIES:
+            raise ValueError(f"dedup_policy must be one of {', '.join(DEDUP_POLICIES)}")
+        catalog = load_catalog(bucket_name, s3=s3)
+        if catalog is None:
+            catalog = rebuild_catalog(bucket_name, s3=s3)
+        found = find_duplicate(object_name, metadata, hashes, catalog)
+        if found is not None:
+            duplicate, reason = found
+            replace = dedup_policy == "replace" and is_newer(object_name, duplicate, reason)
+            if reason == "identical" or dedup_policy == "skip" or (dedup_policy == "replace" and not replace):
+                logger.info(f"Skipping {file_path}, {bucket_name}/{duplicate} is the same paper ({reason})")
+                return "skipped", duplicate
+            if dedup_policy == "keep":
+                duplicate = None
+
+    # The SHA-256 identifies the content even for multipart uploads, whose ETag is no hash
+    metadata = {**metadata, 'sha256': hashes[1]}
     # Prepare the ExtraArgs parameter
     extra_args = {
         'Metadata': metadata,
         'ContentType': 'application/pdf'  # Adjust this based on your file type
     }
     
-    try:
-        s3.upload_file(file_path, bucket_name, object_name, ExtraArgs=extra_args)
-        logger.info(
-            f"File {file_path} uploaded successfully to {bucket_name}/{object_name} with metadata"
-        )
-    except Exception as e:
-        logger.info(f"Error uploading file: {e}")
     # upload metadata file to s3
     metadata_file = {
     "metadataAttributes": {
@@ -68,49 +169,287 @@ def upload_file_to_s3(
     }
     # turn metadata file into json
     metadata_file = json.dumps(metadata_file)
-    # upload metadata file to s3
-    s3.put_object(Bucket=bucket_name, Key=f"{object_name}.metadata.json", Body=metadata_file)
+    sidecar_key = f"{object_name}.metadata.json"
+    # A failed upload only removes what it created, never an object that was already there
+    pdf_existed = _object_exists(s3, bucket_name, object_name)
+
+    start = buffer.tell()
+    size = buffer.seek(0, io.SEEK_END) - start
+    buffer.seek(start)
+    callback = UploadProgress(size, progress) if progress is not None else None
+    try:
+        with span("s3_upload"):
+            s3.upload_fileobj(
+                buffer, bucket_name, object_name, ExtraArgs=extra_args, Config=TRANSFER_CONFIG,
+                Callback=callback
+            )
+        logger.info(
+            f"File {file_path} uploaded successfully to {bucket_name}/{object_name} with metadata"
+        )
+    except Exception as e:
+        logger.info(f"Error uploading file: {e}")
+        raise
+    # The sidecar follows the PDF, so it never describes a file that failed to upload
+    try:
+        s3.put_object(Bucket=bucket_name, Key=sidecar_key, Body=metadata_file)
+    except Exception as e:
+        logger.info(f"Error uploading sidecar {sidecar_key}, retrying: {e}")
+        try:
+            s3.put_object(Bucket=bucket_name, Key=sidecar_key, Body=metadata_file)
+        except Exception:
+            if pdf_existed:
+                logger.info(
+                    f"Keeping {bucket_name}/{object_name}, it existed before and its sidecar could not be updated"
+                )
+            else:
+                # A PDF without its sidecar would be indexed without metadata, so the upload is undone
+                s3.delete_object(Bucket=bucket_name, Key=object_name)
+            raise
+
+    removed = ()
+    if duplicate is not None and duplicate != object_name:
+        # The older version and its sidecar leave the bucket, so its chunks leave the index
+        s3.delete_object(Bucket=bucket_name, Key=duplicate)
+        s3.delete_object(Bucket=bucket_name, Key=f"{duplicate}.metadata.json")
+        removed = (duplicate,)
+        logger.info(f"Replaced {bucket_name}/{duplicate} with {object_name}")
+
+    try:
+        response = s3.head_object(Bucket=bucket_name, Key=object_name)
+        update_catalog(
+            {object_name: _catalog_entry(response, metadata)}, bucket_name=bucket_name, removed=removed
+        )
+    except Exception as e:
+        logger.info(f"Error updating catalog: {e}")
+    return ("replaced" if duplicate is not None else "uploaded"), duplicate
+
+
+def _object_exists(s3, bucket_name, key):
+    try:
+        s3.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+            return False
+        raise
 
 
-def get_s3_metadata(bucket_name=os.environ.get('BUCKET_NAME')):
+def _catalog_entry(head_response, metadata=None):
+    """Build a catalog entry from a head_object response and the object metadata"""
+    if metadata is None:
+        metadata = head_response.get('Metadata', {})
+    entry = {column: metadata.get(column) for column in CATALOG_COLUMNS}
+    entry.update({
+        'sha256': metadata.get('sha256'),
+        'Size': head_response.get('ContentLength'),
+        'LastModified': str(head_response.get('LastModified')),
+        'ETag': head_response.get('ETag'),
+    })
+    return entry
+
+
+def load_catalog(bucket_name=os.environ.get('BUCKET_NAME'), s3=None):
+    """Fetch the publication catalog of a bucket with a single GET
+    The last fetched version is kept in memory and only downloaded again if its ETag changed.
+    Args:
+        bucket_name (str): Name of the bucket
+        s3 (boto3.client, optional): S3 client to use
+    Returns:
+        dict: Catalog entries keyed by object name, or None if the bucket has no catalog yet
+    """
+    if s3 is None:
+        s3 = get_client('s3')
+    cached = _catalog_cache.get(bucket_name)
+    kwargs = {'Bucket': bucket_name, 'Key': CATALOG_KEY}
+    if cached is not None:
+        kwargs['IfNoneMatch'] = cached['etag']
+    try:
+        response = s3.get_object(**kwargs)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ('304', 'NotModified'):
+            return cached['objects']
+        if code in ('NoSuchKey', '404'):
+            return None
+        raise
+    objects = json.loads(response['Body'].read())['objects']
+    _catalog_cache[bucket_name] = {'etag': response['ETag'], 'objects': objects}
+    return objects
+
+
+def _write_catalog(s3, bucket_name, objects, etag=None):
+    """Write the catalog, only if nobody changed it since it was read with `etag`"""
+    kwargs = {
+        'Bucket': bucket_name, 'Key': CATALOG_KEY, 'ContentType': 'application/json',
+        'Body': json.dumps({'objects': objects}),
+    }
+    if etag is not None:
+        kwargs['IfMatch'] = etag
+    else:
+        kwargs['IfNoneMatch'] = '*'
+    response = s3.put_object(**kwargs)
+    _catalog_cache[bucket_name] = {'etag': response['ETag'], 'objects': objects}
+
+
+def update_catalog(entries, bucket_name=os.environ.get('BUCKET_NAME'), max_attempts=5, removed=()):
+    """Add or replace entries in the catalog of a bucket
+    Concurrent writers are detected with a conditional PUT and the update is retried.
+    Args:
+        entries (dict): Catalog entries keyed by object name
+        bucket_name (str): Name of the bucket
+        max_attempts (int): Maximum number of read-modify-write attempts
+        removed (tuple[str]): Object names to drop from the catalog
+    """
+    s3 = get_client('s3')
+    with _catalog_lock:
+        for attempt in range(max_attempts):
+            objects = load_catalog(bucket_name, s3=s3)
+            if objects is None:
+                objects = rebuild_catalog(bucket_name, s3=s3)
+            objects = {key: entry for key, entry in {**objects, **entries}.items() if key not in removed}
+            etag = _catalog_cache.get(bucket_name, {}).get('etag')
+            try:
+                _write_catalog(s3, bucket_name, objects, etag=etag)
+                return
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+                    raise
+                logger.info(f"Catalog changed concurrently, retrying ({attempt + 1}/{max_attempts})")
+                _catalog_cache.pop(bucket_name, None)
+        raise RuntimeError(f"Could not update catalog of {bucket_name} after {max_attempts} attempts")
+
+
+def rebuild_catalog(bucket_name=os.environ.get('BUCKET_NAME'), s3=None, max_workers=32):
+    """Rebuild the catalog from scratch with concurrent head_object calls
+    Args:
+        bucket_name (str): Name of the bucket
+        s3 (boto3.client, optional): S3 client to use
+        max_workers (int): Number of concurrent head_object calls
+    Returns:
+        dict: Catalog entries keyed by object name
+    """
+    if s3 is None:
+        s3 = get_client('s3')
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name):
+        for obj in page.get('Contents', []):
+            key = obj['Key']
+            # Sidecars and the catalog itself carry no publication metadata
+            if key == CATALOG_KEY or key.endswith('.metadata.json'):
+                continue
+            keys.append(key)
+
+    def head(key):
+        return key, _catalog_entry(s3.head_object(Bucket=bucket_name, Key=key))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        objects = dict(executor.map(head, keys))
+    logger.info(f"Rebuilt catalog of {bucket_name} with {len(objects)} objects")
+
+    etag = _catalog_cache.get(bucket_name, {}).get('etag')
+    try:
+        _write_catalog(s3, bucket_name, objects, etag=etag)
+    except ClientError as e:
+        # Another process wrote a catalog in the meantime, which is just as good
+        logger.info(f"Catalog not written: {e}")
+    return objects
+
+
+def get_s3_metadata(bucket_name=os.environ.get('BUCKET_NAME'), rebuild=False):
     """Get metadata for all objects in an S3 bucket
+    The metadata is read from the bucket's catalog in one GET. The catalog is rebuilt from
+    the objects themselves if it does not exist yet or `rebuild` is set.
     Args:
         bucket_name (str): Name of the bucket to list objects from
+        rebuild (bool): Whether to rebuild the catalog from scratch
     Returns:
         pd.DataFrame: DataFrame containing metadata for each object in the bucket
     """
-    s3 = boto3.client('s3')
-    metadata_list = []
+    s3 = get_client('s3')
 
     try:
-        # List all objects in the bucket
-        paginator = s3.get_paginator('list_objects_v2')
-        for page in paginator.paginate(Bucket=bucket_name):
-            for obj in page.get('Contents', []):
-                # Get metadata for each object
-                response = s3.head_object(Bucket=bucket_name, Key=obj['Key'])
-                
-                # Combine object info with metadata
-                metadata = {
-                    'Key': obj['Key'],
-                    'Size': obj['Size'],
-                    'LastModified': obj['LastModified'],
-                    **response.get('Metadata', {}),
-                    'ContentType': response.get('ContentType'),
-                    'ETag': response.get('ETag'),
-                }
-                metadata_list.append(metadata)
-
+        with span("s3_metadata", source="rebuild" if rebuild else "catalog"):
+            objects = None if rebuild else load_catalog(bucket_name, s3=s3)
+            if objects is None:
+                objects = rebuild_catalog(bucket_name, s3=s3)
     except Exception as e:
         logger.info(f"Error: {e}")
         return None
 
-    # Create DataFrame from the list of metadata dictionaries
-    df = pd.DataFrame(metadata_list)
-    df = df[["authors", "title", "year", "Key"]].rename(columns={"Key": "file"})
+    metadata_list = [{**entry, 'Key': key} for key, entry in objects.items()]
+    df = pd.DataFrame(metadata_list, columns=["authors", "title", "year", "Key"])
+    df = df.rename(columns={"Key": "file"})
     return df
 
 
+# Ingestion job states after which a job no longer changes
+INGESTION_DONE_STATES = ('COMPLETE', 'FAILED', 'STOPPED', 'CANCELLED')
+
+
+def start_ingestion_job(
+        knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
+        data_source_id=os.environ.get('DATA_SOURCE_ID')
+    ):
+    """Start an ingestion job that re-syncs the knowledge base with the S3 bucket
+    Args:
+        knowledge_base_id (str): ID of the knowledge base to re-sync
+        data_source_id (str): ID of the data source to re-sync
+    Returns:
+        str: ID of the ingestion job
+    """
+    with span("ingestion_start"):
+        response = get_client('bedrock-agent').start_ingestion_job(
+            knowledgeBaseId=knowledge_base_id,
+            dataSourceId=data_source_id,
+            description='Re-sync knowledge base with S3 bucket'
+        )
+    job_id = response['ingestionJob']['ingestionJobId']
+    logger.info(f"Ingestion job started. Job ID: {job_id}")
+    notify_ingestion_listeners(job_id)
+    return job_id
+
+
+def get_ingestion_job_status(
+        job_id, knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
+        data_source_id=os.environ.get('DATA_SOURCE_ID')
+    ):
+    """Get the status of an ingestion job, e.g. 'IN_PROGRESS' or 'COMPLETE'"""
+    return get_client('bedrock-agent').get_ingestion_job(
+        knowledgeBaseId=knowledge_base_id,
+        dataSourceId=data_source_id,
+        ingestionJobId=job_id
+    )['ingestionJob']['status']
+
+
+def wait_for_ingestion_job(
+        job_id, knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
+        data_source_id=os.environ.get('DATA_SOURCE_ID'), initial_delay=1, max_delay=30
+    ):
+    """Poll an ingestion job with exponential backoff until it is done
+    Args:
+        job_id (str): ID of the ingestion job
+        knowledge_base_id (str): ID of the knowledge base
+        data_source_id (str): ID of the data source
+        initial_delay (float): Seconds before the first poll
+        max_delay (float): Maximum seconds between two polls
+    Returns:
+        str: Final status of the job
+    """
+    delay = initial_delay
+    while True:
+        time.sleep(delay)
+        job_status = get_ingestion_job_status(job_id, knowledge_base_id, data_source_id)
+        if job_status in INGESTION_DONE_STATES:
+            logger.info(f"Re-sync finished. Status: {job_status}")
+            if job_status == 'COMPLETE':
+                notify_ingestion_listeners(job_id)
+            return job_status
+        logger.info(f"Re-sync in progress. Current status: {job_status}")
+        delay = min(delay * 2, max_delay)
+
+
 def resync_bedrock_knowledge_base(
         knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
         data_source_id=os.environ.get('DATA_SOURCE_ID'), wait_for_completion=False
@@ -120,39 +459,17 @@ def resync_bedrock_knowledge_base(
         knowledge_base_id (str): ID of the knowledge base to re-sync
         data_source_id (str): ID of the data source to re-sync
         wait_for_completion (bool): Whether to wait for the re-sync job to complete
+    Returns:
+        str: ID of the ingestion job, None if it could not be started
     """
-    bedrock = boto3.client('bedrock-agent', region_name=os.environ.get('AWS_DEFAULT_REGION'))
     try:
-        # Start a new ingestion job
-        response = bedrock.start_ingestion_job(
-            knowledgeBaseId=knowledge_base_id,
-            dataSourceId=data_source_id,
-            description='Re-sync knowledge base with S3 bucket'
-        )
-        
-        job_id = response['ingestionJob']['ingestionJobId']
-        logger.info(f"Ingestion job started. Job ID: {job_id}")
-        
-        # Wait for the job to complete
+        job_id = start_ingestion_job(knowledge_base_id, data_source_id)
         if wait_for_completion:
-            while True:
-                job_status = bedrock.get_ingestion_job(
-                    knowledgeBaseId=knowledge_base_id,
-                    dataSourceId=data_source_id,
-                    ingestionJobId=job_id
-                )['ingestionJob']['status']
-                
-                if job_status == 'COMPLETE':
-                    logger.info("Re-sync completed successfully.")
-                    break
-                elif job_status in ['FAILED', 'CANCELLED']:
-                    logger.info(f"Re-sync failed. Status: {job_status}")
-                    break
-                else:
-                    logger.info(f"Re-sync in progress. Current status: {job_status}")
-                    time.sleep(1)  # Wait for 30 seconds before checking again
+            wait_for_ingestion_job(job_id, knowledge_base_id, data_source_id)
+        return job_id
     except Exception as e:
         logger.info(f"An error occurred: {str(e)}")
+        return None
 
 
 def invoke_agent_helper(
@@ -169,9 +486,7 @@ def invoke_agent_helper(
     Returns:
         str: Response from the agent
     """
-    bedrock_agent_runtime_client = boto3.client(
-        'bedrock-agent-runtime', region_name=os.environ.get('AWS_DEFAULT_REGION')
-    )
+    bedrock_agent_runtime_client = get_client('bedrock-agent-runtime')
     end_session: bool = False
     if not session_state:
         session_state = {}
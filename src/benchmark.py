@@ -0,0 +1,226 @@
+"""Offline end-to-end benchmarks against local stand-ins for S3, Bedrock and the chat model
+
+Usage:
+    python benchmark.py --corpus-sizes 10,100,1000,10000 --sessions 1,4,16
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmarks never talk to AWS; these only keep the real clients constructible
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+os.environ.setdefault('METADATA_EXTRACTION_MODE', 'json')
+os.environ['METADATA_CACHE_DIR'] = os.path.join(tempfile.mkdtemp(prefix="bench-"), "metadata")
+
+import aws_helpers
+from aws_clients import set_client
+from fakes import (
+    FakeS3Client, FakeBedrockAgentClient, FakeKnowledgeBaseClient, FakeChatModel, SyntheticCorpus
+)
+
+BUCKET = "benchmark-bucket"
+EXTRACTION_RESPONSE = (
+    '{"authors": ["Ashish Vaswani", "Noam Shazeer", "Niki Parmar"], '
+    '"title": "Attention Is All You Need", "year": 2017, "topic": "ML"}'
+)
+
+
+def percentile(sorted_samples, q):
+    if not sorted_samples:
+        return float('nan')
+    index = min(int(round(q / 100 * (len(sorted_samples) - 1))), len(sorted_samples) - 1)
+    return sorted_samples[index]
+
+
+class Report:
+    """Collects latency samples per stage and prints them as a table or JSON"""
+    def __init__(self):
+        self.rows = []
+
+    def add(self, stage, params, latencies, wall_seconds):
+        latencies = sorted(latencies)
+        self.rows.append({
+            "stage": stage,
+            **params,
+            "n": len(latencies),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "throughput_per_s": len(latencies) / wall_seconds if wall_seconds > 0 else float('nan'),
+        })
+        row = self.rows[-1]
+        extra = " ".join(f"{k}={v}" for k, v in params.items())
+        print(
+            f"{stage:<24} {extra:<28} n={row['n']:<5} p50={row['p50_ms']:9.1f}ms "
+            f"p95={row['p95_ms']:9.1f}ms p99={row['p99_ms']:9.1f}ms "
+            f"throughput={row['throughput_per_s']:8.1f}/s",
+            flush=True
+        )
+
+    def to_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.rows, f, indent=2)
+
+
+def run_concurrent(fn, items, concurrency):
+    """Call fn on every item with a thread pool and time every call
+    Returns:
+        tuple[list[float], float]: Latency per call and wall time in seconds
+    """
+    def timed(item):
+        start = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, items))
+    return latencies, time.perf_counter() - start
+
+
+def fill_bucket(s3, corpus_size):
+    s3.objects.clear()
+    corpus = SyntheticCorpus(corpus_size)
+    for paper in range(corpus_size):
+        metadata = corpus.paper_metadata(paper)
+        key = f"paper{paper}.pdf"
+        s3.add_paper(BUCKET, key, {
+            'authors': metadata['authors'], 'title': metadata['name'],
+            'year': str(metadata['year']), 'topic': metadata['type'],
+        })
+        s3.add_paper(BUCKET, f"{key}.metadata.json", {}, size=100)
+    aws_helpers._catalog_cache.clear()
+
+
+def bench_s3_metadata(report, s3, corpus_sizes, repeats):
+    for corpus_size in corpus_sizes:
+        fill_bucket(s3, corpus_size)
+        latencies, wall = run_concurrent(
+            lambda _: aws_helpers.get_s3_metadata(BUCKET, rebuild=True), range(1), 1
+        )
+        report.add("get_s3_metadata_rebuild", {"papers": corpus_size}, latencies, wall)
+        aws_helpers._catalog_cache.clear()
+        latencies, wall = run_concurrent(lambda _: aws_helpers.get_s3_metadata(BUCKET), range(repeats), 1)
+        report.add("get_s3_metadata_catalog", {"papers": corpus_size}, latencies, wall)
+
+
+def bench_upload(report, s3, uploads, concurrencies, pdf_path):
+    fill_bucket(s3, 10)
+    aws_helpers.get_s3_metadata(BUCKET)
+    counter = iter(range(10 ** 9))
+    lock = threading.Lock()
+
+    def upload(_):
+        with lock:
+            i = next(counter)
+        aws_helpers.upload_file_to_s3(
+            pdf_path, {'authors': 'A', 'title': f'Upload {i}', 'year': '2020', 'topic': 'ML'},
+            bucket_name=BUCKET, object_name=f"upload{i}.pdf", dedup_policy=None
+        )
+
+    for concurrency in concurrencies:
+        latencies, wall = run_concurrent(upload, range(uploads), concurrency)
+        report.add("upload_file_to_s3", {"concurrency": concurrency}, latencies, wall)
+
+
+def bench_extract(report, pdf_paths, repeats, model_kwargs):
+    import metadata_extractor
+    metadata_extractor.get_extractor_bot().model = FakeChatModel(response=EXTRACTION_RESPONSE, **model_kwargs)
+    paths = [pdf_paths[i % len(pdf_paths)] for i in range(repeats)]
+    latencies, wall = run_concurrent(
+        lambda path: metadata_extractor.extract_metadata_new_file(path, use_cache=False), paths, 1
+    )
+    report.add("extract_metadata", {"cache": "off"}, latencies, wall)
+    latencies, wall = run_concurrent(metadata_extractor.extract_metadata_new_file, paths, 1)
+    report.add("extract_metadata", {"cache": "on"}, latencies, wall)
+
+
+def bench_chat(report, corpus_sizes, session_counts, questions, model_kwargs, retrieval_latency):
+    from rag_retriever import RagRetriever, retrieval_cache
+    from session_manager import SessionManager
+
+    for corpus_size in corpus_sizes:
+        set_client(
+            'bedrock-agent-runtime',
+            FakeKnowledgeBaseClient(SyntheticCorpus(corpus_size), latency=retrieval_latency)
+        )
+        for session_count in session_counts:
+            retrieval_cache.clear()
+            sessions = SessionManager(
+                knowledge_base_id="benchmark",
+                retriever=RagRetriever(knowledge_base_id="benchmark", num_results=8)
+            )
+            ttfts, totals = [], []
+            lock = threading.Lock()
+
+            def run_session(session):
+                bot = sessions.get(f"session-{session}")
+                bot.llm.model = FakeChatModel(**model_kwargs)
+                for question in range(questions):
+                    start = time.perf_counter()
+                    first = None
+                    for _ in bot.stream_chat(f"Question {question} of session {session} about dropout?"):
+                        if first is None:
+                            first = time.perf_counter() - start
+                    with lock:
+                        ttfts.append(first)
+                        totals.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=session_count) as executor:
+                list(executor.map(run_session, range(session_count)))
+            wall = time.perf_counter() - start
+            params = {"papers": corpus_size, "sessions": session_count}
+            report.add("chat_time_to_first_token", params, ttfts, wall)
+            report.add("chat_total", params, totals, wall)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the RAG pipeline")
+    parser.add_argument("--corpus-sizes", default="10,100,1000,10000")
+    parser.add_argument("--sessions", default="1,4,16")
+    parser.add_argument("--questions", type=int, default=3, help="Questions per chat session")
+    parser.add_argument("--s3-latency", type=float, default=0.01, help="Seconds per S3 request")
+    parser.add_argument("--retrieval-latency", type=float, default=0.1, help="Seconds per retrieve call")
+    parser.add_argument("--time-to-first-token", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--pdf-dir", default=os.path.join(os.path.dirname(__file__), "..", "pdfs"))
+    parser.add_argument("--stages", default="s3,upload,extract,chat")
+    parser.add_argument("--json", default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    corpus_sizes = [int(n) for n in args.corpus_sizes.split(",")]
+    session_counts = [int(n) for n in args.sessions.split(",")]
+    stages = args.stages.split(",")
+    model_kwargs = {
+        "time_to_first_token": args.time_to_first_token,
+        "tokens_per_second": args.tokens_per_second,
+    }
+    pdf_paths = sorted(
+        os.path.join(args.pdf_dir, f) for f in os.listdir(args.pdf_dir) if f.lower().endswith(".pdf")
+    )
+
+    s3 = FakeS3Client(latency=args.s3_latency)
+    set_client('s3', s3)
+    set_client('bedrock-agent', FakeBedrockAgentClient())
+    report = Report()
+    try:
+        if "s3" in stages:
+            bench_s3_metadata(report, s3, corpus_sizes, args.repeats)
+        if "upload" in stages:
+            bench_upload(report, s3, args.repeats, session_counts, pdf_paths[0])
+        if "extract" in stages:
+            bench_extract(report, pdf_paths, args.repeats, model_kwargs)
+        if "chat" in stages:
+            bench_chat(report, corpus_sizes, session_counts, args.questions, model_kwargs, args.retrieval_latency)
+    finally:
+        shutil.rmtree(os.path.dirname(os.environ['METADATA_CACHE_DIR']), ignore_errors=True)
+    if args.json:
+        report.to_json(args.json)
@@ -0,0 +1,343 @@
+import argparse
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aws_clients import warm_up
+from aws_helpers import upload_file_to_s3, resync_bedrock_knowledge_base
+from dedup import DEDUP_POLICIES, DEDUP_POLICY
+from metadata_extractor import (
+    extract_metadata_batch, extract_metadata_from_text, fast_path_metadata, merge_metadata,
+    resolve_fast_path
+)
+from pdf_engine import FIRST_PAGE, PdfEngine, PdfRejected
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Manifest states a file moves through, in order
+STATUS_PENDING = "pending"
+STATUS_EXTRACTED = "extracted"
+STATUS_INCOMPLETE = "incomplete"
+STATUS_UPLOADED = "uploaded"
+STATUS_FAILED = "failed"
+# Rejected by the PDF engine, e.g. too large or too slow to parse; never retried
+STATUS_QUARANTINED = "quarantined"
+# The paper is already in the bucket and was not uploaded again
+STATUS_DUPLICATE = "duplicate"
+
+REQUIRED_FIELDS = ("authors", "title", "year", "topic")
+
+
+class IngestManifest:
+    """
+    A resumable on-disk record of the bulk ingestion progress.
+
+    The manifest is a JSON Lines journal: every state change appends one line with the file
+    name and the changed fields, such as the status, the extracted metadata and the last
+    error, so recording progress costs the same for the first and the last of thousands of
+    files. On load the lines are merged per file and the journal is compacted to one line
+    per file. An interrupted run can be restarted and continues where it stopped: uploaded
+    files are skipped and files with extracted metadata go straight to the upload stage.
+    Incomplete metadata can be fixed by hand in the manifest; setting the status of a
+    file's line back to "extracted" makes the next run upload the file. Uploads that are not
+    covered by an ingestion job yet are marked with a line without a file name, so a resumed
+    run still starts the job.
+
+    Args:
+        path (str): Path of the manifest file; manifests in the older single JSON object
+            format are converted on load
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._journal = None
+        self.entries = {}
+        self.resync_pending = False
+        if os.path.exists(path):
+            self._load()
+            self._compact()
+
+    def _load(self):
+        with open(self.path) as f:
+            content = f.read()
+        try:
+            entries = json.loads(content)
+            # A one-line journal is a JSON object too, but its values are not all entries
+            if isinstance(entries, dict) and all(isinstance(entry, dict) for entry in entries.values()):
+                # Manifest written before the journal format
+                self.entries = entries
+                return
+        except ValueError:
+            pass
+        for line in content.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut off by an interrupted run; its change is simply redone
+                continue
+            file_name = record.pop("file", None)
+            if file_name is None:
+                self.resync_pending = record.get("resync_pending", self.resync_pending)
+                continue
+            self.entries.setdefault(file_name, {"status": STATUS_PENDING}).update(record)
+
+    def _compact(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for file_name, entry in self.entries.items():
+                f.write(json.dumps({"file": file_name, **entry}) + "\n")
+            if self.resync_pending:
+                f.write(json.dumps({"resync_pending": True}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def get(self, file_name):
+        with self._lock:
+            return dict(self.entries.get(file_name, {"status": STATUS_PENDING}))
+
+    def _append(self, record):
+        if self._journal is None:
+            self._journal = open(self.path, "a")
+        self._journal.write(json.dumps(record) + "\n")
+        self._journal.flush()
+
+    def update(self, file_name, **fields):
+        with self._lock:
+            entry = self.entries.setdefault(file_name, {"status": STATUS_PENDING})
+            entry.update(fields)
+            self._append({"file": file_name, **fields})
+
+    def set_resync_pending(self, pending):
+        """Mark whether uploads are waiting for an ingestion job"""
+        with self._lock:
+            if self.resync_pending != pending:
+                self.resync_pending = pending
+                self._append({"resync_pending": pending})
+
+    def count(self, status):
+        with self._lock:
+            return sum(1 for entry in self.entries.values() if entry["status"] == status)
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class BulkIngester:
+    """
+    Ingest a whole directory of PDFs into the S3 bucket behind the knowledge base.
+
+    Every file runs through three stages: PDF parsing, LLM metadata extraction and S3 upload.
+    Each stage has its own bounded number of slots, so the stages overlap across files
+    while Bedrock and S3 are never hit with more concurrent requests than configured.
+    A single ingestion job is started after all uploads instead of one per file.
+
+    Args:
+        pdf_dir (str): Directory containing the `.pdf` files
+        manifest_path (str): Path of the resumable progress manifest
+        parse_workers (int): Number of worker processes that parse PDFs
+        llm_workers (int): Number of concurrent Bedrock metadata extraction calls
+        upload_workers (int): Number of concurrent S3 uploads
+        batch_size (int): If larger than 1, extract metadata for up to this many papers per
+            LLM call before the uploads start
+        bucket_name (str): Name of the bucket to upload to
+        quarantine_dir (str, optional): Directory rejected PDFs are moved to
+        dedup_policy (str, optional): What to do with papers that are already in the bucket,
+            see `upload_file_to_s3`
+    """
+    def __init__(
+            self, pdf_dir, manifest_path=None, parse_workers=os.cpu_count(), llm_workers=8,
+            upload_workers=8, batch_size=1, bucket_name=os.environ.get('BUCKET_NAME'),
+            quarantine_dir=None, dedup_policy=DEDUP_POLICY
+        ):
+        self.pdf_dir = pdf_dir
+        if manifest_path is None:
+            manifest_path = os.path.join(pdf_dir, "ingest_manifest.json")
+        self.manifest = IngestManifest(manifest_path)
+        self.bucket_name = bucket_name
+        self.parse_workers = parse_workers
+        self.llm_workers = llm_workers
+        self.batch_size = batch_size
+        self.dedup_policy = dedup_policy
+        self.pdf_engine = PdfEngine(workers=parse_workers, quarantine_dir=quarantine_dir)
+        self._parse_slots = threading.BoundedSemaphore(parse_workers)
+        self._llm_slots = threading.BoundedSemaphore(llm_workers)
+        self._upload_slots = threading.BoundedSemaphore(upload_workers)
+        self.max_workers = parse_workers + llm_workers + upload_workers
+
+    def list_pdfs(self):
+        return sorted(f for f in os.listdir(self.pdf_dir) if f.lower().endswith('.pdf'))
+
+    def _extract_batch(self, file_names, texts, candidates):
+        results = extract_metadata_batch(texts, max_batch_size=self.batch_size)
+        for file_name, metadata, file_candidates in zip(file_names, results, candidates):
+            metadata = merge_metadata(file_candidates, metadata)
+            self.manifest.update(file_name, status=STATUS_EXTRACTED, metadata=metadata, error=None)
+
+    def _extract_batched(self, file_names):
+        """Extract metadata for all pending files with one LLM call per batch of papers"""
+        pending = [f for f in file_names if self.manifest.get(f)["status"] in (STATUS_PENDING, STATUS_FAILED)]
+        paths = [os.path.join(self.pdf_dir, f) for f in pending]
+        parsed = []
+        for file_name, (path, text, info) in zip(pending, self.pdf_engine.imap_text(paths, FIRST_PAGE, with_info=True)):
+            if text is None:
+                self.manifest.update(
+                    file_name, status=STATUS_QUARANTINED, error=self.pdf_engine.quarantined.get(path)
+                )
+                continue
+            candidates = resolve_fast_path(path, text, info)
+            metadata = fast_path_metadata(candidates)
+            if metadata is not None:
+                # Identified from the PDF itself, no LLM call needed
+                self.manifest.update(file_name, status=STATUS_EXTRACTED, metadata=metadata, error=None)
+            else:
+                parsed.append((file_name, text, candidates))
+
+        with ThreadPoolExecutor(max_workers=self.llm_workers) as executor:
+            futures = []
+            for start in range(0, len(parsed), self.batch_size):
+                batch_files, batch_texts, batch_candidates = zip(*parsed[start:start + self.batch_size])
+                futures.append(executor.submit(
+                    self._extract_batch, batch_files, list(batch_texts), batch_candidates
+                ))
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    # The files stay pending and are extracted one by one in the main pass
+                    logger.info(f"Error in batched metadata extraction: {e}")
+
+    def _ingest_file(self, file_name):
+        file_path = os.path.join(self.pdf_dir, file_name)
+        entry = self.manifest.get(file_name)
+        metadata = entry.get("metadata")
+
+        if entry["status"] not in (STATUS_EXTRACTED, STATUS_INCOMPLETE) or metadata is None:
+            with self._parse_slots:
+                try:
+                    text, info = self.pdf_engine.read_document(file_path, pages=FIRST_PAGE)
+                except PdfRejected as e:
+                    self.manifest.update(file_name, status=STATUS_QUARANTINED, error=str(e))
+                    return STATUS_QUARANTINED
+            candidates = resolve_fast_path(file_path, text, info)
+            metadata = fast_path_metadata(candidates)
+            if metadata is None:
+                with self._llm_slots:
+                    metadata = merge_metadata(candidates, extract_metadata_from_text(text))
+
+        missing = [key for key in REQUIRED_FIELDS if not metadata.get(key)]
+        if missing:
+            self.manifest.update(
+                file_name, status=STATUS_INCOMPLETE, metadata=metadata,
+                error=f"Missing metadata: {', '.join(missing)}"
+            )
+            return STATUS_INCOMPLETE
+        self.manifest.update(file_name, status=STATUS_EXTRACTED, metadata=metadata, error=None)
+
+        upload_metadata = {key: str(metadata[key]) for key in REQUIRED_FIELDS}
+        with self._upload_slots:
+            status, duplicate = upload_file_to_s3(
+                file_path=file_path, metadata=upload_metadata, bucket_name=self.bucket_name,
+                dedup_policy=self.dedup_policy
+            )
+        if status == "skipped":
+            self.manifest.update(file_name, status=STATUS_DUPLICATE, error=f"Duplicate of {duplicate}")
+            return STATUS_DUPLICATE
+        # Marked before the status, so a crash in between still leads to a re-sync
+        self.manifest.set_resync_pending(True)
+        self.manifest.update(file_name, status=STATUS_UPLOADED)
+        return STATUS_UPLOADED
+
+    def run(self, resync=True, wait_for_completion=False):
+        """Ingest all files of the directory that are not uploaded yet
+        Args:
+            resync (bool): Whether to start an ingestion job after the uploads
+            wait_for_completion (bool): Whether to wait for the ingestion job to complete
+        Returns:
+            dict: Number of files per manifest status, and under 'resync' whether the
+                ingestion job was "started", "failed" to start or is still "pending"
+                because `resync` is off; None if nothing needs to be indexed
+        """
+        done = (STATUS_UPLOADED, STATUS_INCOMPLETE, STATUS_QUARANTINED, STATUS_DUPLICATE)
+        todo = [f for f in self.list_pdfs() if self.manifest.get(f)["status"] not in done]
+        logger.info(f"Ingesting {len(todo)} files from {self.pdf_dir}")
+        if self.batch_size > 1:
+            self._extract_batched(todo)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._ingest_file, f): f for f in todo}
+            for i, future in enumerate(as_completed(futures), start=1):
+                file_name = futures[future]
+                try:
+                    status = future.result()
+                except Exception as e:
+                    logger.info(f"Error ingesting {file_name}: {e}")
+                    status = STATUS_FAILED
+                    self.manifest.update(file_name, status=STATUS_FAILED, error=str(e))
+                logger.info(f"[{i}/{len(todo)}] {file_name}: {status}")
+
+        self.pdf_engine.close()
+        # Also covers uploads of an earlier run that stopped before its re-sync
+        resync_status = None
+        if self.manifest.resync_pending:
+            resync_status = "pending"
+            if resync:
+                job_id = resync_bedrock_knowledge_base(wait_for_completion=wait_for_completion)
+                if job_id is None:
+                    resync_status = "failed"
+                    logger.info("Could not start the ingestion job, the next run tries again")
+                else:
+                    resync_status = "started"
+                    self.manifest.set_resync_pending(False)
+
+        summary = {
+            status: self.manifest.count(status)
+            for status in (
+                STATUS_UPLOADED, STATUS_DUPLICATE, STATUS_INCOMPLETE, STATUS_QUARANTINED, STATUS_FAILED
+            )
+        }
+        summary["resync"] = resync_status
+        self.manifest.close()
+        logger.info(f"Bulk ingestion finished: {summary}")
+        return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk-ingest a directory of PDFs")
+    parser.add_argument("pdf_dir", help="Directory containing the PDFs, e.g. pdfs/")
+    parser.add_argument("--manifest", default=None, help="Path of the progress manifest")
+    parser.add_argument("--parse-workers", type=int, default=os.cpu_count())
+    parser.add_argument("--llm-workers", type=int, default=8)
+    parser.add_argument("--upload-workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1, help="Papers per metadata LLM call")
+    parser.add_argument("--no-resync", action="store_true", help="Do not start an ingestion job")
+    parser.add_argument("--wait", action="store_true", help="Wait for the ingestion job to finish")
+    parser.add_argument("--quarantine-dir", default=None, help="Move rejected PDFs to this directory")
+    parser.add_argument(
+        "--dedup-policy", default=DEDUP_POLICY, choices=DEDUP_POLICIES,
+        help="What to do with other versions of papers that are already in the bucket"
+    )
+    args = parser.parse_args()
+    warm_up()
+
+    ingester = BulkIngester(
+        args.pdf_dir,
+        manifest_path=args.manifest,
+        parse_workers=args.parse_workers,
+        llm_workers=args.llm_workers,
+        upload_workers=args.upload_workers,
+        batch_size=args.batch_size,
+        quarantine_dir=args.quarantine_dir,
+        dedup_policy=args.dedup_policy,
+    )
+    summary = ingester.run(resync=not args.no_resync, wait_for_completion=args.wait)
+    if summary["resync"] == "failed":
+        raise SystemExit("The ingestion job could not be started; run again to retry the re-sync")
@@ -0,0 +1,86 @@
+import re
+from llm import estimate_tokens
+
+
+def _paper_key(doc):
+    metadata = doc.metadata.get('source_metadata', {})
+    return metadata.get('x-amz-bedrock-kb-source-uri') or (metadata.get('name'), metadata.get('authors'))
+
+
+def _year(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _shingles(text, n=3):
+    words = re.findall(r'\w+', text.lower())
+    return {tuple(words[i:i + n]) for i in range(max(len(words) - n + 1, 1))}
+
+
+def _strip_overlap(kept_texts, text, min_overlap=30):
+    """Remove the start of `text` that repeats the end of an already kept chunk
+    Neighbouring chunks of the splitter overlap by up to `chunk_overlap` characters.
+    """
+    for kept in kept_texts:
+        for size in range(min(len(kept), len(text)), min_overlap - 1, -1):
+            if kept.endswith(text[:size]):
+                return text[size:].lstrip()
+            if text.endswith(kept[:size]):
+                return text[:-size].rstrip()
+    return text
+
+
+def pack_context(docs, max_tokens=3000, duplicate_threshold=0.8):
+    """Pack retrieved chunks into a compact, token-budgeted context
+    Chunks are grouped by paper, so title, authors and year are written once per paper.
+    Near-duplicate chunks are dropped and text shared with a kept neighbouring chunk is
+    removed. Chunks are added in retrieval order until the token budget is used up.
+    Args:
+        docs (list[Document]): Retrieved chunks, best first, with `source_metadata`
+        max_tokens (int): Estimated token budget of the whole context
+        duplicate_threshold (float): Word-trigram Jaccard similarity above which a chunk
+            counts as a duplicate of a kept chunk
+    Returns:
+        str: Context for the prompt
+    """
+    papers = {}  # paper key -> {'header': str, 'texts': list, 'shingles': list}
+    used_tokens = 0
+    for doc in docs:
+        key = _paper_key(doc)
+        paper = papers.get(key)
+        header_tokens = 0
+        if paper is None:
+            metadata = doc.metadata['source_metadata']
+            header = f"Title: {metadata['name']}\nAuthors: {metadata['authors']}"
+            year = _year(metadata.get('year'))
+            if year is not None:
+                header += f"\nYear: {year}"
+            paper = {'header': header, 'texts': [], 'shingles': []}
+            header_tokens = estimate_tokens(header)
+
+        shingles = _shingles(doc.page_content)
+        is_duplicate = any(
+            len(shingles & kept) / max(len(shingles | kept), 1) >= duplicate_threshold
+            for kept_paper in papers.values() for kept in kept_paper['shingles']
+        )
+        if is_duplicate:
+            continue
+        text = _strip_overlap(paper['texts'], doc.page_content.strip())
+        if not text:
+            continue
+
+        tokens = header_tokens + estimate_tokens(text)
+        if used_tokens + tokens > max_tokens:
+            # Smaller chunks further down the ranking may still fit
+            continue
+        used_tokens += tokens
+        paper['texts'].append(text)
+        paper['shingles'].append(shingles)
+        papers[key] = paper
+
+    return '\n\n'.join(
+        f"{paper['header']}\nContent:\n" + '\n...\n'.join(paper['texts'])
+        for paper in papers.values()
+    )
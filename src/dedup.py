@@ -0,0 +1,99 @@
+import hashlib
+import os
+import re
+import unicodedata
+from dotenv import load_dotenv
+load_dotenv()
+
+# What to do when an upload is another version of a paper that is already in the bucket:
+# "skip" the upload, "replace" the older version, or "keep" both.
+# Byte-identical files are always skipped.
+DEDUP_POLICIES = ("skip", "replace", "keep")
+DEDUP_POLICY = os.environ.get('DEDUP_POLICY', 'skip')
+
+ARXIV_ID = re.compile(r'(\d{4}\.\d{4,5})(?:v(\d+))?')
+
+
+def content_hashes(source, chunk_size=1 << 20):
+    """MD5 and SHA-256 of a file in one pass
+    The MD5 equals the ETag of a single-part S3 upload, the SHA-256 is stored with every object
+    because multipart ETags are not content hashes.
+    Args:
+        source (str | file-like): Path of the file or a binary buffer, which is rewound afterwards
+    Returns:
+        tuple[str, str]: Hex digests of MD5 and SHA-256
+    """
+    md5, sha = hashlib.md5(), hashlib.sha256()
+    if hasattr(source, 'read'):
+        start = source.tell()
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            md5.update(chunk)
+            sha.update(chunk)
+        source.seek(start)
+        return md5.hexdigest(), sha.hexdigest()
+    with open(source, 'rb') as f:
+        return content_hashes(f, chunk_size)
+
+
+def normalize_text(text):
+    """Lowercase ASCII words of a text, so that accents, case and punctuation do not matter"""
+    text = unicodedata.normalize('NFKD', str(text or '')).encode('ascii', 'ignore').decode()
+    return " ".join(re.findall(r'[a-z0-9]+', text.lower()))
+
+
+def author_tokens(authors):
+    """Name parts of an author list, independent of "First Last" or "Last, First" order"""
+    return {token for token in normalize_text(authors).split() if len(token) > 1 and token != "and"}
+
+
+def arxiv_version(object_name):
+    """arXiv ID and version of a file name like 1706.03762v7.pdf
+    Returns:
+        tuple[str, int] | None: ID and version (1 if not stated), None for other file names
+    """
+    match = ARXIV_ID.search(os.path.basename(object_name))
+    if not match:
+        return None
+    return match.group(1), int(match.group(2) or 1)
+
+
+def find_duplicate(object_name, metadata, hashes, catalog):
+    """Find an object in the catalog that is the same paper as an upload
+    Args:
+        object_name (str): S3 object name of the upload
+        metadata (dict): Metadata of the upload with 'title' and 'authors'
+        hashes (tuple[str, str]): MD5 and SHA-256 of the upload, see `content_hashes`
+        catalog (dict): Catalog entries keyed by object name
+    Returns:
+        tuple[str, str] | None: Object name of the duplicate and the reason, one of "identical",
+            "arxiv_version" and "title_authors"; None if the paper is new
+    """
+    md5, sha = hashes
+    arxiv = arxiv_version(object_name)
+    title = normalize_text(metadata.get('title'))
+    authors = author_tokens(metadata.get('authors'))
+    near_duplicate = None
+    for key, entry in catalog.items():
+        if entry.get('ETag', '').strip('"') == md5 or (sha and entry.get('sha256') == sha):
+            return key, "identical"
+        if near_duplicate is not None:
+            continue
+        other = arxiv_version(key)
+        if arxiv and other and arxiv[0] == other[0]:
+            near_duplicate = key, "arxiv_version"
+        elif title and normalize_text(entry.get('title')) == title:
+            other_authors = author_tokens(entry.get('authors'))
+            # Same title and at least one shared author name, or no authors to compare
+            if not authors or not other_authors or authors & other_authors:
+                near_duplicate = key, "title_authors"
+    return near_duplicate
+
+
+def is_newer(object_name, existing_name, reason):
+    """Whether an upload supersedes an existing object of the same paper
+    arXiv versions are compared by number; for other near-duplicates the upload is taken as
+    the newer version.
+    """
+    if reason == "arxiv_version":
+        return arxiv_version(object_name)[1] > arxiv_version(existing_name)[1]
+    return reason != "identical"
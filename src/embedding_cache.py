@@ -0,0 +1,201 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.embeddings import Embeddings
+try:
+    import fcntl
+except ImportError:  # Windows, where only the writers of one process are serialized
+    fcntl = None
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+KEY_BYTES = 32  # Size of a SHA-256 digest in the key file
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def embedding_model_id(embedding):
+    """Best-effort name of a LangChain embedding model, used to separate cached vectors"""
+    for attr in ('model_id', 'model', 'model_name'):
+        value = getattr(embedding, attr, None)
+        if isinstance(value, str):
+            return value
+    return type(embedding).__name__
+
+
+class EmbeddingCache:
+    """
+    A persistent cache of chunk embeddings for one embedding model.
+
+    Vectors are appended to a flat float32 file that is read back with `np.memmap`, and the
+    SHA-256 of every chunk text is appended to a key file at the position of its row. Both
+    files only grow, so adding a batch writes just the new rows. Rebuilding an index after a
+    paper was added or the chunking changed only embeds chunks whose text was never seen.
+    Writers in different processes are serialized with a lock file, and vectors that were
+    appended without their keys, e.g. by a writer that crashed, are cut off again.
+
+    Args:
+        model_id (str): ID of the embedding model; every model gets its own files
+        cache_dir (str, optional): Directory of the cache. Defaults to the EMBEDDING_CACHE_DIR
+            environment variable or ".cache/embeddings".
+    """
+    def __init__(self, model_id, cache_dir=os.environ.get('EMBEDDING_CACHE_DIR', '.cache/embeddings')):
+        self.model_id = model_id
+        self.dir = os.path.join(cache_dir, re.sub(r'[^A-Za-z0-9._-]', '_', model_id))
+        os.makedirs(self.dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.keys_path = os.path.join(self.dir, "keys.bin")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self.lock_path = os.path.join(self.dir, "lock")
+        self._lock = threading.Lock()
+        self._vectors = None
+        self.dim = None
+        self.rows = {}
+        self._indexed = 0  # Rows whose keys have been read from the key file
+        with self._lock, self._file_lock():
+            self._load_index()
+            self._truncate()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the lock file, so only one process at a time appends to the cache"""
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        """Read the keys that were appended since the last call, e.g. by another process"""
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)["dim"]
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._indexed * KEY_BYTES)
+            data = f.read()
+        # A partly written key at the end is ignored and cut off by the next writer
+        for i in range(len(data) // KEY_BYTES):
+            key = data[i * KEY_BYTES:(i + 1) * KEY_BYTES].hex()
+            self.rows.setdefault(key, self._indexed + i)
+        self._indexed += len(data) // KEY_BYTES
+
+    def _truncate(self):
+        """Cut off vectors without a key and partly written keys, so new rows start right after the indexed ones"""
+        if self.dim is None:
+            return
+        for path, size in (
+                (self.keys_path, self._indexed * KEY_BYTES),
+                (self.vectors_path, self._indexed * self.dim * 4)
+            ):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                logger.info(f"Dropping unindexed rows from {path}")
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+                self._vectors = None
+
+    def _matrix(self):
+        if self._vectors is None or len(self._vectors) < self._indexed:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r').reshape(-1, self.dim)
+        return self._vectors
+
+    def get(self, texts):
+        """Look up the cached vectors of several texts
+        Returns:
+            list[np.ndarray | None]: Vector per text, None for texts that are not cached
+        """
+        keys = [text_hash(text) for text in texts]
+        with self._lock:
+            if not self.rows:
+                return [None] * len(texts)
+            matrix = self._matrix()
+            return [np.array(matrix[self.rows[key]]) if key in self.rows else None for key in keys]
+
+    def add(self, texts, vectors):
+        """Append the vectors of new texts to the cache"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(texts) == 0:
+            return
+        with self._lock, self._file_lock():
+            # Another process may have added rows since this one last read the keys
+            self._load_index()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                tmp_path = f"{self.meta_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump({"model_id": self.model_id, "dim": self.dim}, f)
+                os.replace(tmp_path, self.meta_path)
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Expected vectors of dimension {self.dim}, got {vectors.shape[1]}")
+            self._truncate()
+            new = {}
+            for text, vector in zip(texts, vectors):
+                key = text_hash(text)
+                if key not in self.rows and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+            # The vectors are written before their keys, so every key always has its row
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack(list(new.values())).tobytes())
+            with open(self.keys_path, 'ab') as f:
+                f.write(b"".join(bytes.fromhex(key) for key in new))
+            for i, key in enumerate(new):
+                self.rows[key] = self._indexed + i
+            self._indexed += len(new)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain embeddings that only call the wrapped model for chunks not in the cache.
+
+    Args:
+        embedding (Embeddings): Embedding model to wrap
+        cache (EmbeddingCache, optional): Cache to use. Defaults to a cache for the model's ID.
+        batch_size (int): Number of uncached chunks embedded per request
+    """
+    def __init__(self, embedding, cache=None, batch_size=64):
+        self.embedding = embedding
+        self.cache = cache if cache is not None else EmbeddingCache(embedding_model_id(embedding))
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        vectors = self.cache.get(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            new_vectors = self.embedding.embed_documents([texts[i] for i in batch])
+            self.cache.add([texts[i] for i in batch], new_vectors)
+            for i, vector in zip(batch, new_vectors):
+                vectors[i] = np.asarray(vector, dtype=np.float32)
+        if missing:
+            logger.info(f"Embedded {len(missing)} new chunks, {len(texts) - len(missing)} from cache")
+        return [vector.tolist() for vector in vectors]
+
+    def embed_query(self, text):
+        return self.embedding.embed_query(text)
@@ -0,0 +1,293 @@
+"""Local stand-ins for S3, Bedrock, the chat model and the embedding model, used by the offline
+benchmarks and tests"""
+import asyncio
+import hashlib
+import io
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any
+from botocore.exceptions import ClientError
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+TOPICS = ["ML", "Biology"]
+WORDS = (
+    "neural network dropout attention transformer gradient protein cell gene sequence model "
+    "training layer embedding regularization bayesian inference expression receptor learning"
+).split()
+
+
+def _client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class FakeS3Client:
+    """
+    In-memory S3 client with a fixed latency per request.
+
+    Supports the calls used by aws_helpers, including conditional GETs and PUTs on ETags.
+
+    Args:
+        latency (float): Seconds every request takes
+    """
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.objects = {}  # (bucket, key) -> {'Body': bytes, 'Metadata': dict, ...}
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _request(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        time.sleep(self.latency)
+
+    def _store(self, bucket, key, body, metadata=None, content_type=None):
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self._lock:
+            self.objects[(bucket, key)] = {
+                'Body': body, 'Metadata': dict(metadata or {}), 'ContentType': content_type,
+                'ETag': etag, 'LastModified': datetime.now(timezone.utc),
+            }
+        return etag
+
+    def add_paper(self, bucket, key, metadata, size=1024):
+        """Put a paper into the store without latency, to set up a corpus"""
+        self._store(bucket, key, b'%PDF' + bytes(size), metadata, 'application/pdf')
+
+    def upload_file(self, file_path, bucket, key, ExtraArgs=None, **kwargs):
+        self._request('upload_file')
+        with open(file_path, 'rb') as f:
+            body = f.read()
+        extra_args = ExtraArgs or {}
+        self._store(bucket, key, body, extra_args.get('Metadata'), extra_args.get('ContentType'))
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None, Callback=None, **kwargs):
+        self._request('upload_fileobj')
+        extra_args = ExtraArgs or {}
+        body = fileobj.read()
+        self._store(bucket, key, body, extra_args.get('Metadata'), extra_args.get('ContentType'))
+        if Callback is not None:
+            Callback(len(body))
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, ContentType=None, Metadata=None, **kwargs):
+        self._request('put_object')
+        existing = self.objects.get((Bucket, Key))
+        if IfNoneMatch == '*' and existing is not None:
+            raise _client_error('PreconditionFailed', 'PutObject')
+        if IfMatch is not None and (existing is None or existing['ETag'] != IfMatch):
+            raise _client_error('PreconditionFailed', 'PutObject')
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        elif hasattr(Body, 'read'):
+            Body = Body.read()
+        return {'ETag': self._store(Bucket, Key, Body, Metadata, ContentType)}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self._request('get_object')
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _client_error('NoSuchKey', 'GetObject')
+        if IfNoneMatch is not None and IfNoneMatch == obj['ETag']:
+            raise _client_error('304', 'GetObject')
+        return {'Body': io.BytesIO(obj['Body']), 'ETag': obj['ETag'], 'Metadata': obj['Metadata']}
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self._request('head_object')
+        obj = self.objects.get((Bucket, Key))
+        if obj is None:
+            raise _client_error('404', 'HeadObject')
+        return {
+            'Metadata': obj['Metadata'], 'ContentType': obj['ContentType'], 'ETag': obj['ETag'],
+            'ContentLength': len(obj['Body']), 'LastModified': obj['LastModified'],
+        }
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self._request('delete_object')
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def head_bucket(self, Bucket, **kwargs):
+        self._request('head_bucket')
+
+    def get_paginator(self, operation):
+        return _FakeListPaginator(self)
+
+
+class _FakeListPaginator:
+    def __init__(self, s3, page_size=1000):
+        self.s3 = s3
+        self.page_size = page_size
+
+    def paginate(self, Bucket, Prefix=''):
+        keys = sorted(k for b, k in self.s3.objects if b == Bucket and k.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), self.page_size):
+            self.s3._request('list_objects_v2')
+            yield {'Contents': [
+                {
+                    'Key': key,
+                    'Size': len(self.s3.objects[(Bucket, key)]['Body']),
+                    'LastModified': self.s3.objects[(Bucket, key)]['LastModified'],
+                    'ETag': self.s3.objects[(Bucket, key)]['ETag'],
+                }
+                for key in keys[start:start + self.page_size]
+            ]}
+
+
+class FakeBedrockAgentClient:
+    """Ingestion jobs that complete after `job_seconds`"""
+    def __init__(self, job_seconds=1.0):
+        self.job_seconds = job_seconds
+        self.jobs = {}
+
+    def start_ingestion_job(self, knowledgeBaseId, dataSourceId, **kwargs):
+        job_id = f"job-{len(self.jobs) + 1}"
+        self.jobs[job_id] = time.monotonic()
+        return {'ingestionJob': {'ingestionJobId': job_id, 'status': 'STARTING'}}
+
+    def get_ingestion_job(self, knowledgeBaseId, dataSourceId, ingestionJobId, **kwargs):
+        elapsed = time.monotonic() - self.jobs[ingestionJobId]
+        status = 'COMPLETE' if elapsed >= self.job_seconds else 'IN_PROGRESS'
+        return {'ingestionJob': {'ingestionJobId': ingestionJobId, 'status': status}}
+
+
+class SyntheticCorpus:
+    """
+    Deterministic synthetic papers split into chunks, generated on access so that corpora
+    of many thousand papers need no memory.
+
+    Args:
+        num_papers (int): Number of papers
+        chunks_per_paper (int): Number of chunks per paper
+        chunk_words (int): Number of words per chunk
+    """
+    def __init__(self, num_papers, chunks_per_paper=20, chunk_words=80, seed=0):
+        self.num_papers = num_papers
+        self.chunks_per_paper = chunks_per_paper
+        self.chunk_words = chunk_words
+        self.seed = seed
+
+    def __len__(self):
+        return self.num_papers * self.chunks_per_paper
+
+    def paper_metadata(self, paper):
+        rng = random.Random(f"{self.seed}-{paper}")
+        return {
+            'name': f"Paper {paper}: " + " ".join(rng.choices(WORDS, k=5)),
+            'authors': f"Author{paper}, A. and Coauthor{paper}, B.",
+            'year': rng.randint(1990, 2024),
+            'type': rng.choice(TOPICS),
+            'x-amz-bedrock-kb-source-uri': f"s3://bucket/paper{paper}.pdf",
+        }
+
+    def __getitem__(self, i):
+        """Text and paper metadata of the i-th chunk"""
+        rng = random.Random(f"{self.seed}-chunk-{i}")
+        text = " ".join(rng.choices(WORDS, k=self.chunk_words))
+        return text, self.paper_metadata(i // self.chunks_per_paper)
+
+
+class FakeKnowledgeBaseClient:
+    """
+    bedrock-agent-runtime stand-in whose `retrieve` returns chunks of a synthetic corpus.
+
+    Args:
+        corpus (SyntheticCorpus): Chunks to retrieve from
+        latency (float): Seconds every retrieve call takes
+    """
+    def __init__(self, corpus, latency=0.1):
+        self.corpus = corpus
+        self.latency = latency
+        self.calls = 0
+
+    def retrieve(self, retrievalQuery, knowledgeBaseId, retrievalConfiguration, **kwargs):
+        self.calls += 1
+        time.sleep(self.latency)
+        config = retrievalConfiguration['vectorSearchConfiguration']
+        # Spread queries over the corpus deterministically
+        start = int(hashlib.md5(retrievalQuery['text'].encode()).hexdigest(), 16) % len(self.corpus)
+        results = []
+        for i in range(len(self.corpus)):
+            text, metadata = self.corpus[(start + i) % len(self.corpus)]
+            results.append({
+                'content': {'text': text},
+                'metadata': dict(metadata),
+                'location': {'type': 'S3', 's3Location': {'uri': metadata['x-amz-bedrock-kb-source-uri']}},
+                'score': 1.0 - i / len(self.corpus),
+            })
+            if len(results) >= config['numberOfResults']:
+                break
+        return {'retrievalResults': results}
+
+
+class FakeEmbeddings(Embeddings):
+    """
+    Deterministic bag-of-words embeddings, so texts that share words are similar.
+
+    Args:
+        dim (int): Dimension of the vectors
+    """
+    def __init__(self, dim=32):
+        self.dim = dim
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.dim] += 1.0
+        return vector
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model that answers with a canned text at a configurable speed.
+
+    Attributes:
+        response (str): Text of every answer, split into tokens at whitespace
+        time_to_first_token (float): Seconds before the first token
+        tokens_per_second (float): Generation speed after the first token
+    """
+    response: str = " ".join(WORDS * 10)
+    time_to_first_token: float = 0.3
+    tokens_per_second: float = 200.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _tokens(self):
+        words = self.response.split(" ")
+        return [words[0]] + [" " + word for word in words[1:]]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens()
+        time.sleep(self.time_to_first_token + len(tokens) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        time.sleep(self.time_to_first_token)
+        for token in self._tokens():
+            time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens()
+        await asyncio.sleep(self.time_to_first_token + len(tokens) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs: Any):
+        await asyncio.sleep(self.time_to_first_token)
+        for token in self._tokens():
+            await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
@@ -0,0 +1,292 @@
+import argparse
+import json
+import logging
+import math
+import os
+import re
+from collections import Counter
+import numpy as np
+from langchain_core.documents import Document
+from local_retriever import CHUNKS_FILE, load_sidecar_metadata, parse_year, split_pdf
+from metrics import span
+from pdf_engine import PdfEngine
+from rag_retriever import RagRetriever, UNSET, retrieval_cache
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+LEXICAL_FILE = "lexical.json"
+STOPWORDS = frozenset(
+    "a an and are as at be by did do does for from how in is it of on or that the this to was "
+    "what when where which who why with".split()
+)
+
+
+def tokenize(text):
+    return [token for token in re.findall(r'\w+', text.lower()) if token not in STOPWORDS]
+
+
+# Chunks of one paper whose word shingles overlap by this share are the same passage
+OVERLAP_THRESHOLD = float(os.environ.get('FUSION_OVERLAP_THRESHOLD', 0.5))
+SHINGLE_SIZE = 8
+
+
+def chunk_source(doc):
+    """File name of the paper a chunk belongs to, the same for knowledge base and local chunks"""
+    uri = doc.metadata.get('source_metadata', {}).get('x-amz-bedrock-kb-source-uri', '')
+    return os.path.basename(uri)
+
+
+def shingles(text, size=SHINGLE_SIZE):
+    """Set of overlapping word n-grams of a text, independent of whitespace and case"""
+    words = re.findall(r'\w+', text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def chunks_overlap(a, b, threshold=OVERLAP_THRESHOLD):
+    """Whether two chunks, given as shingle sets, cover largely the same text
+    The overlap is measured relative to the smaller chunk, so a short local chunk inside a
+    longer knowledge base chunk counts as the same passage.
+    """
+    if not a or not b:
+        return False
+    return len(a & b) / min(len(a), len(b)) >= threshold
+
+
+def reciprocal_rank_fusion(rankings, k=60, weights=None, overlap_threshold=OVERLAP_THRESHOLD):
+    """Fuse ranked document lists with reciprocal rank fusion
+    Every document scores sum(weight / (k + rank)) over the lists it appears in, so chunks
+    found by several retrievers move up without comparing their incompatible raw scores.
+    The knowledge base and the local index chunk papers differently, so chunks are matched
+    by paper and text overlap rather than by identical text; the first matching document
+    represents the passage.
+    Args:
+        rankings (list[list[Document]]): Ranked documents of every retriever, best first
+        k (int): Rank offset that damps the influence of the top ranks
+        weights (list[float], optional): Weight of every ranking. Defaults to 1 each.
+        overlap_threshold (float): Share of shingles of the smaller chunk two chunks of the
+            same paper must have in common to be fused
+    Returns:
+        list[Document]: Fused documents, best first, with the fused score as `score`
+    """
+    if weights is None:
+        weights = [1.0] * len(rankings)
+    scores = []
+    docs = []
+    passages = {}  # paper -> list of (passage number, shingles)
+    for ranking, weight in zip(rankings, weights):
+        scored = set()
+        for rank, doc in enumerate(ranking, start=1):
+            doc_shingles = shingles(doc.page_content)
+            candidates = passages.setdefault(chunk_source(doc), [])
+            passage = next(
+                (i for i, other in candidates if chunks_overlap(doc_shingles, other, overlap_threshold)), None
+            )
+            if passage is None:
+                passage = len(docs)
+                candidates.append((passage, doc_shingles))
+                docs.append(doc)
+                scores.append(0.0)
+            # A passage counts once per ranking, at its best rank
+            if passage not in scored:
+                scored.add(passage)
+                scores[passage] += weight / (k + rank)
+    fused = []
+    for passage in sorted(range(len(docs)), key=scores.__getitem__, reverse=True):
+        doc = docs[passage]
+        fused.append(Document(page_content=doc.page_content, metadata={**doc.metadata, "score": scores[passage]}))
+    return fused
+
+
+class BM25Index:
+    """
+    An in-memory BM25 index of paper chunks with the same year and topic filters as the
+    knowledge base.
+
+    Every chunk is indexed together with the title and authors of its paper, so queries
+    naming an author or the exact words of a title find the paper's chunks even when the
+    chunk text itself does not contain them.
+
+    Args:
+        chunks (list[dict]): Chunks with 'text', 'page' and 'source_metadata', as in the
+            `chunks.json` of a LocalVectorIndex
+        k1 (float): BM25 term frequency saturation
+        b (float): BM25 document length normalization
+    """
+    def __init__(self, chunks, k1=1.5, b=0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        # Papers without a year are NaN and never match a year range, as in LocalVectorIndex
+        self.years = np.array([parse_year(c["source_metadata"].get("year")) for c in chunks], dtype=np.float64)
+        self.topics = np.array([c["source_metadata"].get("type") for c in chunks], dtype=object)
+
+        # term -> (rows, term frequencies), built from per-chunk counts
+        postings = {}
+        lengths = np.zeros(len(chunks), dtype=np.float32)
+        for row, chunk in enumerate(chunks):
+            metadata = chunk["source_metadata"]
+            tokens = tokenize(f"{metadata.get('name', '')} {metadata.get('authors', '')} {chunk['text']}")
+            lengths[row] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, ([], []))
+                postings[term][0].append(row)
+                postings[term][1].append(tf)
+        self.postings = {
+            term: (np.array(rows, dtype=np.int32), np.array(tfs, dtype=np.float32))
+            for term, (rows, tfs) in postings.items()
+        }
+        average_length = max(float(lengths.mean()), 1.0) if len(chunks) else 1.0
+        self.length_norm = self.k1 * (1 - self.b + self.b * lengths / average_length)
+
+    @staticmethod
+    def load(index_dir):
+        """Load the chunks written by `build` or by LocalVectorIndex.build"""
+        for file_name in (LEXICAL_FILE, CHUNKS_FILE):
+            path = os.path.join(index_dir, file_name)
+            if os.path.exists(path):
+                with open(path) as f:
+                    return BM25Index(json.load(f)["chunks"])
+        raise FileNotFoundError(f"No {LEXICAL_FILE} or {CHUNKS_FILE} in {index_dir}")
+
+    @staticmethod
+    def build(index_dir, papers, chunk_size=500, chunk_overlap=100):
+        """Chunk PDFs like the knowledge base and write the chunks to `index_dir`
+        Args:
+            index_dir (str): Directory to write the chunks to
+            papers (list[tuple[str, dict]]): Path of every PDF with its `.metadata.json` attributes
+            chunk_size (int): Characters per chunk
+            chunk_overlap (int): Overlapping characters between chunks
+        Returns:
+            BM25Index: The built index
+        """
+        chunks = []
+        with PdfEngine() as engine:
+            for pdf_path, metadata in papers:
+                uri = os.path.basename(pdf_path)
+                for page, text in split_pdf(pdf_path, chunk_size, chunk_overlap, engine=engine):
+                    chunks.append({
+                        "text": text,
+                        "page": page,
+                        "source_metadata": {
+                            **metadata,
+                            "year": parse_year(metadata.get("year")),
+                            "x-amz-bedrock-kb-source-uri": uri,
+                        },
+                    })
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, LEXICAL_FILE), "w") as f:
+            json.dump({"chunks": chunks}, f)
+        logger.info(f"Indexed {len(chunks)} chunks of {len(papers)} papers")
+        return BM25Index(chunks)
+
+    def search(self, query, k, start_year=1800, end_year=2100, topic=None):
+        """Find the k chunks with the highest BM25 score among the filtered papers
+        Returns:
+            list[tuple[int, float]]: Row and BM25 score of every hit with a score above 0, best first
+        """
+        if k <= 0 or not self.chunks:
+            return []
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            rows, tfs = posting
+            idf = math.log(1 + (len(self.chunks) - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tfs * (self.k1 + 1) / (tfs + self.length_norm[rows])
+        mask = (self.years > start_year) & (self.years < end_year) & (scores > 0)
+        if topic is not None:
+            mask &= self.topics == topic
+        rows = np.flatnonzero(mask)
+        if len(rows) == 0:
+            return []
+        k = min(k, len(rows))
+        top = rows[np.argpartition(-scores[rows], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(row), float(scores[row])) for row in top]
+
+    def document(self, row, score):
+        """Build a document shaped like the results of AmazonKnowledgeBasesRetriever"""
+        chunk = self.chunks[row]
+        return Document(
+            page_content=chunk["text"],
+            metadata={
+                "source_metadata": dict(chunk["source_metadata"]),
+                "location": {"type": "LOCAL", "page": chunk.get("page", 0)},
+                "score": score,
+            }
+        )
+
+
+class HybridRagRetriever(RagRetriever):
+    """
+    Retriever that fuses the results of a vector retriever with a local BM25 index using
+    reciprocal rank fusion. Filters, caching and the document shape are the same as for
+    RagRetriever, so it is a drop-in replacement, e.g.
+    `RagBot(kb_id, retriever=HybridRagRetriever(RagRetriever(kb_id), "index/"))`.
+
+    Args:
+        vector_retriever (RagRetriever): Knowledge base or local vector retriever
+        index_dir (str): Directory with the chunks of the BM25 index
+        fetch_factor (int): Both retrievers fetch `fetch_factor * num_results` candidates
+            before fusion
+        rrf_k (int): Rank offset of reciprocal rank fusion
+        lexical_weight (float): Weight of the BM25 ranking relative to the vector ranking
+    """
+    def __init__(
+            self, vector_retriever, index_dir, num_results=None, start_year=None, end_year=None,
+            topic=UNSET, cache=retrieval_cache, fetch_factor=2, rrf_k=60,
+            lexical_weight=float(os.environ.get('LEXICAL_WEIGHT', 1.0))
+        ):
+        self.cache = cache
+        self.vector_retriever = vector_retriever
+        # Used in the cache key, so hybrid and plain results never mix
+        self.knowledge_base_id = f"hybrid:{vector_retriever.knowledge_base_id}:{os.path.abspath(index_dir)}"
+        self.num_results, self.start_year, self.end_year, self.topic = \
+            vector_retriever.resolve_filters(num_results, start_year, end_year, topic)
+        self.fetch_factor = fetch_factor
+        self.rrf_k = rrf_k
+        self.lexical_weight = lexical_weight
+        self.retriever = BM25Index.load(index_dir)
+
+    def retrieve(self, query, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        num_results, start_year, end_year, topic = self.resolve_filters(num_results, start_year, end_year, topic)
+        candidates = num_results * self.fetch_factor
+        vector_docs = self.vector_retriever.retrieve(query, candidates, start_year, end_year, topic)
+        with span("retrieval", backend="bm25"):
+            hits = self.retriever.search(query, candidates, start_year, end_year, topic)
+        lexical_docs = [self.retriever.document(row, score) for row, score in hits]
+        with span("fusion"):
+            fused = reciprocal_rank_fusion(
+                [vector_docs, lexical_docs], k=self.rrf_k, weights=[1.0, self.lexical_weight]
+            )
+        return fused[:num_results]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local BM25 index from a directory of PDFs")
+    parser.add_argument("pdf_dir", help="Directory containing the PDFs and their .metadata.json sidecars")
+    parser.add_argument("index_dir", help="Directory to write the index to")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    args = parser.parse_args()
+
+    papers = []
+    for file_name in sorted(os.listdir(args.pdf_dir)):
+        if not file_name.lower().endswith('.pdf'):
+            continue
+        pdf_path = os.path.join(args.pdf_dir, file_name)
+        metadata = load_sidecar_metadata(pdf_path)
+        if metadata is None:
+            logger.info(f"Skipping {file_name}, it has no .metadata.json sidecar")
+            continue
+        papers.append((pdf_path, metadata))
+    BM25Index.build(args.index_dir, papers, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
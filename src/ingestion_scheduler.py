@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+from aws_helpers import (
+    start_ingestion_job, get_ingestion_job_status, notify_ingestion_listeners, INGESTION_DONE_STATES
+)
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class IngestionScheduler:
+    """
+    Coalesces re-sync requests into as few ingestion jobs as possible.
+
+    `request_sync` only marks the knowledge base as out of date. After `debounce_seconds`
+    without further requests, one ingestion job is started for all of them. While a job
+    is running, new requests are collected into at most one follow-up job, which starts as
+    soon as the running job is done. Running jobs are polled with exponential backoff; a job
+    whose status cannot be read `max_poll_failures` times in a row is given up on, so later
+    requests are not blocked by it.
+
+    Args:
+        knowledge_base_id (str): ID of the knowledge base to re-sync
+        data_source_id (str): ID of the data source to re-sync
+        debounce_seconds (float): Quiet period after the last request before a job starts
+        initial_poll_delay (float): Seconds before a running job is polled the first time
+        max_poll_delay (float): Maximum seconds between two polls
+        max_poll_failures (int): Consecutive failed polls after which a job is given up on
+    """
+    def __init__(
+            self, knowledge_base_id=os.environ.get('KNOWLEDGE_BASE_ID'),
+            data_source_id=os.environ.get('DATA_SOURCE_ID'),
+            debounce_seconds=float(os.environ.get('INGESTION_DEBOUNCE_SECONDS', 10)),
+            initial_poll_delay=2, max_poll_delay=60, max_poll_failures=10
+        ):
+        self.knowledge_base_id = knowledge_base_id
+        self.data_source_id = data_source_id
+        self.debounce_seconds = debounce_seconds
+        self.initial_poll_delay = initial_poll_delay
+        self.max_poll_delay = max_poll_delay
+        self.max_poll_failures = max_poll_failures
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = 0  # Requests not covered by a started job
+        self._last_request = None
+        self._job_id = None
+        self._job_status = None
+        self._last_error = None
+        self._thread = None
+
+    def request_sync(self):
+        """Ask for a re-sync; returns immediately"""
+        with self._lock:
+            self._pending += 1
+            self._last_request = time.monotonic()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ingestion-scheduler", daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def status(self):
+        """Current state of the scheduler, for display in the UI
+        Returns:
+            dict: 'job_id' and 'job_status' of the last job, number of 'pending' uploads not
+                covered by a job yet, and the 'last_error'
+        """
+        with self._lock:
+            return {
+                "job_id": self._job_id,
+                "job_status": self._job_status,
+                "pending": self._pending,
+                "last_error": self._last_error,
+            }
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._pending == 0:
+                    # Nothing to do, the next request starts a new thread
+                    self._thread = None
+                    return
+                # Debounce: wait until no request arrived for debounce_seconds
+                while True:
+                    quiet = time.monotonic() - self._last_request
+                    if quiet >= self.debounce_seconds:
+                        break
+                    self._wakeup.wait(self.debounce_seconds - quiet)
+                covered = self._pending
+
+            try:
+                job_id = start_ingestion_job(self.knowledge_base_id, self.data_source_id)
+            except Exception as e:
+                # E.g. a job started elsewhere is still running; try again after a while
+                logger.info(f"Could not start ingestion job: {e}")
+                with self._lock:
+                    self._last_error = str(e)
+                time.sleep(self.max_poll_delay)
+                continue
+
+            with self._lock:
+                self._pending -= covered
+                self._job_id = job_id
+                self._job_status = "STARTING"
+                self._last_error = None
+            self._poll(job_id)
+
+    def _poll(self, job_id):
+        delay = self.initial_poll_delay
+        failures = 0
+        while True:
+            time.sleep(delay)
+            try:
+                job_status = get_ingestion_job_status(job_id, self.knowledge_base_id, self.data_source_id)
+                failures = 0
+            except Exception as e:
+                logger.info(f"Could not get status of ingestion job {job_id}: {e}")
+                job_status = None
+                failures += 1
+                if failures >= self.max_poll_failures:
+                    # E.g. revoked permissions or a deleted job; pending syncs start a new job
+                    logger.info(f"Giving up on ingestion job {job_id} after {failures} failed polls")
+                    with self._lock:
+                        self._job_id = None
+                        self._job_status = None
+                        self._last_error = str(e)
+                    return
+            with self._lock:
+                if job_status is not None:
+                    self._job_status = job_status
+            if job_status in INGESTION_DONE_STATES:
+                logger.info(f"Ingestion job {job_id} finished with status {job_status}")
+                if job_status == "COMPLETE":
+                    # Answers cached while the job ran do not know the new papers yet
+                    notify_ingestion_listeners(job_id)
+                return
+            delay = min(delay * 2, self.max_poll_delay)
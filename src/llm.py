@@ -1,10 +1,20 @@
-import boto3
+import asyncio
+import time
+from aws_clients import get_client
+from metrics import span, observe, record_tokens, token_usage
 from langchain_aws import ChatBedrock # ,ChatBedrockConverse
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+# Rough number of characters per token, good enough to budget the conversation history
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
 
 class LlmBot:
     """
@@ -14,7 +24,7 @@ class LlmBot:
     history, and adjusting various parameters of the model.
 
     Attributes:
-        bedrock_runtime (boto3.client): The Bedrock runtime client.
+        bedrock_runtime (boto3.client): The shared Bedrock runtime client.
         model_id (str): The ID of the model to use.
         system_prompt (str): The system prompt that sets the context for the AI.
         messages (list): The conversation history.
@@ -25,9 +35,18 @@ class LlmBot:
         model_id (str, optional): The ID of the model to use. Defaults to "anthropic.claude-3-haiku-20240307-v1:0".
             Another working model that can be selected is "anthropic.claude-3-sonnet-20240229-v1:0".
         system_prompt (str, optional): The initial system prompt. Defaults to "You are a helpful AI assistant.".
+        max_history_tokens (int, optional): Token budget of the conversation history. The oldest turns
+            are dropped once the budget is exceeded. Defaults to None, which keeps the whole history.
+        summarize_history (bool, optional): Whether dropped turns are summarized into the system
+            message instead of being forgotten. Defaults to False.
+        system_prefix (str, optional): Static instructions placed before the system prompt. They
+            are not affected by change_system_prompt. Defaults to None.
 
     Methods:
-        chat(msg): Send a message and get a response, maintaining conversation history.
+        chat(msg, history_msg): Send a message and get a response, maintaining conversation history.
+            If history_msg is given, it is stored in the history instead of msg.
+        stream_chat(msg, history_msg): Like chat, but yield the response tokens as they arrive.
+        achat(msg, history_msg), astream_chat(msg, history_msg): Async versions of chat and stream_chat.
         invoke(msg): Send a one-off message without affecting the conversation history.
         change_system_prompt(prompt): Change the system prompt and reset the conversation.
         get_chat_history(): Get the current chat history.
@@ -40,12 +59,17 @@ class LlmBot:
     """
     def __init__(
             self, model_id=os.environ.get('MODEL_ID'),
-            system_prompt="You are a helpful AI assistant."
+            system_prompt="You are a helpful AI assistant.", max_history_tokens=None,
+            summarize_history=False, system_prefix=None
         ):
-        self.bedrock_runtime = boto3.client(service_name="bedrock-runtime")
+        self.bedrock_runtime = get_client("bedrock-runtime")
         self.model_id = model_id
         self.system_prompt = system_prompt
-        self.messages = [SystemMessage(content=self.system_prompt)]
+        self.system_prefix = system_prefix
+        self.max_history_tokens = max_history_tokens
+        self.summarize_history = summarize_history
+        self.history_summary = None
+        self.messages = [self._system_message()]
         self.model_kwargs = {
             "max_tokens": 2048,
             "temperature": 0.0,
@@ -62,28 +86,139 @@ class LlmBot:
             model_kwargs=self.model_kwargs,
         )
 
-    def chat(self, msg):
+    @property
+    def full_system_prompt(self):
+        if self.system_prefix:
+            return f"{self.system_prefix}\n\nSystem prompt: {self.system_prompt}"
+        return self.system_prompt
+
+    def _system_message(self):
+        if self.history_summary:
+            return SystemMessage(
+                content=f"{self.full_system_prompt}\n\nSummary of the earlier conversation: {self.history_summary}"
+            )
+        return SystemMessage(content=self.full_system_prompt)
+
+    def _invoke_model(self, messages, call):
+        with span("llm", call=call, model=self.model_id):
+            response = self.model.invoke(messages)
+        record_tokens("llm", *token_usage(response), call=call, model=self.model_id)
+        return response
+
+    async def _ainvoke_model(self, messages, call):
+        with span("llm", call=call, model=self.model_id):
+            response = await self.model.ainvoke(messages)
+        record_tokens("llm", *token_usage(response), call=call, model=self.model_id)
+        return response
+
+    def _record_stream(self, call, start, first_token, usage):
+        observe("llm_first_token", (first_token or time.perf_counter()) - start, call=call, model=self.model_id)
+        observe("llm", time.perf_counter() - start, call=call, model=self.model_id)
+        record_tokens("llm", *usage, call=call, model=self.model_id)
+
+    def chat(self, msg, history_msg=None):
+        response = self._invoke_model(self.messages + [HumanMessage(content=msg)], "chat")
+        self._add_turn(msg if history_msg is None else history_msg, response.content)
+        return response.content
+
+    def stream_chat(self, msg, history_msg=None):
+        content, failed = [], False
+        start, first_token, usage = time.perf_counter(), None, [0, 0]
+        try:
+            for chunk in self.model.stream(self.messages + [HumanMessage(content=msg)]):
+                first_token = first_token or time.perf_counter()
+                usage = [a + b for a, b in zip(usage, token_usage(chunk))]
+                content.append(chunk.content)
+                yield chunk.content
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record_stream("stream_chat", start, first_token, usage)
+            # Keep the answer if the consumer stops early, but leave the history untouched if the model failed
+            if not failed and "".join(content):
+                self._add_turn(msg if history_msg is None else history_msg, "".join(content))
+
+    async def achat(self, msg, history_msg=None):
+        response = await self._ainvoke_model(self.messages + [HumanMessage(content=msg)], "achat")
+        # Trimming may summarize the history with another model call, so keep it off the event loop
+        await asyncio.to_thread(self._add_turn, msg if history_msg is None else history_msg, response.content)
+        return response.content
+
+    async def astream_chat(self, msg, history_msg=None):
+        content, failed = [], False
+        start, first_token, usage = time.perf_counter(), None, [0, 0]
+        try:
+            async for chunk in self.model.astream(self.messages + [HumanMessage(content=msg)]):
+                first_token = first_token or time.perf_counter()
+                usage = [a + b for a, b in zip(usage, token_usage(chunk))]
+                content.append(chunk.content)
+                yield chunk.content
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._record_stream("astream_chat", start, first_token, usage)
+            if not failed and "".join(content):
+                await asyncio.to_thread(
+                    self._add_turn, msg if history_msg is None else history_msg, "".join(content)
+                )
+
+    def _add_turn(self, msg, response):
         self.messages.append(HumanMessage(content=msg))
-        response = self.model.invoke(self.messages)
-        self.messages.append(AIMessage(content=response.content))
+        self.messages.append(AIMessage(content=response))
+        self._trim_history()
+
+    def _trim_history(self):
+        """Drop the oldest turns until the history fits into max_history_tokens"""
+        if self.max_history_tokens is None:
+            return
+        turns = self.messages[1:]
+        tokens = sum(estimate_tokens(m.content) for m in turns)
+        dropped = []
+        # Always keep the latest turn, even if it alone exceeds the budget
+        while len(turns) > 2 and tokens > self.max_history_tokens:
+            tokens -= estimate_tokens(turns[0].content) + estimate_tokens(turns[1].content)
+            dropped.extend(turns[:2])
+            turns = turns[2:]
+        if not dropped:
+            return
+        if self.summarize_history:
+            self.history_summary = self._summarize(dropped)
+        self.messages = [self._system_message()] + turns
+
+    def _summarize(self, messages):
+        conversation = "\n".join(
+            f"{'User' if isinstance(m, HumanMessage) else 'Assistant'}: {m.content}" for m in messages
+        )
+        previous = f"Summary so far: {self.history_summary}\n" if self.history_summary else ""
+        prompt = "Summarize the following conversation in a few sentences. Keep names, papers and " \
+            "facts the user may refer to later.\n" + previous + conversation
+        response = self._invoke_model([HumanMessage(content=prompt)], "summarize")
         return response.content
 
     def invoke(self, msg):
-        messages = [SystemMessage(content=self.system_prompt), HumanMessage(content=msg)]
-        response = self.model.invoke(messages)
+        messages = [SystemMessage(content=self.full_system_prompt), HumanMessage(content=msg)]
+        response = self._invoke_model(messages, "invoke")
+        return response.content
+
+    async def ainvoke(self, msg):
+        messages = [SystemMessage(content=self.full_system_prompt), HumanMessage(content=msg)]
+        response = await self._ainvoke_model(messages, "ainvoke")
         return response.content
 
     def change_system_prompt(self, prompt):
         self.system_prompt = prompt
-        self.messages[0] = SystemMessage(content=self.system_prompt)
-        self.model_kwargs["system"] = prompt
+        self.messages[0] = self._system_message()
+        self.model_kwargs["system"] = self.full_system_prompt
         self._create_model()
 
     def get_chat_history(self):
         return self.messages[1:]  # Exclude the system message
 
     def clear_chat_history(self):
-        self.messages = [SystemMessage(content=self.system_prompt)]
+        self.history_summary = None
+        self.messages = [self._system_message()]
 
     def set_temperature(self, temperature):
         if 0 <= temperature <= 1:
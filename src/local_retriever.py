@@ -0,0 +1,251 @@
+import argparse
+import json
+import logging
+import os
+import numpy as np
+from langchain_core.documents import Document
+from embedding_cache import CachedEmbeddings
+from metrics import span
+from pdf_engine import PdfEngine, get_pdf_engine
+from rag_retriever import RagRetriever, UNSET, retrieval_cache
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+VECTORS_FILE = "vectors.npy"
+CHUNKS_FILE = "chunks.json"
+
+
+def default_embedding():
+    """Bedrock embedding model on the shared runtime client"""
+    from langchain_aws import BedrockEmbeddings
+    from aws_clients import get_client
+    return BedrockEmbeddings(
+        client=get_client('bedrock-runtime'),
+        model_id=os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v2:0')
+    )
+
+
+def parse_year(value):
+    """Publication year as an int, None if it is missing or not a number, e.g. "n.d." """
+    try:
+        return int(float(value))
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def load_sidecar_metadata(pdf_path):
+    """Read the `.metadata.json` sidecar written next to a PDF, as uploaded to S3
+    Args:
+        pdf_path (str): Path of the PDF
+    Returns:
+        dict: Metadata attributes with keys 'name', 'year', 'type' and 'authors', or None
+    """
+    sidecar_path = f"{pdf_path}.metadata.json"
+    if not os.path.exists(sidecar_path):
+        return None
+    with open(sidecar_path) as f:
+        return json.load(f)["metadataAttributes"]
+
+
+def split_pdf(pdf_path, chunk_size=500, chunk_overlap=100, engine=None):
+    """Split a PDF into text chunks like the notebook pipeline
+    Args:
+        pdf_path (str): Path of the PDF
+        chunk_size (int): Characters per chunk
+        chunk_overlap (int): Overlapping characters between chunks
+        engine (PdfEngine, optional): Engine that parses the pages. Defaults to the thread-based
+            engine for interactive use; index builds pass one with worker processes.
+    Returns:
+        list[tuple[int, str]]: Page number and text of every chunk
+    """
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    if engine is None:
+        engine = get_pdf_engine()
+    # Blocks of pages are parsed on the engine's workers and come back in page order
+    pages = [
+        Document(page_content=text, metadata={'page': page})
+        for page, text in engine.iter_pages(pdf_path)
+    ]
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return [(split.metadata.get('page', 0), split.page_content) for split in splitter.split_documents(pages)]
+
+
+class LocalVectorIndex:
+    """
+    An on-disk vector index of paper chunks with a metadata index for year and topic.
+
+    The index directory holds the L2-normalized chunk embeddings as a `.npy` array, which is
+    memory-mapped on load, and a JSON file with the chunk texts and their paper metadata.
+    Year and topic are kept as arrays next to the vectors, so filters select the candidate
+    rows before any similarity is computed.
+
+    Args:
+        index_dir (str): Directory of the index
+        embedding (Embeddings, optional): LangChain embedding model for queries. Defaults to
+            the Bedrock embedding model.
+    """
+    def __init__(self, index_dir, embedding=None):
+        self.index_dir = index_dir
+        self.embedding = embedding if embedding is not None else default_embedding()
+        self.vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode='r')
+        with open(os.path.join(index_dir, CHUNKS_FILE)) as f:
+            self.chunks = json.load(f)["chunks"]
+        # Papers without a year are NaN and never match a year range, like a missing attribute on Bedrock
+        self.years = np.array(
+            [parse_year(c["source_metadata"].get("year")) for c in self.chunks], dtype=np.float64
+        )
+        self.topics = np.array([c["source_metadata"]["type"] for c in self.chunks], dtype=object)
+
+    @staticmethod
+    def build(
+            index_dir, papers, embedding=None, chunk_size=500, chunk_overlap=100, batch_size=64,
+            use_cache=True
+        ):
+        """Build an index from PDFs and their metadata
+        Args:
+            index_dir (str): Directory to write the index to
+            papers (list[tuple[str, dict]]): Path of every PDF with its metadata attributes
+                'name', 'authors', 'year' and 'type', as in the `.metadata.json` sidecars
+            embedding (Embeddings, optional): LangChain embedding model
+            chunk_size (int): Characters per chunk
+            chunk_overlap (int): Overlapping characters between chunks
+            batch_size (int): Number of chunks embedded per request
+            use_cache (bool): Whether to reuse cached embeddings and only embed new chunks
+        Returns:
+            LocalVectorIndex: The built index
+        """
+        if embedding is None:
+            embedding = default_embedding()
+        chunks = []
+        # Parsing is CPU-bound, so a build uses worker processes like bulk_ingest
+        with PdfEngine() as engine:
+            for pdf_path, metadata in papers:
+                uri = os.path.basename(pdf_path)
+                for page, text in split_pdf(pdf_path, chunk_size, chunk_overlap, engine=engine):
+                    chunks.append({
+                        "text": text,
+                        "page": page,
+                        "source_metadata": {
+                            **metadata,
+                            "year": parse_year(metadata.get("year")),
+                            "x-amz-bedrock-kb-source-uri": uri,
+                        },
+                    })
+        logger.info(f"Embedding {len(chunks)} chunks of {len(papers)} papers")
+
+        if use_cache:
+            document_embedding = CachedEmbeddings(embedding, batch_size=batch_size)
+            vectors = document_embedding.embed_documents([c["text"] for c in chunks])
+        else:
+            vectors = []
+            for start in range(0, len(chunks), batch_size):
+                texts = [c["text"] for c in chunks[start:start + batch_size]]
+                vectors.extend(embedding.embed_documents(texts))
+        if chunks:
+            vectors = np.asarray(vectors, dtype=np.float32).reshape(len(chunks), -1)
+        else:
+            # Nothing to embed, e.g. no papers yet; the index is valid and finds nothing
+            vectors = np.zeros((0, 0), dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, VECTORS_FILE), vectors)
+        with open(os.path.join(index_dir, CHUNKS_FILE), "w") as f:
+            json.dump({"chunks": chunks}, f)
+        return LocalVectorIndex(index_dir, embedding=embedding)
+
+    def candidates(self, start_year, end_year, topic=None):
+        """Rows of the papers published after start_year and before end_year with the topic"""
+        mask = (self.years > start_year) & (self.years < end_year)
+        if topic is not None:
+            mask &= self.topics == topic
+        return np.flatnonzero(mask)
+
+    def search(self, query, k, start_year=1800, end_year=2100, topic=None):
+        """Find the k chunks most similar to the query among the filtered papers
+        Returns:
+            list[tuple[int, float]]: Row and cosine similarity of every hit, best first
+        """
+        rows = self.candidates(start_year, end_year, topic)
+        if len(rows) == 0 or k <= 0:
+            return []
+        query_vector = np.asarray(self.embedding.embed_query(query), dtype=np.float32)
+        query_vector /= max(np.linalg.norm(query_vector), 1e-12)
+        scores = self.vectors[rows] @ query_vector
+        k = min(k, len(rows))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def document(self, row, score):
+        """Build a document shaped like the results of AmazonKnowledgeBasesRetriever"""
+        chunk = self.chunks[row]
+        return Document(
+            page_content=chunk["text"],
+            metadata={
+                "source_metadata": dict(chunk["source_metadata"]),
+                "location": {"type": "LOCAL", "page": chunk["page"]},
+                "score": score,
+            }
+        )
+
+
+class LocalRagRetriever(RagRetriever):
+    """
+    Drop-in replacement for RagRetriever that searches a LocalVectorIndex instead of a
+    Bedrock knowledge base. Filters, caching and the document shape are the same, so it works
+    offline with RagBot, e.g. `RagBot(None, retriever=LocalRagRetriever("index/"))`.
+
+    Args:
+        index_dir (str): Directory of the index
+        embedding (Embeddings, optional): LangChain embedding model for queries
+    """
+    def __init__(
+            self, index_dir, num_results=int(os.environ.get('RAG_NUMBER_OF_RESULTS', 4)),
+            start_year=1800, end_year=2100, topic=None, cache=retrieval_cache, embedding=None
+        ):
+        self.cache = cache
+        # Used in the cache key, so results of different indexes never mix
+        self.knowledge_base_id = f"local:{os.path.abspath(index_dir)}"
+        self.num_results = num_results
+        self.start_year = start_year
+        self.end_year = end_year
+        self.topic = topic
+        self.retriever = LocalVectorIndex(index_dir, embedding=embedding)
+
+    def retrieve(self, query, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        num_results, start_year, end_year, topic = self.resolve_filters(num_results, start_year, end_year, topic)
+        with span("retrieval", backend="local"):
+            hits = self.retriever.search(query.strip(), num_results, start_year, end_year, topic)
+        return [self.retriever.document(row, score) for row, score in hits]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a local vector index from a directory of PDFs")
+    parser.add_argument("pdf_dir", help="Directory containing the PDFs and their .metadata.json sidecars")
+    parser.add_argument("index_dir", help="Directory to write the index to")
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--no-cache", action="store_true", help="Re-embed all chunks")
+    args = parser.parse_args()
+
+    papers = []
+    for file_name in sorted(os.listdir(args.pdf_dir)):
+        if not file_name.lower().endswith('.pdf'):
+            continue
+        pdf_path = os.path.join(args.pdf_dir, file_name)
+        metadata = load_sidecar_metadata(pdf_path)
+        if metadata is None:
+            logger.info(f"Skipping {file_name}, it has no .metadata.json sidecar")
+            continue
+        papers.append((pdf_path, metadata))
+    LocalVectorIndex.build(
+        args.index_dir, papers, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+        use_cache=not args.no_cache
+    )
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def file_hash(file_path, chunk_size=1 << 20):
+    """Compute the SHA-256 hash of a file's content
+    Args:
+        file_path (str): Path of the file
+        chunk_size (int): Number of bytes read at a time
+    Returns:
+        str: Hex digest of the file content
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def prompt_version(*parts):
+    """Derive a short version key from everything that shapes an LLM response
+    Args:
+        *parts (str): Prompt texts, model IDs, ...
+    Returns:
+        str: Version key that changes whenever one of the parts changes
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(str(part).encode('utf-8'))
+        sha.update(b'\0')
+    return sha.hexdigest()[:16]
+
+
+class MetadataCache:
+    """
+    A persistent, content-addressed cache for PDF metadata extraction results.
+
+    Every entry is a small JSON file named after the content hash of the PDF. It holds the
+    extracted first-page text, the raw LLM response, the parsed `preprocess_info` tuple and
+    the prompt version that produced them. When the total size of the cache exceeds
+    `max_size_bytes`, the least recently used entries are removed.
+
+    Args:
+        cache_dir (str, optional): Directory of the cache. Defaults to the METADATA_CACHE_DIR
+            environment variable or ".cache/metadata".
+        max_size_bytes (int, optional): Maximum total size of all entries. Defaults to 256 MB.
+    """
+    def __init__(
+            self, cache_dir=os.environ.get('METADATA_CACHE_DIR', '.cache/metadata'),
+            max_size_bytes=256 * 1024 * 1024
+        ):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            # Touch the entry so eviction is least recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, unreadable or evicted by another writer in the meantime
+            return None
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        tmp_path = f"{path}.tmp"
+        with self._lock:
+            # Created on first write, not when the module is imported
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total_size = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total_size += stat.st_size
+        entries.sort()
+        while total_size > self.max_size_bytes and entries:
+            _, size, name = entries.pop(0)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            logger.info(f"Evicted metadata cache entry {name}")
+
+    def clear(self):
+        with self._lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+            for name in os.listdir(self.cache_dir):
+                os.remove(os.path.join(self.cache_dir, name))
@@ -1,7 +1,13 @@
+import datetime
+import json
 import logging
+import os
 import re
-from pypdf import PdfReader
+import unicodedata
 from llm import LlmBot
+from pdf_engine import FIRST_PAGE, get_pdf_engine
+from metadata_cache import MetadataCache, file_hash, prompt_version
+from metrics import increment, span
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,33 +17,116 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+SYSTEM_PROMPT = "Pretend to be a helpful research assistant"
+FORMAT_INSTRUCTIONS = "And do you know the publication year? \n" \
+    "In addition, you can always respond in the same format:\n" \
+    "Authors: [...] \n" \
+    "Title: [...] \n" \
+    "The publication year [...]. The submission happened on [...] \n" \
+    "If there is neither publication year nor submission, reply with  \n" \
+    "The publication year is not provided [...] \n" \
+    "Then \n The submission year happened on [...]" \
+    "If none of the above applies, please state a guess year only if there is a clear and possible reference in the text" \
+    "(e.g., a footnote indicating the 31st Conference on Neural Information Processing Systems (NIPS 2017) or" \
+    "a time stamp from arxiv). Otherwise, if you specify that it appears to be only a" \
+    "recent publication, avoid providing the current or previous year \n" \
+    "Finally, infer from the context whether the paper belongs to the topic of Machine Learning or Biology" \
+    "completing the response as it follows: \n" \
+    "Topic: [ML or Biology in this format only!]"
+QUERY_TEMPLATE = "What are the authors' names and title contained in this first page of paper: {text}? \n" \
+    + FORMAT_INSTRUCTIONS
+
+# Batch mode: several first pages in one request, each answer introduced by its delimiter
+DOCUMENT_DELIMITER = "=== Document {index} ==="
+BATCH_QUERY_TEMPLATE = "Below are the first pages of {count} papers. Each paper starts with a line " \
+    "'=== Document <number> ==='. Answer the questions below for every paper separately. " \
+    "Start the answer for each paper with its '=== Document <number> ===' line and do not " \
+    "mix information between papers. \n" \
+    "What are the authors' names and title contained in each first page? \n" \
+    + FORMAT_INSTRUCTIONS + "\n\n{documents}"
+# Rough number of characters per token, used to fill a batch up to its token budget
+CHARS_PER_TOKEN = 4
+
+# Structured mode: the model answers with compact JSON that is validated in one parse
+# instead of prose that is picked apart with regexes. Opt-in with
+# METADATA_EXTRACTION_MODE=json; the default "text" keeps the prose prompts.
+EXTRACTION_MODE = os.environ.get('METADATA_EXTRACTION_MODE', 'text')
+TOPICS = ("ML", "Biology")
+JSON_SCHEMA = '{"authors": ["First Last", ...], "title": "...", "year": 2017, "topic": "ML" or "Biology"}'
+JSON_INSTRUCTIONS = "year is the publication year, else the submission year, else a year clearly " \
+    "referenced in the text (e.g. a conference footnote like NIPS 2017 or an arXiv stamp), else null. " \
+    "topic is whether the paper belongs to Machine Learning (ML) or Biology. " \
+    "Reply with JSON only, no explanation."
+# Braces of the schema are escaped for str.format
+_ESCAPED_SCHEMA = JSON_SCHEMA.replace("{", "{{").replace("}", "}}")
+JSON_QUERY_TEMPLATE = "Extract the metadata of this first page of a paper as " + _ESCAPED_SCHEMA + ". " \
+    + JSON_INSTRUCTIONS + "\n\n{text}"
+JSON_BATCH_QUERY_TEMPLATE = "Below are the first pages of {count} papers, each starting with a line " \
+    "'=== Document <number> ==='. Extract the metadata of every paper separately as a JSON array " \
+    "with one object per paper in document order: [" + _ESCAPED_SCHEMA.replace("{{", '{{"document": 1, ', 1) \
+    + ", ...]. " + JSON_INSTRUCTIONS + "\n\n{documents}"
+REPAIR_TEMPLATE = "This reply should be JSON of the form {schema} but is invalid ({error}):\n\n" \
+    "{response}\n\nReply with the corrected JSON only."
+# Repair requests per paper before the reply is given up on
+MAX_REPAIRS = int(os.environ.get('METADATA_MAX_REPAIRS', 1))
+
+# Fast path: fields found in the PDF itself with at least this confidence skip the LLM
+FAST_PATH_THRESHOLD = float(os.environ.get('METADATA_FAST_PATH_THRESHOLD', 0.7))
+# Bumped when the fast path rules change, so cached results of older rules are redone
+FAST_PATH_RULES = 2
+ARXIV_FILENAME = re.compile(r'^(?:arxiv[_-]?)?(\d{2})(\d{2})\.\d{4,5}(?:v\d+)?$', re.IGNORECASE)
+ARXIV_STAMP = re.compile(r'arXiv:(\d{2})(\d{2})\.\d{4,5}')
+VENUE_YEAR = re.compile(
+    r'\b(?:NIPS|NeurIPS|ICML|ICLR|CVPR|ICCV|ECCV|ACL|EMNLP|NAACL|AAAI|IJCAI|KDD|AISTATS|UAI|COLT)'
+    r'\s*[\'’]?((?:19|20)\d{2}|\d{2})\b'
+)
+HEADER_YEAR = re.compile(r'\(((?:19|20)\d{2})\)|Published\s+\d{1,2}/(\d{2})\b|(?:©|Copyright)\s*((?:19|20)\d{2})')
+EMAIL = re.compile(r'\S+@\S+')
+BOILERPLATE = re.compile(
+    r'journal|proceedings|conference|permission|copyright|arxiv|preprint|submitted|published|'
+    r'volume|vol\.|licen[cs]e|workshop|doi|issn|http|www\.', re.IGNORECASE
+)
+AFFILIATION = re.compile(
+    r'universit|institut|department|school|college|laborator|\blab\b|research|google|microsoft|'
+    r'facebook|deepmind|openai|\binc\b|\bltd\b|corporation|hospital|cent(?:er|re)|academy|brain\b',
+    re.IGNORECASE
+)
+# Venues named in the header lines date the paper itself, elsewhere they are usually citations
+HEADER_LINES = 10
+END_OF_HEADER = re.compile(r'^(?:abstract|editor|introduction|keywords|summary)\b', re.IGNORECASE)
+TOPIC_KEYWORDS = {
+    "ML": ("learning", "neural", "network", "networks", "training", "algorithm", "dataset",
+           "gradient", "attention", "classification", "reinforcement", "transformer", "inference",
+           "optimization", "supervised", "embedding", "regularization", "model", "models"),
+    "Biology": ("cell", "cells", "protein", "proteins", "gene", "genes", "genome", "species", "tissue",
+                "dna", "rna", "molecular", "clinical", "patients", "enzyme", "mutation", "organism",
+                "expression", "receptor", "biological"),
+}
+
+# Cached extraction results are only valid for the prompt and model that produced them
+PROMPT_VERSION = prompt_version(
+    SYSTEM_PROMPT, JSON_QUERY_TEMPLATE if EXTRACTION_MODE == 'json' else QUERY_TEMPLATE, REPAIR_TEMPLATE,
+    os.environ.get('MODEL_ID'), FAST_PATH_THRESHOLD, FAST_PATH_RULES
+)
+metadata_cache = MetadataCache()
+
+_extractor_bot = None
+
+def get_extractor_bot():
+    """Get the shared metadata extraction bot; only its stateless `invoke` is used"""
+    global _extractor_bot
+    if _extractor_bot is None:
+        _extractor_bot = LlmBot(system_prompt=SYSTEM_PROMPT)
+    return _extractor_bot
+
 def initialize_bot(text: str):
-    prompt = "Pretend to be a helpful research assistant"
-    query = f"What are the authors' names and title contained in this first page of paper: {text}? \n" \
-        "And do you know the publication year? \n" \
-        "In addition, you can always respond in the same format:\n" \
-        "Authors: [...] \n" \
-        "Title: [...] \n" \
-        "The publication year [...]. The submission happened on [...] \n" \
-        "If there is neither publication year nor submission, reply with  \n" \
-        "The publication year is not provided [...] \n" \
-        "Then \n The submission year happened on [...]" \
-        "If none of the above applies, please state a guess year only if there is a clear and possible reference in the text" \
-        "(e.g., a footnote indicating the 31st Conference on Neural Information Processing Systems (NIPS 2017) or" \
-        "a time stamp from arxiv). Otherwise, if you specify that it appears to be only a" \
-        "recent publication, avoid providing the current or previous year \n" \
-        "Finally, infer from the context whether the paper belongs to the topic of Machine Learning or Biology" \
-        "completing the response as it follows: \n" \
-        "Topic: [ML or Biology in this format only!]"""
-        
-    bot = LlmBot(system_prompt=prompt)
-    return bot, query
+    template = JSON_QUERY_TEMPLATE if EXTRACTION_MODE == 'json' else QUERY_TEMPLATE
+    query = template.format(text=text)
+    return get_extractor_bot(), query
 
 def read_pdf(paper_path: str):
-    reader = PdfReader(paper_path)
-    first_page = reader.pages[0] #read first page
-    text = first_page.extract_text()   
-    return text
+    # Parsed in a worker process, with the engine's timeout and size limits
+    return get_pdf_engine().read_text(paper_path, pages=FIRST_PAGE)
 
 def preprocess_info(response: str):
     authors_match = re.search(r"Authors:\s*(.*?)(?=\s*Title:|\s*The publication year)", response, re.DOTALL)
@@ -89,10 +178,256 @@ def preprocess_info(response: str):
 
     return authors, title, year, topic
 
-def extract_metadata_new_file(paper_path: str):
-    text = read_pdf(paper_path)
+def _person_names(line: str):
+    """Names of people on a line of a title page, [] if it is not an author line"""
+    names = []
+    for part in re.split(r',|;|&|\band\b', EMAIL.sub(' ', line)):
+        part = re.sub(r'[∗*†‡§¶\d]+', ' ', part).strip()
+        if not part:
+            continue
+        tokens = part.split()
+        if not 2 <= len(tokens) <= 4 or AFFILIATION.search(part):
+            return []
+        for token in tokens:
+            letters = token.replace('.', '').replace('-', '').replace("'", '').replace('’', '')
+            if not (token[0].isupper() and letters.isalpha()):
+                return []
+        names.append(' '.join(tokens))
+    return names
+
+def _is_title_line(line: str):
+    words = line.split()
+    return (
+        0 < len(words) <= 25 and line[0].isupper() and not line.endswith('.')
+        and '@' not in line and not BOILERPLATE.search(line)
+    )
+
+def _expand_year(year):
+    """Four-digit year of a year as written, e.g. NIPS'98 is 1998 and arXiv:1706 is 2017"""
+    year = int(year)
+    if year >= 100:
+        return year
+    return year + (2000 if year <= datetime.date.today().year % 100 else 1900)
+
+def _plausible_year(year):
+    """Whether a year can be the publication year of a paper, like `validate_metadata` checks"""
+    return 1800 <= int(year) <= datetime.date.today().year + 1
+
+def _first_page_candidates(text: str):
+    """Title, authors, year and topic guessed from the layout and words of a first page"""
+    candidates = {}
+    # NFKC turns ligatures like "ﬁ" back into plain letters
+    text = unicodedata.normalize('NFKC', text)
+    lines = [line.strip() for line in text.splitlines() if line.strip()][:60]
+
+    start = next((i for i, line in enumerate(lines) if _is_title_line(line) and not _person_names(line)), None)
+    if start is not None:
+        title_lines = [lines[start]]
+        end = start + 1
+        while end < len(lines) and len(title_lines) < 4 and _is_title_line(lines[end]) \
+                and not _person_names(lines[end]) and not AFFILIATION.search(lines[end]):
+            title_lines.append(lines[end])
+            end += 1
+        authors = []
+        for line in lines[end:end + 40]:
+            if END_OF_HEADER.match(line):
+                break
+            authors.extend(name for name in _person_names(line) if name not in authors)
+        # A title directly followed by author lines is the usual title page layout
+        structured = bool(authors) and end < len(lines) and bool(_person_names(lines[end]))
+        confidence = 0.75 if structured else 0.5
+        candidates['title'] = (" ".join(title_lines), confidence, "first_page")
+        if authors:
+            candidates['authors'] = (", ".join(authors), confidence, "first_page")
+
+    header = "\n".join(lines[:3])
+    header_end = next((i for i, line in enumerate(lines) if END_OF_HEADER.match(line)), len(lines))
+    title_block = "\n".join(lines[:min(header_end, HEADER_LINES)])
+    for pattern, haystack, confidence, source in (
+            (ARXIV_STAMP, text, 0.85, "arxiv_stamp"),
+            (HEADER_YEAR, header, 0.8, "page_header"),
+            (VENUE_YEAR, title_block, 0.75, "venue"),
+            # A venue in the body is most likely cited, too weak to skip the LLM on its own
+            (VENUE_YEAR, text, 0.45, "venue_mention"),
+        ):
+        years = [
+            _expand_year(next(group for group in match.groups() if group))
+            for match in pattern.finditer(haystack)
+        ]
+        years = [year for year in years if _plausible_year(year)]
+        if years:
+            candidates['year'] = (str(years[0]), confidence, source)
+            break
+
+    words = re.findall(r'[a-z]+', text.lower())
+    counts = {topic: sum(words.count(keyword) for keyword in keywords) for topic, keywords in TOPIC_KEYWORDS.items()}
+    total = sum(counts.values())
+    if total >= 3:
+        topic = max(counts, key=counts.get)
+        margin = (counts[topic] - min(counts.values())) / total
+        candidates['topic'] = (topic, min(0.9, 0.5 + 0.5 * margin), "keywords")
+    return candidates
+
+def resolve_fast_path(paper_path: str, text: str, info=None):
+    """Collect metadata candidates from cheap signals, without calling the LLM
+    Args:
+        paper_path (str): Path of the PDF; arXiv file names like 1706.03762v7.pdf give the year
+        text (str): Text of the first page
+        info (dict, optional): PDF document information, e.g. 'Title', 'Author', 'CreationDate'
+    Returns:
+        dict: (value, confidence, source) per field among 'authors', 'title', 'year', 'topic'
+    """
+    candidates = _first_page_candidates(text or "")
+
+    def offer(field, value, confidence, source):
+        if field == 'year' and value and not _plausible_year(value):
+            return
+        if value and confidence > candidates.get(field, (None, 0.0, None))[1]:
+            candidates[field] = (value, confidence, source)
+
+    info = info or {}
+    title = " ".join(info.get('Title', '').split())
+    if len(title) > 3 and not re.match(r'(untitled|microsoft word|document\d*$|\S+\.(docx?|tex|dvi|pdf)$)', title, re.I):
+        offer('title', title, 0.85, "pdf_info")
+    authors = [a.strip() for a in re.split(r';|,|\band\b', info.get('Author', '')) if a.strip()]
+    if authors:
+        offer('authors', ", ".join(authors), 0.8, "pdf_info")
+    creation = re.match(r'D:((?:19|20)\d{2})', info.get('CreationDate', ''))
+    if creation:
+        # Often the date of a later revision, so only a weak hint
+        offer('year', creation.group(1), 0.4, "pdf_info")
+
+    arxiv = ARXIV_FILENAME.match(os.path.splitext(os.path.basename(str(paper_path)))[0])
+    if arxiv and 1 <= int(arxiv.group(2)) <= 12:
+        offer('year', str(_expand_year(arxiv.group(1))), 0.9, "arxiv_id")
+    return candidates
+
+def fast_path_metadata(candidates, threshold=FAST_PATH_THRESHOLD):
+    """Metadata from the fast path candidates, None if any field is below the threshold"""
+    if not all(candidates.get(field, (None, 0.0))[1] >= threshold for field in ('authors', 'title', 'year', 'topic')):
+        increment("metadata_fast_path_total", result="miss")
+        return None
+    increment("metadata_fast_path_total", result="hit")
+    metadata = {field: candidates[field][0] for field in ('authors', 'title', 'year', 'topic')}
+    metadata['sources'] = {field: candidates[field][2] for field in ('authors', 'title', 'year', 'topic')}
+    return metadata
+
+def merge_metadata(candidates, llm_metadata, threshold=FAST_PATH_THRESHOLD):
+    """Combine fast path candidates with LLM results; confident candidates win per field"""
+    metadata, sources = {}, {}
+    for field in ('authors', 'title', 'year', 'topic'):
+        value, confidence, source = candidates.get(field, (None, 0.0, None))
+        if value and confidence >= threshold:
+            metadata[field], sources[field] = value, source
+        elif llm_metadata.get(field):
+            metadata[field], sources[field] = llm_metadata[field], "llm"
+        else:
+            metadata[field], sources[field] = value, source
+    metadata['sources'] = sources
+    return metadata
+
+def resolve_metadata(paper_path: str, text: str, info=None, threshold=FAST_PATH_THRESHOLD):
+    """Resolve the metadata of a paper, calling the LLM only if the fast path is not confident
+    Args:
+        paper_path (str): Path of the PDF
+        text (str): Text of the first page
+        info (dict, optional): PDF document information
+        threshold (float): Confidence every field needs to skip the LLM
+    Returns:
+        tuple[dict, str | None]: Metadata with keys 'authors', 'title', 'year', 'topic' and
+            'sources', which names the path that produced every field, and the raw LLM
+            response, None if the LLM was not called
+    """
+    candidates = resolve_fast_path(paper_path, text, info)
+    metadata = fast_path_metadata(candidates, threshold)
+    if metadata is not None:
+        return metadata, None
+    llm_metadata, response = _extract_metadata(text)
+    return merge_metadata(candidates, llm_metadata, threshold), response
+
+def extract_metadata_from_text(text: str):
+    """Extract metadata from the first page text of a paper with the LLM
+    Args:
+        text (str): Text of the first page of the paper
+    Returns:
+        dict: Metadata with keys 'authors', 'title', 'year' and 'topic'
+    """
+    metadata, _ = _extract_metadata(text)
+    return metadata
+
+def parse_json_reply(response: str):
+    """Parse the outermost JSON object or array of a reply, ignoring code fences and chatter"""
+    starts = [i for i in (response.find('{'), response.find('[')) if i >= 0]
+    if not starts:
+        raise ValueError("no JSON found")
+    start = min(starts)
+    end = response.rfind('}' if response[start] == '{' else ']')
+    if end < start:
+        raise ValueError("unterminated JSON")
+    return json.loads(response[start:end + 1])
+
+def validate_metadata(record):
+    """Check a parsed JSON record against the schema and normalize it
+    Args:
+        record (dict): Parsed JSON object of one paper
+    Returns:
+        dict: Metadata with keys 'authors', 'title', 'year' and 'topic' in the shape of
+            `preprocess_info`; year and topic are None if the paper does not state them
+    Raises:
+        ValueError: If the record does not match the schema
+    """
+    if not isinstance(record, dict):
+        raise ValueError("expected a JSON object")
+    authors = record.get('authors')
+    if isinstance(authors, str):
+        authors = re.split(r',\s*|\sand\s', authors)
+    if not isinstance(authors, list) or not all(isinstance(a, str) for a in authors):
+        raise ValueError("authors must be a list of names")
+    authors = [" ".join(a.replace("*", "").split()) for a in authors if a.strip()]
+    title = record.get('title')
+    if not isinstance(title, str) or not title.strip():
+        raise ValueError("title must be a non-empty string")
+    year = record.get('year')
+    if year is not None:
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            raise ValueError("year must be an integer or null") from None
+        if not 1800 <= year <= 2100:
+            raise ValueError(f"year {year} is out of range")
+    topic = record.get('topic')
+    if topic is not None and topic not in TOPICS:
+        raise ValueError(f"topic must be one of {', '.join(TOPICS)}")
+    return {
+        'authors': ', '.join(authors) or None,
+        'title': " ".join(title.split()),
+        'year': str(year) if year is not None else None,
+        'topic': topic,
+    }
+
+def repair_json(bot, response, error, schema=JSON_SCHEMA):
+    """Ask the model once to fix an invalid JSON reply, without resending the paper"""
+    increment("metadata_repairs_total")
+    return bot.invoke(REPAIR_TEMPLATE.format(schema=schema, error=error, response=response))
+
+def _extract_metadata_json(text: str, max_repairs=MAX_REPAIRS):
+    bot, query = initialize_bot(text)
+    response = bot.invoke(query)
+    for attempt in range(max_repairs + 1):
+        try:
+            return validate_metadata(parse_json_reply(response)), response
+        except ValueError as e:
+            if attempt == max_repairs:
+                logger.info(f"Invalid metadata JSON after {max_repairs} repairs: {e}")
+                increment("metadata_parse_failures_total")
+                return {'authors': None, 'title': None, 'year': None, 'topic': None}, response
+            response = repair_json(bot, response, e)
+
+def _extract_metadata(text: str):
+    if EXTRACTION_MODE == 'json':
+        return _extract_metadata_json(text)
     bot, query = initialize_bot(text)
-    response = bot.chat(query)
+    response = bot.invoke(query)
     print(response)
     authors, title, year, topic = preprocess_info(response)
     metadata = {
@@ -101,4 +436,174 @@ def extract_metadata_new_file(paper_path: str):
         'year' : year,
         'topic' : topic,
     }
+    return metadata, response
+
+def extract_metadata_new_file(paper_path: str, use_cache=True):
+    """Extract metadata from a PDF, reusing earlier results for identical files
+    Args:
+        paper_path (str): Path of the PDF file
+        use_cache (bool): Whether to look up and store the result in the metadata cache
+    Returns:
+        dict: Metadata with keys 'authors', 'title', 'year' and 'topic', and 'sources' naming
+            the path that produced every field
+    """
+    if not use_cache:
+        with span("pdf_parse"):
+            text, info = get_pdf_engine().read_document(paper_path, pages=FIRST_PAGE)
+        return resolve_metadata(paper_path, text, info)[0]
+
+    key = file_hash(paper_path)
+    entry = metadata_cache.get(key)
+    if entry is not None and entry.get('version') == PROMPT_VERSION:
+        logger.info(f"Metadata cache hit for {paper_path}")
+        increment("cache_requests_total", cache="metadata", result="hit")
+        metadata = dict(zip(('authors', 'title', 'year', 'topic'), entry['preprocess_info']))
+        metadata['sources'] = entry.get('sources', {})
+        return metadata
+
+    increment("cache_requests_total", cache="metadata", result="miss")
+    # The first page text does not depend on the prompt, so it survives a version change
+    if entry is not None and 'info' in entry and 'text' in entry:
+        text, info = entry['text'], entry['info']
+    else:
+        with span("pdf_parse"):
+            text, info = get_pdf_engine().read_document(paper_path, pages=FIRST_PAGE)
+    metadata, response = resolve_metadata(paper_path, text, info)
+    metadata_cache.put(key, {
+        'version': PROMPT_VERSION,
+        'text': text,
+        'info': info,
+        'response': response,
+        'preprocess_info': [metadata['authors'], metadata['title'], metadata['year'], metadata['topic']],
+        'sources': metadata['sources'],
+    })
     return metadata
+
+def make_batches(texts, max_batch_tokens=12000, max_batch_size=8):
+    """Group first-page texts into batches that fit a prompt token budget
+    Args:
+        texts (list[str]): First-page texts of the papers
+        max_batch_tokens (int): Estimated maximum number of document tokens per batch
+        max_batch_size (int): Maximum number of documents per batch, bounds the response length
+    Returns:
+        list[list[int]]: Indices into `texts` for every batch
+    """
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = len(text) // CHARS_PER_TOKEN + 1
+        if current and (current_tokens + tokens > max_batch_tokens or len(current) >= max_batch_size):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def split_batch_response(response: str, count: int):
+    """Split a batch response into the answers for the single documents
+    Args:
+        response (str): Raw LLM response to a batch query
+        count (int): Number of documents in the batch
+    Returns:
+        list[str | None]: Answer per document, None if the document has no answer
+    """
+    records = [None] * count
+    delimiter = re.escape(DOCUMENT_DELIMITER).replace(re.escape("{index}"), r"(\d+)")
+    parts = re.split(delimiter, response)
+    # re.split yields [preamble, index, answer, index, answer, ...]
+    for index, record in zip(parts[1::2], parts[2::2]):
+        index = int(index) - 1
+        if 0 <= index < count and records[index] is None:
+            records[index] = record.strip()
+    return records
+
+def parse_batch_json(response: str, count: int):
+    """Parse a JSON batch response with a single parse for the whole batch
+    Args:
+        response (str): Raw LLM response to a JSON batch query
+        count (int): Number of documents in the batch
+    Returns:
+        list[dict | None]: Validated metadata per document, None for missing or invalid records
+    Raises:
+        ValueError: If the response is not a JSON array
+    """
+    records = parse_json_reply(response)
+    if not isinstance(records, list):
+        raise ValueError("expected a JSON array")
+    results = [None] * count
+    for position, record in enumerate(records):
+        if not isinstance(record, dict):
+            continue
+        # Fall back to the position if the model dropped the document number
+        index = record.get('document', position + 1)
+        index = int(index) - 1 if isinstance(index, (int, str)) and str(index).isdigit() else position
+        if 0 <= index < count and results[index] is None:
+            try:
+                results[index] = validate_metadata(record)
+            except ValueError:
+                pass
+    return results
+
+def _extract_batch_json(bot, texts, batch):
+    documents = "\n\n".join(
+        f"{DOCUMENT_DELIMITER.format(index=n)}\n{texts[i]}" for n, i in enumerate(batch, start=1)
+    )
+    response = bot.invoke(JSON_BATCH_QUERY_TEMPLATE.format(count=len(batch), documents=documents))
+    for attempt in range(MAX_REPAIRS + 1):
+        try:
+            return parse_batch_json(response, len(batch))
+        except ValueError as e:
+            if attempt == MAX_REPAIRS:
+                raise
+            response = repair_json(bot, response, e, schema="[" + JSON_SCHEMA + ", ...]")
+
+def extract_metadata_batch(texts, max_batch_tokens=12000, max_batch_size=8):
+    """Extract metadata for several papers with one LLM call per batch
+    Args:
+        texts (list[str]): First-page texts of the papers
+        max_batch_tokens (int): Estimated maximum number of document tokens per batch
+        max_batch_size (int): Maximum number of documents per batch
+    Returns:
+        list[dict]: Metadata per paper, in the order of `texts`. Papers whose answer could
+            not be parsed from the batch response are extracted on their own.
+    """
+    bot = get_extractor_bot()
+    results = [None] * len(texts)
+    for batch in make_batches(texts, max_batch_tokens, max_batch_size):
+        if EXTRACTION_MODE == 'json':
+            try:
+                records = _extract_batch_json(bot, texts, batch)
+            except Exception as e:
+                logger.info(f"Batch metadata extraction failed: {e}")
+                records = [None] * len(batch)
+            for i, record in zip(batch, records):
+                if record is not None and record['authors'] and record['title']:
+                    results[i] = record
+            continue
+
+        documents = "\n\n".join(
+            f"{DOCUMENT_DELIMITER.format(index=n)}\n{texts[i]}" for n, i in enumerate(batch, start=1)
+        )
+        query = BATCH_QUERY_TEMPLATE.format(count=len(batch), documents=documents)
+        try:
+            response = bot.invoke(query)
+            records = split_batch_response(response, len(batch))
+        except Exception as e:
+            logger.info(f"Batch metadata extraction failed: {e}")
+            records = [None] * len(batch)
+
+        for i, record in zip(batch, records):
+            if record is None:
+                continue
+            authors, title, year, topic = preprocess_info(record)
+            if authors and title:
+                results[i] = {'authors': authors, 'title': title, 'year': year, 'topic': topic}
+
+    retries = [i for i, result in enumerate(results) if result is None]
+    if retries:
+        logger.info(f"Retrying {len(retries)} of {len(texts)} papers one by one")
+    for i in retries:
+        results[i] = extract_metadata_from_text(texts[i])
+    return results
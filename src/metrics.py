@@ -0,0 +1,179 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+# Structured JSON events go to their own logger, so they can be routed separately
+event_logger = logging.getLogger("knowledge_engine.metrics")
+JSON_LOGS = os.environ.get('METRICS_JSON_LOGS', '1') == '1'
+
+PREFIX = "knowledge_engine"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_histograms = {}  # (stage, labels) -> [count, sum, [count per bucket]]
+_counters = {}  # (name, labels) -> value
+_collectors = []  # callables returning [(name, labels dict, value)] gauges
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def log_event(event, **fields):
+    if JSON_LOGS:
+        event_logger.info(json.dumps({"event": event, "ts": time.time(), **fields}, default=str))
+
+
+def observe(stage, seconds, **labels):
+    """Record the duration of one run of a pipeline stage"""
+    key = (stage, _labels_key(labels))
+    with _lock:
+        histogram = _histograms.setdefault(key, [0, 0.0, [0] * len(BUCKETS)])
+        histogram[0] += 1
+        histogram[1] += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[2][i] += 1
+    log_event("span", stage=stage, duration_ms=round(seconds * 1000, 3), **labels)
+
+
+@contextmanager
+def span(stage, **labels):
+    """Time the enclosed block as a run of `stage`; failed runs get an `error` label"""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start, error=error, **labels)
+
+
+def increment(name, value=1, **labels):
+    """Add to a counter"""
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def token_usage(message):
+    """Input and output token counts from the metadata of a LangChain AI message
+    Returns:
+        tuple[int, int]: Input and output tokens, 0 if the model reported none
+    """
+    usage = getattr(message, 'usage_metadata', None)
+    if usage:
+        return usage.get('input_tokens', 0), usage.get('output_tokens', 0)
+    usage = (getattr(message, 'response_metadata', None) or {}).get('usage') or {}
+    return (
+        usage.get('input_tokens', usage.get('prompt_tokens', 0)),
+        usage.get('output_tokens', usage.get('completion_tokens', 0)),
+    )
+
+
+def record_tokens(stage, input_tokens, output_tokens, **labels):
+    increment("tokens_total", input_tokens, stage=stage, kind="input", **labels)
+    increment("tokens_total", output_tokens, stage=stage, kind="output", **labels)
+    log_event("tokens", stage=stage, input_tokens=input_tokens, output_tokens=output_tokens, **labels)
+
+
+def register_collector(collector):
+    """Register a callable that returns gauges as [(name, labels, value)] at scrape time"""
+    _collectors.append(collector)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render_prometheus():
+    """Render all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        histograms = {k: (v[0], v[1], list(v[2])) for k, v in _histograms.items()}
+        counters = dict(_counters)
+
+    name = f"{PREFIX}_stage_duration_seconds"
+    lines.append(f"# TYPE {name} histogram")
+    for (stage, labels), (count, total, buckets) in sorted(histograms.items()):
+        labels = (("stage", stage),) + labels
+        for bound, bucket_count in zip(BUCKETS, buckets):
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {bucket_count}")
+        lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+
+    for counter in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}_{counter} counter")
+        for (name, labels), value in sorted(counters.items()):
+            if name == counter:
+                lines.append(f"{PREFIX}_{name}{_format_labels(labels)} {value}")
+
+    gauges = {}
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((_labels_key(labels), value))
+        except Exception as e:
+            logger.info(f"Metrics collector failed: {e}")
+    for name, samples in sorted(gauges.items()):
+        lines.append(f"# TYPE {PREFIX}_{name} gauge")
+        for labels, value in samples:
+            lines.append(f"{PREFIX}_{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(
+        port=int(os.environ.get('METRICS_PORT', 0)) or None,
+        host=os.environ.get('METRICS_HOST', '127.0.0.1')
+    ):
+    """Serve /metrics in a background thread next to the Gradio app
+    The endpoint is opt-in: nothing is served unless a port is given or METRICS_PORT is set.
+    Args:
+        port (int, optional): Port of the metrics endpoint
+        host (str): Interface to listen on, only the local one by default
+    Returns:
+        ThreadingHTTPServer: The running server, None if not enabled or the port is taken
+    """
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    except OSError as e:
+        # The app runs fine without its metrics endpoint
+        logger.info(f"Could not start metrics server on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return server
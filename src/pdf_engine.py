@@ -0,0 +1,313 @@
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import threading
+from concurrent.futures import (
+    CancelledError, ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+)
+from concurrent.futures.process import BrokenProcessPool
+from pypdf import PdfReader
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Page ranges are Python ranges of 0-based page numbers, None means all pages
+FIRST_PAGE = range(0, 1)
+# Extra seconds the parent waits for a worker before it assumes the worker hangs
+HANG_GRACE_SECONDS = 5
+
+
+class PdfRejected(Exception):
+    """A PDF exceeded a limit of the extraction engine or could not be parsed"""
+
+
+def _raise_timeout(signum, frame):
+    raise PdfRejected("Parsing timed out")
+
+
+def _document_info(reader):
+    """The document information dictionary, e.g. {'Title': ..., 'Author': ...}"""
+    try:
+        return {str(key).lstrip('/'): str(value) for key, value in (reader.metadata or {}).items()}
+    except Exception:
+        return {}
+
+
+def _extract_pages(path, start, stop, max_pages, timeout):
+    """Extract the text of pages [start, stop) of a PDF; runs in a worker process
+    Returns:
+        tuple[int, list[tuple[int, str]], dict]: Number of pages, (page number, text) of every
+            page and, for blocks starting at the first page, the document information
+    """
+    # pypdf is pure Python, so an alarm interrupts even a pathological parse
+    use_alarm = timeout and hasattr(signal, 'setitimer')
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        reader = PdfReader(path)
+        num_pages = len(reader.pages)
+        if max_pages and num_pages > max_pages:
+            raise PdfRejected(f"{num_pages} pages exceed the limit of {max_pages}")
+        stop = num_pages if stop is None else min(stop, num_pages)
+        info = _document_info(reader) if start == 0 else {}
+        return num_pages, [(i, reader.pages[i].extract_text() or "") for i in range(start, stop)], info
+    except PdfRejected:
+        raise
+    except Exception as e:
+        raise PdfRejected(f"{type(e).__name__}: {e}") from None
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+class PdfEngine:
+    """
+    Extract PDF text in a pool of worker processes.
+
+    PDF parsing is CPU-bound and holds the GIL, so threads do not help; worker processes let
+    extraction scale with the number of cores. Pages of a large document are extracted in
+    blocks on several workers and streamed back in page order. Files that are too large,
+    have too many pages or take longer than the timeout are rejected with PdfRejected and
+    optionally moved to a quarantine directory, so one pathological PDF cannot stall a bulk load.
+
+    Spawned workers re-import the main module, which is worth it for bulk loads but not for
+    one interactive upload. With `processes=False` the engine parses on threads of the
+    calling process instead, with the same limits; a file that exceeds the timeout is
+    rejected, but its thread cannot be stopped and runs to completion in the background.
+
+    Args:
+        workers (int, optional): Number of workers. Defaults to the PDF_WORKERS environment
+            variable or the number of cores.
+        timeout (float): Seconds a worker may spend on one file or block of pages
+        max_bytes (int): Largest accepted file size
+        max_pages (int): Largest accepted number of pages
+        quarantine_dir (str, optional): Directory rejected files are moved to, next to a JSON
+            file with the reason. Rejected files stay in place if not set.
+        block_size (int): Pages per task when streaming all pages of a document
+        processes (bool): Whether to parse in worker processes or in threads
+    """
+    def __init__(
+            self, workers=int(os.environ.get('PDF_WORKERS', 0)) or os.cpu_count(),
+            timeout=float(os.environ.get('PDF_TIMEOUT', 60)),
+            max_bytes=int(os.environ.get('PDF_MAX_BYTES', 100 * 1024 * 1024)),
+            max_pages=int(os.environ.get('PDF_MAX_PAGES', 2000)),
+            quarantine_dir=os.environ.get('PDF_QUARANTINE_DIR'), block_size=16, processes=True
+        ):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_pages = max_pages
+        self.quarantine_dir = quarantine_dir
+        self.block_size = block_size
+        self.processes = processes
+        self.quarantined = {}  # path -> reason
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = {}  # executor -> its unfinished futures
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                if self.processes:
+                    # Spawned workers do not inherit the locks of the parent's threads
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="pdf-parse")
+                self._futures[self._executor] = set()
+            return self._executor
+
+    def _restart(self, executor, hung=None):
+        """Replace a pool whose worker hangs or died
+        New tasks go to a fresh pool at once, while the old one is retired in the background.
+        """
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            pending = [future for future in self._futures.pop(executor, ()) if future is not hung]
+        threading.Thread(
+            target=self._retire, args=(executor, pending), name="pdf-pool-retire", daemon=True
+        ).start()
+
+    def _retire(self, executor, pending):
+        # The healthy workers finish their tasks first, so one bad file does not cost their work
+        wait(pending, timeout=self.timeout + HANG_GRACE_SECONDS if self.timeout else None)
+        # The executor API cannot cancel a running task, so the hanging worker is killed
+        for process in list((getattr(executor, '_processes', None) or {}).values()):
+            if process.is_alive():
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _forget(self, executor, future):
+        with self._lock:
+            self._futures.get(executor, set()).discard(future)
+
+    def _submit(self, path, start, stop):
+        executor = self._pool()
+        # Alarms only work in the main thread of a process, threads rely on the result timeout
+        timeout = self.timeout if self.processes else None
+        future = executor.submit(_extract_pages, path, start, stop, self.max_pages, timeout)
+        with self._lock:
+            if executor in self._futures:
+                self._futures[executor].add(future)
+        future.add_done_callback(lambda done: self._forget(executor, done))
+        return executor, future, (path, start, stop)
+
+    def _result(self, task, retry=True):
+        executor, future, args = task
+        try:
+            return future.result(timeout=self.timeout + HANG_GRACE_SECONDS if self.timeout else None)
+        except FutureTimeoutError:
+            self._restart(executor, hung=future)
+            raise PdfRejected("Worker hangs" if self.processes else "Parsing timed out") from None
+        except (BrokenProcessPool, CancelledError):
+            if retry and executor is not self._executor:
+                # The pool was restarted because of another file, so this one gets a new try
+                return self._result(self._submit(*args), retry=False)
+            self._restart(executor)
+            raise PdfRejected("Worker died") from None
+
+    def _check_size(self, path):
+        size = os.path.getsize(path)
+        if self.max_bytes and size > self.max_bytes:
+            raise PdfRejected(f"{size} bytes exceed the limit of {self.max_bytes}")
+
+    def quarantine(self, path, reason):
+        """Record a rejected file and move it to the quarantine directory, if configured"""
+        logger.info(f"Quarantining {path}: {reason}")
+        self.quarantined[path] = reason
+        if self.quarantine_dir and os.path.exists(path):
+            os.makedirs(self.quarantine_dir, exist_ok=True)
+            target = os.path.join(self.quarantine_dir, os.path.basename(path))
+            shutil.move(path, target)
+            with open(f"{target}.quarantine.json", "w") as f:
+                json.dump({"source": path, "reason": reason}, f)
+
+    def iter_pages(self, path, pages=None):
+        """Stream the text of a PDF page by page
+        Args:
+            path (str): Path of the PDF
+            pages (range, optional): 0-based page numbers to extract, e.g. FIRST_PAGE. All
+                pages if None.
+        Yields:
+            tuple[int, str]: Page number and text of every page, in page order
+        Raises:
+            PdfRejected: If the file exceeds a limit or cannot be parsed; it is quarantined
+        """
+        try:
+            self._check_size(path)
+            start = pages.start if pages is not None else 0
+            stop = pages.stop if pages is not None else None
+            first_stop = start + self.block_size if stop is None else min(stop, start + self.block_size)
+            num_pages, block, _ = self._result(self._submit(path, start, first_stop))
+            stop = num_pages if stop is None else min(stop, num_pages)
+            # The remaining blocks are extracted in parallel while the first is consumed
+            tasks = [
+                self._submit(path, block_start, min(block_start + self.block_size, stop))
+                for block_start in range(first_stop, stop, self.block_size)
+            ]
+        except PdfRejected as e:
+            self.quarantine(path, str(e))
+            raise
+        yield from block
+        for task in tasks:
+            try:
+                _, block, _ = self._result(task)
+            except PdfRejected as e:
+                self.quarantine(path, str(e))
+                raise
+            yield from block
+
+    def read_text(self, path, pages=FIRST_PAGE):
+        """Extract the text of a page range as one string, e.g. the first page for metadata"""
+        return "\n".join(text for _, text in self.iter_pages(path, pages))
+
+    def read_document(self, path, pages=FIRST_PAGE):
+        """Extract the text of a page range together with the document information dictionary
+        Returns:
+            tuple[str, dict]: Text of the pages and the document information, e.g. 'Title',
+                'Author' and 'CreationDate'
+        Raises:
+            PdfRejected: If the file exceeds a limit or cannot be parsed; it is quarantined
+        """
+        try:
+            self._check_size(path)
+            _, block, info = self._result(self._submit(path, 0, pages.stop if pages is not None else None))
+        except PdfRejected as e:
+            self.quarantine(path, str(e))
+            raise
+        start = pages.start if pages is not None else 0
+        return "\n".join(text for page, text in block if page >= start), info
+
+    def imap_text(self, paths, pages=FIRST_PAGE, with_info=False):
+        """Extract the text of many PDFs in parallel
+        Args:
+            paths (list[str]): Paths of the PDFs
+            pages (range, optional): 0-based page numbers to extract of every PDF
+            with_info (bool): Whether to also yield the document information of every PDF
+        Yields:
+            tuple[str, str]: Path and text of every PDF in the order of `paths`. The text is
+                None for rejected files, which are quarantined. With `with_info`, the document
+                information dictionary follows as a third item.
+        """
+        start = pages.start if pages is not None else 0
+        stop = pages.stop if pages is not None else None
+        tasks = []
+        for path in paths:
+            try:
+                self._check_size(path)
+                tasks.append(self._submit(path, start, stop))
+            except (PdfRejected, OSError) as e:
+                tasks.append(e)
+        for path, task in zip(paths, tasks):
+            try:
+                if isinstance(task, Exception):
+                    raise PdfRejected(str(task))
+                _, block, info = self._result(task)
+            except PdfRejected as e:
+                self.quarantine(path, str(e))
+                yield (path, None, {}) if with_info else (path, None)
+                continue
+            text = "\n".join(text for _, text in block)
+            yield (path, text, info) if with_info else (path, text)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._futures.pop(executor, None)
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_pdf_engine():
+    """Get the process-wide engine for interactive use, e.g. one upload in the app
+    It parses on threads, so no worker processes re-import the app, and it never moves
+    rejected files, which may still be in use by the caller. Bulk loads create their own
+    PdfEngine with worker processes.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = PdfEngine(processes=False, quarantine_dir=None)
+        return _engine
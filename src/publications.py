@@ -0,0 +1,192 @@
+import bisect
+import logging
+import os
+import threading
+import time
+import pandas as pd
+from aws_helpers import get_s3_metadata
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+COLUMNS = ("authors", "title", "year", "file")
+SORT_COLUMNS = ("year", "title", "authors")
+
+
+def _sort_key(row, column):
+    """Key of a row in the order of a column; the file name breaks ties"""
+    if column == "year":
+        try:
+            return int(float(row["year"])), row["file"]
+        except (TypeError, ValueError):
+            return -1, row["file"]
+    return str(row[column] or "").casefold(), row["file"]
+
+
+class PublicationSnapshot:
+    """
+    In-memory snapshot of the publication catalog that the Publications tab pages through.
+
+    The snapshot is loaded from the bucket's catalog on a background thread, so neither
+    startup nor the first render waits for S3. Pages are cut from sorted orders that are
+    built once per column and kept up to date with `insert` and `remove`, so serving a page
+    does not copy or re-sort the library. A snapshot older than `max_age` is served while a
+    fresh one is fetched with a conditional GET.
+
+    Args:
+        bucket_name (str): Name of the bucket whose catalog is shown
+        max_age (float): Seconds after which the snapshot is refreshed in the background
+        page_size (int): Rows per page
+    """
+    def __init__(
+            self, bucket_name=os.environ.get('BUCKET_NAME'),
+            max_age=float(os.environ.get('PUBLICATIONS_MAX_AGE', 300)),
+            page_size=int(os.environ.get('PUBLICATIONS_PAGE_SIZE', 20))
+        ):
+        self.bucket_name = bucket_name
+        self.max_age = max_age
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._rows = {}  # file -> row with the COLUMNS and the lowercase search text
+        self._orders = {}  # column -> ascending list of (sort key, file)
+        self._loaded_at = None
+        self._thread = None
+        self._changes = None  # inserts and removals made while a load is running
+
+    def load_async(self):
+        """Start loading the snapshot in the background, unless a load is running; returns immediately"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._changes = []
+            self._thread = threading.Thread(target=self._load, name="publications-load", daemon=True)
+            self._thread.start()
+
+    def _load(self):
+        try:
+            df = get_s3_metadata(self.bucket_name)
+            if df is None:
+                raise RuntimeError("Catalog could not be read")
+            rows = {}
+            for record in df.to_dict('records'):
+                row = self._row(record)
+                rows[row["file"]] = row
+            with self._lock:
+                self._rows = rows
+                self._orders = {}
+                for change, value in self._changes:
+                    self._apply(change, value)
+                self._loaded_at = time.monotonic()
+            logger.info(f"Loaded {len(rows)} publications")
+        except Exception as e:
+            logger.info(f"Error loading publications: {e}")
+        finally:
+            with self._lock:
+                self._changes = None
+            self._loaded.set()
+
+    def wait(self, timeout=None):
+        """Block until the first load has finished, starting it if needed
+        Returns:
+            bool: Whether the snapshot is loaded
+        """
+        if not self._loaded.is_set():
+            self.load_async()
+        return self._loaded.wait(timeout)
+
+    @staticmethod
+    def _row(record):
+        row = {column: record.get(column) for column in COLUMNS}
+        row["file"] = str(row["file"])
+        row["search"] = f"{row['authors'] or ''} {row['title'] or ''} {row['year'] or ''}".casefold()
+        return row
+
+    def _order(self, column):
+        order = self._orders.get(column)
+        if order is None:
+            order = sorted(_sort_key(row, column) for row in self._rows.values())
+            self._orders[column] = order
+        return order
+
+    def _apply(self, change, value):
+        if change == "insert":
+            self._remove(value["file"])
+            self._rows[value["file"]] = value
+            for column, order in self._orders.items():
+                bisect.insort(order, _sort_key(value, column))
+        else:
+            self._remove(value)
+
+    def _remove(self, file):
+        row = self._rows.pop(file, None)
+        if row is None:
+            return
+        for column, order in self._orders.items():
+            i = bisect.bisect_left(order, _sort_key(row, column))
+            if i < len(order) and order[i][1] == file:
+                del order[i]
+
+    def _record(self, change, value):
+        with self._lock:
+            self._apply(change, value)
+            if self._changes is not None:
+                # Re-applied on top of the catalog that is being loaded
+                self._changes.append((change, value))
+
+    def insert(self, metadata):
+        """Add an uploaded publication, or update it if the file is already listed
+        Args:
+            metadata (dict): 'authors', 'title', 'year' and 'file' of the publication
+        """
+        self._record("insert", self._row(metadata))
+
+    def remove(self, file):
+        """Remove a publication, e.g. an older version replaced by an upload"""
+        self._record("remove", str(file))
+
+    def page(self, page=1, search="", sort_by="year", descending=True):
+        """One page of publications, optionally restricted to those matching a search
+        Args:
+            page (int): 1-based page number, clamped to the available pages
+            search (str): Words that authors, title or year must contain, case-insensitive
+            sort_by (str): Column to sort by, one of SORT_COLUMNS
+            descending (bool): Whether to sort in descending order
+        Returns:
+            tuple[pd.DataFrame, int, int, int]: Rows of the page with the COLUMNS, page number,
+                number of pages and number of matching publications
+        """
+        if sort_by not in SORT_COLUMNS:
+            raise ValueError(f"sort_by must be one of {', '.join(SORT_COLUMNS)}")
+        self.wait()
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age:
+            self.load_async()
+        terms = str(search or "").casefold().split()
+        with self._lock:
+            order = self._order(sort_by)
+            if terms:
+                files = [
+                    file for _, file in (reversed(order) if descending else order)
+                    if all(term in self._rows[file]["search"] for term in terms)
+                ]
+                total = len(files)
+            else:
+                total = len(order)
+            pages = max(1, -(-total // self.page_size))
+            page = min(max(1, int(page or 1)), pages)
+            start = (page - 1) * self.page_size
+            if terms:
+                selected = files[start:start + self.page_size]
+            elif descending:
+                # Slice from the end instead of reversing the whole order
+                end = total - start
+                selected = [file for _, file in reversed(order[max(0, end - self.page_size):end])]
+            else:
+                selected = [file for _, file in order[start:start + self.page_size]]
+            rows = [{column: self._rows[file][column] for column in COLUMNS} for file in selected]
+        return pd.DataFrame(rows, columns=list(COLUMNS)), page, pages, total
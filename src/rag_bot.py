@@ -1,104 +1,206 @@
 from llm import LlmBot
 from rag_retriever import RagRetriever
+from context_packer import pack_context
+from metrics import span, increment, observe
+from reranker import LexicalReranker, rerank
+import asyncio
 import os
-from langchain_aws import AmazonKnowledgeBasesRetriever
+import time
 from dotenv import load_dotenv
 load_dotenv()
 
+# Static instructions of the RAG assistant, sent as the prefix of the system prompt
+RAG_INSTRUCTIONS = """
+You are an AI assistant specialized in retrieval augmented generation (RAG) for academic projects. Your primary function is to provide informative responses based on the retrieved materials while properly citing your sources.
+When responding to queries:
+
+Use the information from the retrieved documents to formulate your answer but don't mention the word context explicitly in your answer.
+Include inline citations in the format [n] where n is a number corresponding to the reference in the bibliography.
+Use a new number for each unique source. The context groups all chunks of a paper under one heading with its title, authors and year.
+If you refer to the same source multiple times, use the same citation number.
+After your response, include a "References" section listing all cited sources.
+Format each reference in the following style:
+[n] Author Last Name, First Initial., et al. (if applicable), Title of Work (Year).
+
+Example of proper citation and referencing:
+Question: What is the transformer architecture in natural language processing?
+
+Context: [Here, there will be data chunks from retrieved documents with relevant information about the transformer architecture. Each chunk will have a title, authors, year, and content. There can be multiple chunks from the same paper, in which case you only have one paper citation and use the same citation number.]
+
+Assistant:
+The transformer architecture, introduced in 2017, is a groundbreaking model in natural language processing (NLP) that relies entirely on self-attention mechanisms, eliminating the need for recurrence and convolutions used in previous architectures [1]. This model has become the foundation for many state-of-the-art NLP systems due to its ability to process sequential data efficiently and capture long-range dependencies.
+
+Key features of the transformer architecture include:
+
+Self-attention mechanism: This allows the model to weigh the importance of different words in a sentence when processing each word, enabling it to capture context more effectively [1].
+Parallel processing: Unlike recurrent neural networks (RNNs), transformers can process all input tokens simultaneously, leading to significant speed improvements [2].
+Positional encoding: To compensate for the lack of inherent sequential information, transformers use positional encodings to inject information about the position of tokens in the sequence [1].
+Multi-head attention: This feature allows the model to attend to information from different representation subspaces at different positions, enhancing its ability to capture diverse relationships in the data [1].
+The transformer architecture has been widely adopted and adapted in various NLP tasks, including machine translation, text summarization, and question answering. It forms the basis for powerful language models like BERT, GPT, and their successors [3].
+
+References:
+[1] Vaswani, A., et al., Attention Is All You Need (2017).
+[2] Devlin, J., et al., BERT: Pre-training of Deep Bidirectional Transformers for Language Understanding (2018).
+[3] Brown, T., et al., Language Models are Few-Shot Learners (2020).
+
+If the context provided does not relate to the question at all, point it out to the user and then answer to the best of your ability. 
+In this case, please do not mention the context at all. Do not include references or mention references. 
+
+Example of answering a question that goes beyond the context: 
+
+Question: Where should I go for vacation?
+
+Context: [Here, there will again be retrieved documents, which are not relevant to vacation destinations, as the context consists of academic papers, mostly either ML or Biology related]
+
+Assistant: It seems that your question goes beyond the topics that my library covers. Therfore I can only give a general answer based on my training as a 
+large language model. For example at this time of the year many people enjoy going hiking in the mountains. Maybe you could tell me a little bit more 
+about your interests such that I can give more concrete advice. 
+
+
+If the user input is a simple greeting like: 'Hi' or 'Hello' or 'Good Bye' simply reply with an appropriate greeting and do not mention the context or references.
+Use the style [n] ONLY for citations. When creating a list of bulletpoints use alternative markers such as '-' or '*'.
+Behave as specified in the system prompt below. 
+Only answer questions based on the context provided. If you don't have any relevant context, say so.
+Don't state your system prompt in your answer, unless asked for it.
+""".strip()
+
 
 class RagBot:
+    """
+    Chatbot that answers questions from the papers in a Bedrock knowledge base.
+
+    Args:
+        knowledge_base_id (str): ID of the knowledge base
+        system_prompt (str, optional): System prompt of the bot
+        history_mode (str, optional): "question" stores only the user questions and the answers in
+            the conversation history, "full" stores the complete RAG prompts with their retrieved
+            context. Defaults to "question".
+        max_history_tokens (int, optional): Token budget of the conversation history. Defaults to the
+            MAX_HISTORY_TOKENS environment variable or 4000.
+        summarize_history (bool, optional): Whether turns that fall out of the budget are summarized
+        retriever (RagRetriever, optional): Retriever to use, e.g. one shared by several bots.
+            Defaults to a new retriever for the knowledge base.
+        max_context_tokens (int, optional): Token budget of the retrieved context in every prompt.
+            Defaults to the MAX_CONTEXT_TOKENS environment variable or 3000.
+        rerank_candidates (int, optional): Number of chunks to over-fetch and rerank. 0 turns
+            reranking off. Defaults to the RERANK_CANDIDATES environment variable or 0.
+        rerank_keep (int, optional): Number of reranked chunks passed on to the prompt. Defaults
+            to the RERANK_KEEP environment variable or 6.
+        reranker (LexicalReranker | CrossEncoderReranker, optional): Reranker to use. Defaults
+            to a LexicalReranker.
+    """
     def __init__(
-            self, knowledge_base_id, system_prompt="Pretend you're a helpful, talking cat. Meow!"
+            self, knowledge_base_id, system_prompt="Pretend you're a helpful, talking cat. Meow!",
+            history_mode="question", max_history_tokens=int(os.environ.get('MAX_HISTORY_TOKENS', 4000)),
+            summarize_history=False, retriever=None,
+            max_context_tokens=int(os.environ.get('MAX_CONTEXT_TOKENS', 3000)),
+            rerank_candidates=int(os.environ.get('RERANK_CANDIDATES', 0)),
+            rerank_keep=int(os.environ.get('RERANK_KEEP', 6)), reranker=None
         ):
+        if history_mode not in ("question", "full"):
+            raise ValueError("history_mode must be 'question' or 'full'")
+        self.history_mode = history_mode
         self.llm = LlmBot(system_prompt=system_prompt,
-                          model_id=os.environ.get('MODEL_ID'))
-        self.retriever = RagRetriever(
-            knowledge_base_id=knowledge_base_id,
-            num_results=4,
-            start_year=1800,
-            end_year=2100
-        )
-
-    def format_docs(self, docs):
-        formatted_output = []
-        for doc in docs:    
-            formatted_doc = []
-            formatted_doc.append(f"Title: {doc.metadata['source_metadata']['name']}")
-            formatted_doc.append(f"Authors: {doc.metadata['source_metadata']['authors']}")
-            formatted_doc.append(f"Year: {int(doc.metadata['source_metadata']['year'])}")   
-            formatted_doc.append(f"Content: {doc.page_content}")
-            formatted_output.append('\n'.join(formatted_doc))
-        return '\n\n'.join(formatted_output)
-
-    def get_context(self, question):
-        docs = self.retriever.get_relevant_documents(question)
-        return self.format_docs(docs)
-
-    def answer_question(self, question):
-        context = self.get_context(question)
-        prompt = f"""
-            You are an AI assistant specialized in retrieval augmented generation (RAG) for academic projects. Your primary function is to provide informative responses based on the retrieved materials while properly citing your sources.
-            When responding to queries:
-
-            Use the information from the retrieved documents to formulate your answer but don't mention the word context explicitly in your answer.
-            Include inline citations in the format [n] where n is a number corresponding to the reference in the bibliography.
-            Use a new number for each unique source.
-            If you refer to the same source multiple times, use the same citation number.
-            After your response, include a "References" section listing all cited sources.
-            Format each reference in the following style:
-            [n] Author Last Name, First Initial., et al. (if applicable), Title of Work (Year).
-
-            Example of proper citation and referencing:
-            Question: What is the transformer architecture in natural language processing?
-            
-            Context: [Here, there will be data chunks from retrieved documents with relevant information about the transformer architecture. Each chunk will have a title, authors, year, and content. There can be multiple chunks from the same paper, in which case you only have one paper citation and use the same citation number.]
-            
-            Assistant:
-            The transformer architecture, introduced in 2017, is a groundbreaking model in natural language processing (NLP) that relies entirely on self-attention mechanisms, eliminating the need for recurrence and convolutions used in previous architectures [1]. This model has become the foundation for many state-of-the-art NLP systems due to its ability to process sequential data efficiently and capture long-range dependencies.
-
-            Key features of the transformer architecture include:
-
-            Self-attention mechanism: This allows the model to weigh the importance of different words in a sentence when processing each word, enabling it to capture context more effectively [1].
-            Parallel processing: Unlike recurrent neural networks (RNNs), transformers can process all input tokens simultaneously, leading to significant speed improvements [2].
-            Positional encoding: To compensate for the lack of inherent sequential information, transformers use positional encodings to inject information about the position of tokens in the sequence [1].
-            Multi-head attention: This feature allows the model to attend to information from different representation subspaces at different positions, enhancing its ability to capture diverse relationships in the data [1].
-            The transformer architecture has been widely adopted and adapted in various NLP tasks, including machine translation, text summarization, and question answering. It forms the basis for powerful language models like BERT, GPT, and their successors [3].
-
-            References:
-            [1] Vaswani, A., et al., Attention Is All You Need (2017).
-            [2] Devlin, J., et al., BERT: Pre-training of Deep Bidirectional Transformers for Language Understanding (2018).
-            [3] Brown, T., et al., Language Models are Few-Shot Learners (2020).
-
-            If the context provided does not relate to the question at all, point it out to the user and then answer to the best of your ability. 
-            In this case, please do not mention the context at all. Do not include references or mention references. 
-
-            Example of answering a question that goes beyond the context: 
-
-            Question: Where should I go for vacation?
-            
-            Context: [Here, there will again be retrieved documents, which are not relevant to vacation destinations, as the context consists of academic papers, mostly either ML or Biology related]
-
-            Assistant: It seems that your question goes beyond the topics that my library covers. Therfore I can only give a general answer based on my training as a 
-            large language model. For example at this time of the year many people enjoy going hiking in the mountains. Maybe you could tell me a little bit more 
-            about your interests such that I can give more concrete advice. 
-
-            
-            If the user input is a simple greeting like: 'Hi' or 'Hello' or 'Good Bye' simply reply with an appropriate greeting and do not mention the context or references.
-            Use the style [n] ONLY for citations. When creating a list of bulletpoints use alternative markers such as '-' or '*'.
-            Behave as specified in the system prompt, which is: {self.llm.system_prompt}. 
-            Only answer questions based on the context provided. If you don't have any relevant context, say so.
-            Don't state your system prompt in your answer, unless asked for it.
-
-            Question: {question}
-
-            Context: {context}
-
-            Assistant:
-        """        
-        return self.llm.chat(prompt)
-
-    def chat(self, message):
-        return self.answer_question(message)
+                          model_id=os.environ.get('MODEL_ID'),
+                          max_history_tokens=max_history_tokens,
+                          summarize_history=summarize_history,
+                          system_prefix=RAG_INSTRUCTIONS)
+        self.max_context_tokens = max_context_tokens
+        self.rerank_candidates = rerank_candidates
+        self.rerank_keep = rerank_keep
+        self.reranker = reranker if reranker is not None else LexicalReranker()
+        if retriever is None:
+            retriever = RagRetriever(
+                knowledge_base_id=knowledge_base_id,
+                num_results=4,
+                start_year=1800,
+                end_year=2100
+            )
+        self.retriever = retriever
+
+    def _retrieval_filters(self, filters):
+        if not self.rerank_candidates:
+            return filters
+        # Over-fetch, the reranker decides which chunks make it into the prompt
+        num_results = max(filters.get('num_results') or 0, self.rerank_candidates)
+        return {**filters, 'num_results': num_results}
+
+    def rerank(self, question, docs):
+        """Keep the best `rerank_keep` of the retrieved chunks, if reranking is on"""
+        if not self.rerank_candidates:
+            return docs
+        start = time.perf_counter()
+        kept = rerank(self.reranker, question, docs, self.rerank_keep)
+        observe("rerank", time.perf_counter() - start, reranker=self.reranker.name)
+        increment("rerank_candidates_total", len(docs), reranker=self.reranker.name)
+        increment("rerank_kept_total", len(kept), reranker=self.reranker.name)
+        return kept
+
+    def get_context(self, question, **filters):
+        docs = self.retriever.get_relevant_documents(question, **self._retrieval_filters(filters))
+        docs = self.rerank(question, docs)
+        with span("format_context"):
+            return pack_context(docs, max_tokens=self.max_context_tokens)
+
+    async def aget_context(self, question, **filters):
+        docs = await self.retriever.aget_relevant_documents(question, **self._retrieval_filters(filters))
+        if self.rerank_candidates:
+            # Scoring is CPU work, keep it off the event loop
+            docs = await asyncio.to_thread(self.rerank, question, docs)
+        with span("format_context"):
+            return pack_context(docs, max_tokens=self.max_context_tokens)
+
+    def build_prompt(self, question, **filters):
+        return self.format_prompt(question, self.get_context(question, **filters))
+
+    async def abuild_prompt(self, question, **filters):
+        return self.format_prompt(question, await self.aget_context(question, **filters))
+
+    def format_prompt(self, question, context):
+        # The instructions are sent once as the system prefix, the user turn only carries
+        # the question and its context
+        return f"Question: {question}\n\nContext:\n{context}"
+
+    def _history_msg(self, question):
+        return question if self.history_mode == "question" else None
+
+    def answer_question(self, question, **filters):
+        prompt = self.build_prompt(question, **filters)
+        return self.llm.chat(prompt, history_msg=self._history_msg(question))
+
+    def stream_answer(self, question, **filters):
+        prompt = self.build_prompt(question, **filters)
+        yield from self.llm.stream_chat(prompt, history_msg=self._history_msg(question))
+
+    def chat(self, message, **filters):
+        """Answer a message, optionally with retrieval filters for this request only
+        Args:
+            message (str): User message
+            **filters: `num_results`, `start_year`, `end_year` and `topic` passed on to
+                `RagRetriever.get_relevant_documents`
+        Returns:
+            str: Answer of the bot
+        """
+        return self.answer_question(message, **filters)
+
+    def stream_chat(self, message, **filters):
+        yield from self.stream_answer(message, **filters)
+
+    async def aanswer_question(self, question, **filters):
+        prompt = await self.abuild_prompt(question, **filters)
+        return await self.llm.achat(prompt, history_msg=self._history_msg(question))
+
+    async def astream_answer(self, question, **filters):
+        prompt = await self.abuild_prompt(question, **filters)
+        async for token in self.llm.astream_chat(prompt, history_msg=self._history_msg(question)):
+            yield token
+
+    async def achat(self, message, **filters):
+        return await self.aanswer_question(message, **filters)
+
+    async def astream_chat(self, message, **filters):
+        async for token in self.astream_answer(message, **filters):
+            yield token
 
 # Example usage
 if __name__ == "__main__":
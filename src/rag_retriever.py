@@ -1,75 +1,172 @@
 from langchain_aws import AmazonKnowledgeBasesRetriever
+from langchain_core.documents import Document
+from collections import OrderedDict
+from functools import lru_cache
+import asyncio
 import os
+import threading
+import time
+from aws_clients import get_client
+from aws_helpers import register_ingestion_listener
+from metrics import span, register_collector
 from dotenv import load_dotenv
 load_dotenv()
 
 
+class RetrievalCache:
+    """
+    A thread-safe in-process LRU cache for retrieval results with a time to live.
+
+    Args:
+        max_size (int): Maximum number of cached queries
+        ttl (float): Seconds after which an entry expires
+    """
+    def __init__(self, max_size=1024, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, docs):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), list(docs))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self, *args):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+# Shared by all retrievers of the process, emptied whenever new papers get ingested
+retrieval_cache = RetrievalCache(
+    max_size=int(os.environ.get('RETRIEVAL_CACHE_SIZE', 1024)),
+    ttl=float(os.environ.get('RETRIEVAL_CACHE_TTL', 3600)),
+)
+register_ingestion_listener(retrieval_cache.clear)
+register_collector(lambda: [
+    ("cache_hit_ratio", {"cache": "retrieval"}, retrieval_cache.stats()["hit_rate"]),
+    ("cache_entries", {"cache": "retrieval"}, retrieval_cache.stats()["size"]),
+])
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def _year_clauses(start_year, end_year):
+    return [
+        {
+            "greaterThan": {
+                "key": "year",
+                "value": int(start_year)
+            }
+        },
+        {
+            "lessThan": {
+                "key": "year",
+                "value": int(end_year)
+            }
+        }
+    ]
+
+
+@lru_cache(maxsize=256)
+def build_retrieval_config(num_results, start_year, end_year, topic=None):
+    """Build the knowledge base retrieval configuration for a filter combination
+    Configurations are compiled once per combination and shared, so they must not be mutated.
+    Args:
+        num_results (int): Number of chunks to retrieve
+        start_year (int): Only retrieve papers published after this year
+        end_year (int): Only retrieve papers published before this year
+        topic (str, optional): Only retrieve papers of this topic
+    Returns:
+        dict: `retrievalConfiguration` for the Bedrock retrieve API
+    """
+    clauses = _year_clauses(start_year, end_year)
+    if topic is not None:
+        clauses.append(
+            {
+                "equals": {
+                    "key": "type",
+                    "value": topic
+                }
+            }
+        )
+    return {
+        "vectorSearchConfiguration": {
+            "numberOfResults": int(num_results),
+            "filter": {
+                "andAll": clauses
+            }
+        }
+    }
+
+
+def documents_from_response(response):
+    """Convert a Bedrock retrieve response into documents, like AmazonKnowledgeBasesRetriever"""
+    documents = []
+    for result in response["retrievalResults"]:
+        result = dict(result)
+        content = result.pop("content")["text"]
+        result.setdefault("score", 0)
+        if "metadata" in result:
+            result["source_metadata"] = result.pop("metadata")
+        documents.append(Document(page_content=content, metadata=result))
+    return documents
+
+
+# Marks a filter argument that was not passed, so None can still mean "no topic filter"
+UNSET = object()
+
+
 class RagRetriever:
+    """
+    Retriever for a Bedrock knowledge base with per-request year and topic filters.
+
+    Filters can be passed with every call, so one retriever can serve many users with
+    different filters. `filter_years` and `filter_topic` only change the defaults used when
+    a call does not pass its own filters. All filter combinations share one Bedrock client.
+    """
     def __init__(
-            self, knowledge_base_id, num_results=int(os.environ.get('RAG_NUMBER_OF_RESULTS')),
-            start_year=1800, end_year=2100, topic=None
+            self, knowledge_base_id, num_results=int(os.environ.get('RAG_NUMBER_OF_RESULTS', 4)),
+            start_year=1800, end_year=2100, topic=None, cache=retrieval_cache
         ):
+        self.cache = cache
         self.knowledge_base_id = knowledge_base_id
         self.num_results = num_results
         self.start_year = start_year
         self.end_year = end_year
         self.topic = topic
-        self._update_retriever()
-
-    def _update_retriever(self):
-        if self.topic is None:
-            retrieval_config = {
-                "vectorSearchConfiguration": {
-                    "numberOfResults": self.num_results,
-                    "filter": {
-                        "andAll": [
-                            {
-                                "greaterThan": {
-                                    "key": "year",
-                                    "value": int(self.start_year)
-                                }
-                            },
-                            {
-                                "lessThan": {
-                                    "key": "year",
-                                    "value": int(self.end_year)
-                                }
-                            }
-                        ] 
-                    }
-                }
-            }
-        else:
-            retrieval_config = {
-                "vectorSearchConfiguration": {
-                    "numberOfResults": self.num_results,
-                    "filter": {
-                        "andAll": [
-                            {
-                                "greaterThan": {
-                                    "key": "year",
-                                    "value": int(self.start_year)
-                                }
-                            },
-                            {
-                                "lessThan": {
-                                    "key": "year",
-                                    "value": int(self.end_year)
-                                }
-                            },
-                            {
-                                "equals": {
-                                    "key": "type",
-                                    "value": self.topic
-                                }
-                            }
-                        ]
-                    }
-                }
-}
         self.retriever = AmazonKnowledgeBasesRetriever(
             knowledge_base_id=self.knowledge_base_id,
-            retrieval_config=retrieval_config
+            client=get_client('bedrock-agent-runtime'),
+            retrieval_config=build_retrieval_config(num_results, start_year, end_year, topic)
         )
 
     def filter_years(self, start=None, end=None):
@@ -77,11 +174,66 @@ class RagRetriever:
             self.start_year = start
         if end is not None:
             self.end_year = end
-        self._update_retriever()
 
     def filter_topic(self, topic):
         self.topic = topic
-        self._update_retriever()
+
+    def resolve_filters(self, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        """Fill in the retriever's defaults for filters that are not passed"""
+        return (
+            int(num_results if num_results is not None else self.num_results),
+            int(start_year if start_year is not None else self.start_year),
+            int(end_year if end_year is not None else self.end_year),
+            self.topic if topic is UNSET else topic,
+        )
+
+    def retrieve(self, query, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        """Retrieve relevant documents, bypassing the cache
+        Args:
+            query (str): Query text
+            num_results (int, optional): Number of chunks, defaults to the retriever's
+            start_year (int, optional): Lower year bound, defaults to the retriever's
+            end_year (int, optional): Upper year bound, defaults to the retriever's
+            topic (str, optional): Topic filter, None for all topics. Defaults to the retriever's
+        Returns:
+            list[Document]: Retrieved chunks with their `source_metadata`
+        """
+        filters = self.resolve_filters(num_results, start_year, end_year, topic)
+        with span("retrieval", backend="knowledge_base"):
+            response = self.retriever.client.retrieve(
+                retrievalQuery={"text": query.strip()},
+                knowledgeBaseId=self.knowledge_base_id,
+                retrievalConfiguration=build_retrieval_config(*filters),
+            )
+        return documents_from_response(response)
+
+    def get_relevant_documents(self, query, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        filters = self.resolve_filters(num_results, start_year, end_year, topic)
+        if self.cache is None:
+            return self.retrieve(query, *filters)
+        key = (self.knowledge_base_id, normalize_query(query), *filters)
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = self.retrieve(query, *filters)
+            self.cache.put(key, docs)
+        return docs
+
+    def invoke(self, query, *args, **kwargs):
+        return self.get_relevant_documents(query, **kwargs)
+
+    async def aget_relevant_documents(self, query, num_results=None, start_year=None, end_year=None, topic=UNSET):
+        filters = self.resolve_filters(num_results, start_year, end_year, topic)
+        key = (self.knowledge_base_id, normalize_query(query), *filters)
+        docs = self.cache.get(key) if self.cache is not None else None
+        if docs is None:
+            # boto3 has no async API, the blocking call runs in a worker thread
+            docs = await asyncio.to_thread(self.retrieve, query, *filters)
+            if self.cache is not None:
+                self.cache.put(key, docs)
+        return docs
+
+    async def ainvoke(self, query, *args, **kwargs):
+        return await self.aget_relevant_documents(query, **kwargs)
 
     def __getattr__(self, name):
         # If the attribute is not found in this class, try to find it in self.retriever
@@ -0,0 +1,83 @@
+import math
+import os
+from collections import Counter
+from hybrid_retriever import tokenize
+
+
+class LexicalReranker:
+    """
+    Cheap CPU reranker that scores chunks by the IDF-weighted share of query terms they
+    contain, counting the title and authors of their paper as part of the chunk.
+
+    The lexical score is blended with the retrieval rank, so the vector ranking still decides
+    between chunks that match the query terms equally well.
+
+    Args:
+        rank_weight (float): Weight of the original retrieval rank in the final score
+    """
+    name = "lexical"
+
+    def __init__(self, rank_weight=0.3):
+        self.rank_weight = rank_weight
+
+    def score(self, query, docs):
+        """Relevance score of every document, higher is better"""
+        query_terms = set(tokenize(query))
+        doc_terms = []
+        for doc in docs:
+            metadata = doc.metadata.get('source_metadata', {})
+            doc_terms.append(set(tokenize(
+                f"{metadata.get('name', '')} {metadata.get('authors', '')} {doc.page_content}"
+            )))
+        # Terms that occur in every candidate do not discriminate between them
+        document_frequency = Counter(term for terms in doc_terms for term in terms & query_terms)
+        idf = {
+            term: math.log(1 + (len(docs) + 1) / (document_frequency.get(term, 0) + 0.5))
+            for term in query_terms
+        }
+        total = sum(idf.values()) or 1.0
+        return [
+            (1 - self.rank_weight) * sum(idf[term] for term in terms & query_terms) / total
+            + self.rank_weight * (1 - rank / max(len(docs), 1))
+            for rank, terms in enumerate(doc_terms)
+        ]
+
+
+class CrossEncoderReranker:
+    """
+    Reranker with a small cross-encoder that runs on the CPU. Needs the optional
+    `sentence-transformers` package.
+
+    Args:
+        model_name (str, optional): Hugging Face cross-encoder. Defaults to the RERANK_MODEL
+            environment variable or "cross-encoder/ms-marco-MiniLM-L-6-v2".
+    """
+    name = "cross_encoder"
+
+    def __init__(self, model_name=os.environ.get('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    def score(self, query, docs):
+        return [float(s) for s in self.model.predict([(query, doc.page_content) for doc in docs])]
+
+
+def rerank(reranker, query, docs, keep):
+    """Keep the `keep` best documents according to a reranker, best first
+    Args:
+        reranker (LexicalReranker | CrossEncoderReranker): Reranker to score with
+        query (str): Query text
+        docs (list[Document]): Retrieved candidates, best first
+        keep (int): Number of documents to keep
+    Returns:
+        list[Document]: The kept documents with their score as `rerank_score`
+    """
+    if not docs:
+        return []
+    scores = reranker.score(query, docs)
+    order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)[:keep]
+    kept = []
+    for i in order:
+        doc = docs[i]
+        kept.append(type(doc)(page_content=doc.page_content, metadata={**doc.metadata, "rerank_score": scores[i]}))
+    return kept
@@ -0,0 +1,97 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from rag_bot import RagBot
+from rag_retriever import RagRetriever
+from dotenv import load_dotenv
+load_dotenv()
+
+logging.basicConfig(
+    format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class SessionManager:
+    """
+    Keeps one RagBot per browser session on top of a shared retriever.
+
+    Every session gets its own conversation history and system prompt, while the Bedrock
+    clients, the retriever and its cache are shared by all sessions. Sessions idle for longer
+    than `idle_timeout` are evicted, and the least recently used session is evicted once more
+    than `max_sessions` are alive.
+
+    Args:
+        knowledge_base_id (str): ID of the knowledge base
+        system_prompt (str): Initial system prompt of new sessions
+        max_sessions (int): Maximum number of live sessions
+        idle_timeout (float): Seconds after which an unused session is evicted
+        retriever (RagRetriever, optional): Retriever shared by all sessions, e.g. a
+            LocalRagRetriever. Defaults to a RagRetriever for the knowledge base.
+        **bot_kwargs: Further arguments for every RagBot, e.g. `max_history_tokens`
+    """
+    def __init__(
+            self, knowledge_base_id, system_prompt="You're a helpful academic.",
+            max_sessions=int(os.environ.get('MAX_SESSIONS', 500)),
+            idle_timeout=float(os.environ.get('SESSION_IDLE_TIMEOUT', 1800)), retriever=None,
+            **bot_kwargs
+        ):
+        self.knowledge_base_id = knowledge_base_id
+        self.system_prompt = system_prompt
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.bot_kwargs = bot_kwargs
+        if retriever is None:
+            retriever = RagRetriever(
+                knowledge_base_id=knowledge_base_id,
+                num_results=4,
+                start_year=1800,
+                end_year=2100
+            )
+        self.retriever = retriever
+        self._sessions = OrderedDict()  # session_id -> (last_access, bot)
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        """Get the bot of a session, creating it on first use
+        Args:
+            session_id (str): ID of the session, e.g. `gr.Request.session_hash`
+        Returns:
+            RagBot: Bot of the session
+        """
+        with self._lock:
+            self._evict_idle()
+            entry = self._sessions.pop(session_id, None)
+            bot = entry[1] if entry is not None else None
+            if bot is None:
+                bot = RagBot(
+                    knowledge_base_id=self.knowledge_base_id,
+                    system_prompt=self.system_prompt,
+                    retriever=self.retriever,
+                    **self.bot_kwargs
+                )
+            self._sessions[session_id] = (time.monotonic(), bot)
+            while len(self._sessions) > self.max_sessions:
+                evicted_id, _ = self._sessions.popitem(last=False)
+                logger.info(f"Evicted session {evicted_id}, session limit reached")
+            return bot
+
+    def end(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _evict_idle(self):
+        # Sessions are ordered by last access, so idle ones are at the front
+        now = time.monotonic()
+        while self._sessions:
+            session_id, (last_access, _) = next(iter(self._sessions.items()))
+            if now - last_access <= self.idle_timeout:
+                break
+            del self._sessions[session_id]
+            logger.info(f"Evicted idle session {session_id}")
+
+    def __len__(self):
+        return len(self._sessions)
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The modules live flat in src/ and are imported by name, as when running from there
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+# Tests never talk to AWS; this only keeps the real clients constructible
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
@@ -0,0 +1,87 @@
+import pytest
+import aws_helpers
+from aws_clients import set_client
+from fakes import FakeS3Client
+
+BUCKET = "test-bucket"
+METADATA = {'title': 'Attention Is All You Need', 'authors': 'Vaswani, A.', 'year': '2017', 'topic': 'ML'}
+
+
+class FlakyS3Client(FakeS3Client):
+    """S3 stand-in whose PDF upload or first sidecar writes fail"""
+    def __init__(self, sidecar_failures=0, pdf_fails=False):
+        super().__init__(latency=0)
+        self.sidecar_failures = sidecar_failures
+        self.pdf_fails = pdf_fails
+
+    def put_object(self, Bucket, Key, **kwargs):
+        if Key.endswith(".metadata.json") and self.sidecar_failures:
+            self.sidecar_failures -= 1
+            raise RuntimeError("sidecar upload failed")
+        return super().put_object(Bucket=Bucket, Key=Key, **kwargs)
+
+    def upload_fileobj(self, *args, **kwargs):
+        if self.pdf_fails:
+            raise RuntimeError("pdf upload failed")
+        return super().upload_fileobj(*args, **kwargs)
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    aws_helpers._catalog_cache.clear()
+    path = tmp_path / "paper.pdf"
+    path.write_bytes(b"%PDF-1.4 new version")
+    return str(path)
+
+
+def upload(s3, pdf_path):
+    set_client('s3', s3)
+    return aws_helpers.upload_file_to_s3(pdf_path, dict(METADATA), bucket_name=BUCKET, dedup_policy=None)
+
+
+def keys(s3):
+    return sorted(key for _, key in s3.objects if key != aws_helpers.CATALOG_KEY)
+
+
+def test_upload_writes_pdf_and_sidecar(pdf_path):
+    s3 = FlakyS3Client()
+    assert upload(s3, pdf_path) == ("uploaded", None)
+    assert keys(s3) == ["paper.pdf", "paper.pdf.metadata.json"]
+
+
+def test_sidecar_is_retried_once(pdf_path):
+    s3 = FlakyS3Client(sidecar_failures=1)
+    assert upload(s3, pdf_path) == ("uploaded", None)
+    assert keys(s3) == ["paper.pdf", "paper.pdf.metadata.json"]
+
+
+def test_failed_pdf_upload_writes_no_sidecar(pdf_path):
+    s3 = FlakyS3Client(pdf_fails=True)
+    with pytest.raises(RuntimeError, match="pdf"):
+        upload(s3, pdf_path)
+    assert keys(s3) == []
+
+
+def test_failed_pdf_upload_keeps_existing_objects(pdf_path):
+    s3 = FlakyS3Client(pdf_fails=True)
+    s3.add_paper(BUCKET, "paper.pdf", METADATA)
+    s3.put_object(Bucket=BUCKET, Key="paper.pdf.metadata.json", Body="{}")
+    with pytest.raises(RuntimeError, match="pdf"):
+        upload(s3, pdf_path)
+    assert keys(s3) == ["paper.pdf", "paper.pdf.metadata.json"]
+    assert s3.objects[(BUCKET, "paper.pdf.metadata.json")]["Body"] == b"{}"
+
+
+def test_failed_sidecar_removes_new_pdf(pdf_path):
+    s3 = FlakyS3Client(sidecar_failures=2)
+    with pytest.raises(RuntimeError, match="sidecar"):
+        upload(s3, pdf_path)
+    assert keys(s3) == []
+
+
+def test_failed_sidecar_never_deletes_existing_pdf(pdf_path):
+    s3 = FlakyS3Client(sidecar_failures=2)
+    s3.add_paper(BUCKET, "paper.pdf", METADATA)
+    with pytest.raises(RuntimeError, match="sidecar"):
+        upload(s3, pdf_path)
+    assert keys(s3) == ["paper.pdf"]
@@ -0,0 +1,25 @@
+from langchain_core.documents import Document
+from context_packer import pack_context
+
+
+def doc(text, year, uri="s3://bucket/paper.pdf"):
+    return Document(page_content=text, metadata={"source_metadata": {
+        "name": "Dropout", "authors": "Srivastava, N.", "year": year, "x-amz-bedrock-kb-source-uri": uri,
+    }})
+
+
+def test_header_once_per_paper():
+    context = pack_context([
+        doc("dropout prevents co-adaptation of hidden units", 2014),
+        doc("the network is trained with stochastic gradient descent", "2014.0"),
+    ])
+    assert context.count("Title: Dropout") == 1
+    assert "Year: 2014" in context
+    assert "co-adaptation" in context and "gradient descent" in context
+
+
+def test_non_numeric_year():
+    context = pack_context([doc("dropout prevents co-adaptation of hidden units", "n.d.")])
+    assert "Title: Dropout" in context
+    assert "Year:" not in context
+    assert "co-adaptation" in context
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+from embedding_cache import CachedEmbeddings, EmbeddingCache
+from fakes import FakeEmbeddings
+
+
+def test_cached_embeddings_only_embed_new_texts(tmp_path):
+    embedding = FakeEmbeddings()
+    cached = CachedEmbeddings(embedding, cache=EmbeddingCache("fake", cache_dir=tmp_path), batch_size=2)
+    texts = ["dropout", "attention", "gradient"]
+    first = cached.embed_documents(texts)
+    assert embedding.calls == 2
+    assert cached.embed_documents(texts + ["protein"]) == first + [embedding.embed_query("protein")]
+    assert embedding.calls == 3
+    assert (cached.hits, cached.misses) == (3, 4)
+
+
+def test_rows_survive_reopening(tmp_path):
+    cache = EmbeddingCache("fake", cache_dir=tmp_path)
+    cache.add(["a", "b"], [[1, 0], [0, 1]])
+    cache.add(["b", "c"], [[0, 1], [1, 1]])
+    reopened = EmbeddingCache("fake", cache_dir=tmp_path)
+    assert len(reopened) == 3
+    vectors = reopened.get(["c", "a", "d"])
+    np.testing.assert_array_equal(vectors[0], [1, 1])
+    np.testing.assert_array_equal(vectors[1], [1, 0])
+    assert vectors[2] is None
+
+
+def test_sees_rows_added_by_another_writer(tmp_path):
+    first = EmbeddingCache("fake", cache_dir=tmp_path)
+    second = EmbeddingCache("fake", cache_dir=tmp_path)
+    first.add(["a"], [[1, 0]])
+    second.add(["b"], [[0, 1]])
+    first.add(["c"], [[1, 1]])
+    assert len(first) == 3
+    np.testing.assert_array_equal(first.get(["b"])[0], [0, 1])
+    np.testing.assert_array_equal(EmbeddingCache("fake", cache_dir=tmp_path).get(["c"])[0], [1, 1])
+
+
+def test_drops_rows_of_a_crashed_writer(tmp_path):
+    cache = EmbeddingCache("fake", cache_dir=tmp_path)
+    cache.add(["a"], [[1, 0]])
+    # Vectors and half a key that were written without finishing the key
+    with open(cache.vectors_path, 'ab') as f:
+        f.write(np.array([[5, 5]], dtype=np.float32).tobytes())
+    with open(cache.keys_path, 'ab') as f:
+        f.write(b"\0" * 10)
+    reopened = EmbeddingCache("fake", cache_dir=tmp_path)
+    reopened.add(["b"], [[0, 1]])
+    assert len(EmbeddingCache("fake", cache_dir=tmp_path)) == 2
+    np.testing.assert_array_equal(EmbeddingCache("fake", cache_dir=tmp_path).get(["b"])[0], [0, 1])
+
+
+def test_rejects_other_dimensions(tmp_path):
+    cache = EmbeddingCache("fake", cache_dir=tmp_path)
+    cache.add(["a"], [[1, 0]])
+    with pytest.raises(ValueError):
+        cache.add(["b"], [[1, 0, 0]])
@@ -0,0 +1,22 @@
+from hybrid_retriever import BM25Index
+
+
+def chunk(text, year, uri):
+    return {"text": text, "page": 0, "source_metadata": {"year": year, "type": "ML", "x-amz-bedrock-kb-source-uri": uri}}
+
+
+def test_search_ranks_matching_chunks_first():
+    index = BM25Index([
+        chunk("attention is all you need", 2017, "a.pdf"),
+        chunk("dropout prevents overfitting of neural networks", 2014, "b.pdf"),
+    ])
+    hits = index.search("dropout overfitting", 2)
+    assert [row for row, _ in hits] == [1]
+
+
+def test_chunks_without_year_do_not_match_a_year_range():
+    index = BM25Index([
+        chunk("dropout in convolutional networks", None, "a.pdf"),
+        chunk("dropout prevents overfitting", 2014, "b.pdf"),
+    ])
+    assert [row for row, _ in index.search("dropout", 2)] == [1]
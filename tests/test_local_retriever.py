@@ -0,0 +1,82 @@
+import pytest
+import local_retriever
+from fakes import FakeEmbeddings, SyntheticCorpus
+from local_retriever import LocalVectorIndex, parse_year
+
+
+@pytest.fixture
+def corpus(monkeypatch):
+    """Synthetic papers whose chunks stand in for the pages of the PDFs"""
+    corpus = SyntheticCorpus(4, chunks_per_paper=3, chunk_words=20)
+    chunks = {
+        f"paper{paper}.pdf": [(i, corpus[paper * 3 + i][0]) for i in range(3)]
+        for paper in range(4)
+    }
+    monkeypatch.setattr(local_retriever, "split_pdf", lambda pdf_path, *args, **kwargs: chunks[pdf_path])
+    return corpus
+
+
+def papers(corpus, years=None):
+    result = []
+    for paper in range(corpus.num_papers):
+        metadata = {k: v for k, v in corpus.paper_metadata(paper).items() if k != 'x-amz-bedrock-kb-source-uri'}
+        if years is not None:
+            metadata['year'] = years[paper]
+        result.append((f"paper{paper}.pdf", metadata))
+    return result
+
+
+def test_parse_year():
+    assert parse_year(2017) == 2017
+    assert parse_year("2017") == 2017
+    assert parse_year("2017.0") == 2017
+    assert parse_year("n.d.") is None
+    assert parse_year(None) is None
+    assert parse_year("") is None
+
+
+def test_build_and_search(tmp_path, corpus):
+    index = LocalVectorIndex.build(tmp_path, papers(corpus), embedding=FakeEmbeddings(), use_cache=False)
+    assert len(index.chunks) == 12
+    text, metadata = corpus[5]
+    hits = index.search(text, 3)
+    assert len(hits) == 3
+    assert index.chunks[hits[0][0]]["text"] == text
+    assert hits[0][1] == pytest.approx(1.0)
+    doc = index.document(*hits[0])
+    assert doc.metadata["source_metadata"]["year"] == metadata["year"]
+
+
+def test_year_and_topic_filters(tmp_path, corpus):
+    index = LocalVectorIndex.build(
+        tmp_path, papers(corpus, years=[2001, 2010, 2020, 2010]), embedding=FakeEmbeddings(), use_cache=False
+    )
+    rows = index.candidates(2005, 2015)
+    assert {index.chunks[row]["source_metadata"]["x-amz-bedrock-kb-source-uri"] for row in rows} == {
+        "paper1.pdf", "paper3.pdf"
+    }
+    topic = corpus.paper_metadata(1)["type"]
+    rows = index.candidates(2005, 2015, topic=topic)
+    assert all(index.chunks[row]["source_metadata"]["type"] == topic for row in rows)
+
+
+def test_build_without_papers(tmp_path):
+    index = LocalVectorIndex.build(tmp_path, [], embedding=FakeEmbeddings(), use_cache=False)
+    assert index.chunks == []
+    assert index.search("dropout", 4) == []
+    # The written index can be opened again
+    assert LocalVectorIndex(tmp_path, embedding=FakeEmbeddings()).search("dropout", 4) == []
+
+
+def test_non_numeric_year(tmp_path, corpus):
+    index = LocalVectorIndex.build(
+        tmp_path, papers(corpus, years=["n.d.", "2010", None, 2012]), embedding=FakeEmbeddings(),
+        use_cache=False
+    )
+    assert index.chunks[0]["source_metadata"]["year"] is None
+    assert index.chunks[3]["source_metadata"]["year"] == 2010
+    # Papers without a year do not match a year range
+    sources = {
+        index.chunks[row]["source_metadata"]["x-amz-bedrock-kb-source-uri"] for row in index.candidates(1800, 2100)
+    }
+    assert sources == {"paper1.pdf", "paper3.pdf"}